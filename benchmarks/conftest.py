@@ -0,0 +1,201 @@
+import os
+import random
+import shutil
+import time
+import unittest.mock as mock
+import openai
+import pytest
+from chatgpt.database import LocalDatabase
+from chatgpt.scheduler import RequestScheduler
+
+# Message counts of the synthetic chat.db files. 1,000,000 takes a while to
+# build, so it is opt-in: BENCH_SIZES=1000,100000,1000000 make benchmark
+SIZES = [int(size) for size in os.getenv("BENCH_SIZES", "1000,100000").split(",")]
+MESSAGES_PER_CONVERSATION = 20
+# Seconds the fake completion API waits before answering.
+COMPLETION_LATENCY = float(os.getenv("BENCH_COMPLETION_LATENCY", 0))
+# A PostgreSQL server to also run the storage benchmarks against, on which
+# they create bench_* schemas.
+POSTGRES_DSN = os.getenv("BENCH_POSTGRES_DSN")
+
+WORDS = (
+    "the of and to in is that it for on with as was at by this from be or "
+    "are an have not but which function data model python query index table "
+    "conversation message token context summary database latency cache"
+).split()
+
+
+def _content(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(10, 200)))
+
+
+def synthetic_messages(messages):
+    """
+    Yield the rows of a deterministic history with the given number of
+    messages, split into conversations of MESSAGES_PER_CONVERSATION
+    alternating turns, as put_messages takes them.
+    """
+    rng = random.Random(messages)
+    for index in range(messages):
+        content = _content(rng)
+        yield (
+            {"role": "user" if index % 2 == 0 else "assistant", "content": content},
+            index // MESSAGES_PER_CONVERSATION + 1,
+            index % MESSAGES_PER_CONVERSATION,
+            len(content.split()) * 4 // 3,
+        )
+
+
+def build_chat_db(db_path, messages):
+    """
+    Write a synthetic chat.db with the given number of messages and a title
+    for every conversation.
+    """
+    conversations = -(-messages // MESSAGES_PER_CONVERSATION)
+    with LocalDatabase(db_file=db_path) as db:
+        db.create_tables()
+        with db.bulk_insert() as insert:
+            insert(
+                "conversations",
+                ["id", "title"],
+                ((i, f"Conversation {i}") for i in range(1, conversations + 1)),
+            )
+            db.put_messages(synthetic_messages(messages))
+
+
+def fill_backend(db, messages):
+    """
+    Write the same history as build_chat_db through any StorageBackend.
+    """
+    conversations = -(-messages // MESSAGES_PER_CONVERSATION)
+    with db.transaction():
+        for conversation_id in range(1, conversations + 1):
+            db.put_conversation(conversation_id)
+            db.update_conversation_title(
+                conversation_id, f"Conversation {conversation_id}"
+            )
+        db.put_messages(synthetic_messages(messages))
+
+
+@pytest.fixture(scope="session")
+def chat_db_cache(tmp_path_factory):
+    """
+    Build each synthetic database once per session, on first use.
+    """
+    directory = tmp_path_factory.mktemp("chat_dbs")
+    paths = {}
+
+    def get(messages):
+        if messages not in paths:
+            paths[messages] = str(directory / f"chat_{messages}.db")
+            build_chat_db(paths[messages], messages)
+        return paths[messages]
+
+    return get
+
+
+@pytest.fixture(params=SIZES, ids=lambda size: f"{size}_messages")
+def chat_db(request, chat_db_cache, tmp_path):
+    """
+    A private copy of a synthetic database, safe to write to.
+    """
+    db_path = str(tmp_path / "chat.db")
+    shutil.copy(chat_db_cache(request.param), db_path)
+    return db_path
+
+
+@pytest.fixture(scope="session")
+def postgres_cache():
+    """
+    Fill one schema per synthetic database size on the BENCH_POSTGRES_DSN
+    server, once per session, on first use.
+    """
+    if POSTGRES_DSN is None:
+        pytest.skip("BENCH_POSTGRES_DSN is not set")
+    psycopg = pytest.importorskip("psycopg")
+    from chatgpt.postgres import PostgresDatabase
+
+    conninfos = {}
+
+    def get(messages):
+        if messages not in conninfos:
+            schema = f"bench_{messages}"
+            with psycopg.connect(POSTGRES_DSN, autocommit=True) as conn:
+                conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+                conn.execute(f"CREATE SCHEMA {schema}")
+            conninfos[messages] = psycopg.conninfo.make_conninfo(
+                POSTGRES_DSN, options=f"-csearch_path={schema}"
+            )
+            with PostgresDatabase(conninfos[messages]) as db:
+                db.create_tables()
+                fill_backend(db, messages)
+        return conninfos[messages]
+
+    yield get
+
+    with psycopg.connect(POSTGRES_DSN, autocommit=True) as conn:
+        for messages in conninfos:
+            conn.execute(f"DROP SCHEMA bench_{messages} CASCADE")
+
+
+@pytest.fixture(
+    params=[(backend, size) for backend in ("local", "postgres") for size in SIZES],
+    ids=lambda param: f"{param[0]}-{param[1]}_messages",
+)
+def storage(request, chat_db_cache, tmp_path):
+    """
+    A StorageBackend holding a synthetic history. Local databases are private
+    copies; PostgreSQL schemas are shared by the session, so benchmarks
+    writing to them add conversations rather than change existing ones.
+    """
+    backend, size = request.param
+    if backend == "local":
+        db_path = str(tmp_path / "chat.db")
+        shutil.copy(chat_db_cache(size), db_path)
+        db = LocalDatabase(db_file=db_path)
+    else:
+        from chatgpt.postgres import PostgresDatabase
+
+        db = PostgresDatabase(request.getfixturevalue("postgres_cache")(size))
+    db.create_tables()
+    yield db
+
+    db.close()
+
+
+@pytest.fixture
+def unlimited_scheduler():
+    # Benchmarks measure our overhead, not the client-side rate limits.
+    return RequestScheduler(requests_per_minute=10**9, tokens_per_minute=10**12)
+
+
+def fake_completion(**request):
+    time.sleep(COMPLETION_LATENCY)
+    content = "This is a deterministic fake completion. " * 10
+    if request.get("stream"):
+        return iter(
+            {"choices": [{"delta": {"content": word + " "}}]}
+            for word in content.split()
+        )
+    return {
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 80},
+    }
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "benchmark")
+    with mock.patch.object(
+        openai.ChatCompletion, "create", side_effect=fake_completion
+    ):
+        yield
+
+
+@pytest.fixture
+def local_db(tmp_path):
+    db = LocalDatabase(db_file=str(tmp_path / "bench.db"))
+    db.create_tables()
+    yield db
+
+    db.close()
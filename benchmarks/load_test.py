@@ -0,0 +1,161 @@
+"""
+Load test the ASGI chat server against a local mock of the completion API.
+
+Starts a mock upstream that streams a fixed reply token by token, and
+answers non-streaming requests such as titles in one piece, then opens many
+concurrent /api/chat streams and reports time-to-first-token.
+
+    python benchmarks/load_test.py --streams 100
+    python benchmarks/load_test.py --url http://127.0.0.1:8000
+
+Without --url the ASGI application is driven in-process; with it, requests
+go over HTTP to a server started separately (e.g. uvicorn chatgpt.asgi:app)
+which must itself be pointed at the mock with OPENAI_API_BASE.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+import openai
+from aiohttp import ClientSession, web
+
+
+def mock_upstream(tokens, first_token_latency, token_interval):
+    async def completions(request):
+        body = await request.json()
+        if not body.get("stream"):
+            await asyncio.sleep(first_token_latency)
+            message = {"role": "assistant", "content": "".join(tokens)}
+            return web.json_response(
+                {
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": message}],
+                }
+            )
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(first_token_latency)
+        for token in tokens:
+            chunk = {
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": token}}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(token_interval)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    return app
+
+
+async def start(app, port=0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+async def stream_in_process(app, prompt):
+    body = json.dumps({"prompt": prompt}).encode()
+    finished = asyncio.Event()
+    request_sent = False
+    started = time.perf_counter()
+    first_token = None
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal first_token
+        if message["type"] != "http.response.body":
+            return
+        if first_token is None and b'"response"' in message["body"]:
+            first_token = time.perf_counter()
+        if not message.get("more_body", False):
+            finished.set()
+
+    scope = {"type": "http", "path": "/api/chat", "method": "POST"}
+    await app(scope, receive, send)
+    return first_token - started
+
+
+async def stream_over_http(session, url, prompt):
+    started = time.perf_counter()
+    async with session.post(f"{url}/api/chat", json={"prompt": prompt}) as response:
+        async for chunk in response.content.iter_any():
+            if b'"response"' in chunk:
+                first_token = time.perf_counter()
+                async for _ in response.content.iter_any():
+                    pass
+                return first_token - started
+
+
+async def main(args):
+    tokens = [f"token{i} " for i in range(args.tokens)]
+    upstream, port = await start(
+        mock_upstream(tokens, args.first_token_latency, args.token_interval),
+        args.upstream_port,
+    )
+    openai.api_base = f"http://127.0.0.1:{port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "load-test")
+    print(f"Mock upstream listening on {openai.api_base}")
+
+    try:
+        if args.url is None:
+            from chatgpt.asgi import ChatApplication
+
+            with tempfile.TemporaryDirectory() as tmp:
+                app = ChatApplication(
+                    db_path=os.path.join(tmp, "load.db"),
+                    max_concurrency=args.streams,
+                )
+                started = time.perf_counter()
+                ttfts = await asyncio.gather(
+                    *(
+                        stream_in_process(app, f"Prompt {i}")
+                        for i in range(args.streams)
+                    )
+                )
+                elapsed = time.perf_counter() - started
+                # Let the titles finish against the mock before the database goes.
+                await asyncio.to_thread(app.title_worker.close)
+                app.database.close()
+        else:
+            async with ClientSession() as session:
+                started = time.perf_counter()
+                ttfts = await asyncio.gather(
+                    *(
+                        stream_over_http(session, args.url, f"Prompt {i}")
+                        for i in range(args.streams)
+                    )
+                )
+                elapsed = time.perf_counter() - started
+    finally:
+        await upstream.cleanup()
+
+    quantiles = statistics.quantiles(ttfts, n=100)
+    print(f"{args.streams} concurrent streams finished in {elapsed:.2f}s")
+    print(f"time to first token p50: {quantiles[49] * 1000:.1f}ms")
+    print(f"time to first token p99: {quantiles[98] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--first-token-latency", type=float, default=0.1)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--upstream-port", type=int, default=0)
+    parser.add_argument("--url", default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,22 @@
+import pytest
+from chatgpt import analytics
+
+
+def _role_tokens_in_pandas(db):
+    # Loads every message, as reports built on get_messages had to.
+    messages = db.get_messages()
+    return messages.groupby("role")["token_count"].describe(
+        percentiles=analytics.PERCENTILES
+    )
+
+
+@pytest.mark.parametrize("aggregated", [False, True], ids=["pandas", "sql"])
+def test_role_tokens(benchmark, storage, aggregated):
+    if aggregated:
+        benchmark(analytics.role_tokens, storage)
+    else:
+        benchmark(_role_tokens_in_pandas, storage)
+
+
+def test_report(benchmark, storage):
+    benchmark(analytics.report, storage)
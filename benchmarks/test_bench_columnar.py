@@ -0,0 +1,43 @@
+import pytest
+from chatgpt.database import LocalDatabase
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def source_db(chat_db):
+    with LocalDatabase(db_file=chat_db) as db:
+        yield db
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_export_history(benchmark, source_db, tmp_path, format):
+    benchmark.pedantic(
+        source_db.export_history,
+        args=(str(tmp_path / "export"),),
+        kwargs={"format": format},
+        rounds=3,
+    )
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_import_history(benchmark, source_db, tmp_path, format):
+    directory = str(tmp_path / "export")
+    source_db.export_history(directory, format=format)
+
+    def setup():
+        target = LocalDatabase(db_file=str(tmp_path / f"target_{len(targets)}.db"))
+        target.create_tables()
+        targets.append(target)
+        return (target, directory), {"format": format}
+
+    targets = []
+    benchmark.pedantic(
+        lambda target, directory, format: target.import_history(
+            directory, format=format
+        ),
+        setup=setup,
+        rounds=3,
+    )
+    for target in targets:
+        target.close()
@@ -0,0 +1,37 @@
+import pytest
+from chatgpt.chatbot import Chatbot
+from chatgpt.database import LocalDatabase
+
+
+@pytest.fixture(params=[1_000, 10_000, 100_000])
+def populated_db_path(request, tmp_path):
+    db_path = str(tmp_path / "bench.db")
+    with LocalDatabase(db_file=db_path) as db:
+        db.create_tables()
+        with db.transaction() as conn:
+            # Half the conversations are titled and in use, half abandoned.
+            conn.executemany(
+                "INSERT INTO conversations (id, title) VALUES (?, ?)",
+                (
+                    (i, f"Conversation {i}" if i % 2 else None)
+                    for i in range(1, request.param + 1)
+                ),
+            )
+            db.put_messages(
+                ({"role": "user", "content": "Hello"}, i, 0, 1)
+                for i in range(1, request.param + 1, 2)
+            )
+    return db_path
+
+
+def test_constructor(benchmark, populated_db_path):
+    def construct():
+        Chatbot(db_path=populated_db_path).close()
+
+    benchmark(construct)
+
+
+def test_collect_garbage(benchmark, populated_db_path):
+    chatbot = Chatbot(db_path=populated_db_path)
+    benchmark.pedantic(chatbot.collect_garbage, kwargs={"min_age": 0}, rounds=1)
+    chatbot.close()
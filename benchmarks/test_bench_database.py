@@ -0,0 +1,59 @@
+import sqlite3
+
+
+def _query_db_connect_per_query(db_file, query, params=None, fetch=None):
+    # The pre-pooling implementation of LocalDatabase._query_db.
+    conn = sqlite3.connect(db_file)
+    cur = conn.cursor()
+    if params:
+        cur.execute(query, params)
+    else:
+        cur.execute(query)
+    if fetch == "one":
+        data = cur.fetchone()
+    conn.commit()
+    conn.close()
+    if fetch == "one":
+        return data
+
+
+def _seed(db, n=100):
+    db.put_conversation(1)
+    for i in range(n):
+        db.put_message({"role": "user", "content": f"Message {i}"}, 1, i, 3)
+
+
+def test_select_pooled(benchmark, local_db):
+    _seed(local_db)
+    benchmark(
+        local_db._query_db,
+        "SELECT content FROM messages WHERE id = ?",
+        (50,),
+        fetch="one",
+    )
+
+
+def test_select_connect_per_query(benchmark, local_db):
+    _seed(local_db)
+    benchmark(
+        _query_db_connect_per_query,
+        local_db.db_file,
+        "SELECT content FROM messages WHERE id = ?",
+        (50,),
+        fetch="one",
+    )
+
+
+def test_update_pooled(benchmark, local_db):
+    local_db.put_conversation(1)
+    benchmark(local_db.update_conversation, 1)
+
+
+def test_update_connect_per_query(benchmark, local_db):
+    local_db.put_conversation(1)
+    benchmark(
+        _query_db_connect_per_query,
+        local_db.db_file,
+        "UPDATE conversations SET last_updated = datetime('now') WHERE id = ?",
+        (1,),
+    )
@@ -0,0 +1,47 @@
+import os
+
+CONVERSATIONS = int(os.getenv("BENCH_IMPORT_CONVERSATIONS", 10_000))
+MESSAGES = int(os.getenv("BENCH_IMPORT_MESSAGES", 50))
+ROW_BY_ROW_CONVERSATIONS = int(os.getenv("BENCH_IMPORT_ROW_BY_ROW", 100))
+
+
+def _conversation(index):
+    return [
+        {
+            "role": "user" if position % 2 == 0 else "assistant",
+            "content": f"Conversation {index} message {position}",
+        }
+        for position in range(MESSAGES)
+    ]
+
+
+def _import_batched(db, conversations):
+    with db.transaction():
+        conversation_id = db.get_max_conversation_id()
+        for conversation in conversations:
+            conversation_id += 1
+            db.put_conversation(conversation_id)
+            db.put_messages(
+                (message, conversation_id, position, 5)
+                for position, message in enumerate(conversation)
+            )
+            db.update_conversation(conversation_id)
+
+
+def _import_row_by_row(db, conversations):
+    for conversation in conversations:
+        conversation_id = db.get_max_conversation_id() + 1
+        db.put_conversation(conversation_id)
+        for position, message in enumerate(conversation):
+            db.put_message(message, conversation_id, position, 5)
+        db.update_conversation(conversation_id)
+
+
+def test_import_batched(benchmark, local_db):
+    conversations = [_conversation(i) for i in range(CONVERSATIONS)]
+    benchmark.pedantic(_import_batched, args=(local_db, conversations), rounds=1)
+
+
+def test_import_row_by_row(benchmark, local_db):
+    conversations = [_conversation(i) for i in range(ROW_BY_ROW_CONVERSATIONS)]
+    benchmark.pedantic(_import_row_by_row, args=(local_db, conversations), rounds=1)
@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+# IPython is already loaded in a kernel, so only our own import is charged.
+PRELOADED = "import IPython.core.magic, IPython.display"
+THRESHOLD_MS = float(os.getenv("BENCH_IMPORT_THRESHOLD_MS", 50))
+
+
+def cumulative_import_ms(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{PRELOADED}; import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines look like "import time:   self [us] | cumulative | imported package".
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.rsplit("|", 2)
+        if name.strip() == module:
+            return int(cumulative) / 1000
+    raise AssertionError(f"{module} not found in -X importtime output")
+
+
+def test_chatbot_magic_import_time(benchmark):
+    elapsed_ms = benchmark.pedantic(
+        cumulative_import_ms, args=("chatgpt.chatbot_magic",), rounds=5
+    )
+    assert elapsed_ms < THRESHOLD_MS
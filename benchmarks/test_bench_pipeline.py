@@ -0,0 +1,84 @@
+import pytest
+from chatgpt.chatbot import Chatbot
+from chatgpt.database import LocalDatabase
+from chatgpt.tokens import count_tokens
+
+MESSAGES_PER_UPLOAD = 100
+TEXT = "Where does the time go between the prompt and the first token? " * 20
+
+
+@pytest.fixture
+def chatbot(chat_db, fake_openai, unlimited_scheduler):
+    with LocalDatabase(db_file=chat_db) as db:
+        conversation_id = db.get_max_conversation_id() // 2 + 1
+    chatbot = Chatbot(
+        conversation_id=conversation_id,
+        db_path=chat_db,
+        scheduler=unlimited_scheduler,
+    )
+    yield chatbot
+
+    chatbot.close()
+
+
+def test_construct(benchmark, chat_db):
+    def construct():
+        Chatbot(db_path=chat_db).close()
+
+    benchmark(construct)
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["sqlite", "hot"])
+def test_get_context(benchmark, chatbot, cached):
+    database = chatbot.database if cached else chatbot.database.database
+    context = benchmark(database.get_context, chatbot.conversation_id)
+    assert len(context) > 0
+
+
+def test_build_context(benchmark, chatbot):
+    benchmark(chatbot._build_context, 10)
+
+
+@pytest.mark.parametrize("full_text", [False, True], ids=["like", "fts"])
+def test_find_message(benchmark, chatbot, full_text):
+    benchmark(chatbot.find_message, "latency", full_text=full_text, limit=20)
+
+
+def test_list_conversations(benchmark, chatbot):
+    conversations = benchmark(chatbot.list_conversations, limit=20)
+    assert conversations.shape[0] == 20
+
+
+def test_upload_conversation(benchmark, chatbot):
+    conversation = [
+        {
+            "role": "user" if position % 2 == 0 else "assistant",
+            "content": f"Uploaded message {position}: {TEXT}",
+        }
+        for position in range(MESSAGES_PER_UPLOAD)
+    ]
+    benchmark(chatbot.upload_conversation, conversation)
+    chatbot.title_worker.join()
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["cold", "memoised"])
+def test_count_tokens(benchmark, chatbot, cached):
+    chatbot._count_tokens(TEXT)
+
+    def setup():
+        if not cached:
+            count_tokens.cache_clear()
+
+    benchmark.pedantic(chatbot._count_tokens, args=(TEXT,), setup=setup, rounds=100)
+
+
+def test_talk_to_me(benchmark, chatbot):
+    benchmark(chatbot.talk_to_me, "How do I make this faster?")
+
+
+def test_stream_to_me(benchmark, chatbot):
+    def stream():
+        for _ in chatbot.stream_to_me("How do I make this faster?"):
+            pass
+
+    benchmark(stream)
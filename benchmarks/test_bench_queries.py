@@ -0,0 +1,117 @@
+import functools
+import itertools
+import warnings
+import pytest
+from chatgpt.database import LocalDatabase
+from chatgpt.filters import MessageFilter
+
+# Context loads cycle through this many conversations, more than a
+# connection's statement cache holds, as a server with many users would.
+CONVERSATIONS = 512
+
+
+def _get_context_interpolated(db, conversation_id):
+    # The pre-parameterised implementation of LocalDatabase.get_context,
+    # which SQLite has to parse again for every conversation.
+    context = db._query_db(
+        f"""
+            SELECT role, content
+            FROM messages
+            WHERE conversation_id = {conversation_id}
+            ORDER BY conversation_position
+        """,
+        fetch="all",
+    )
+    return [{"role": role, "content": content} for role, content in context]
+
+
+@pytest.fixture
+def sqlite_db(chat_db):
+    # Uncached, so every load reaches SQLite.
+    db = LocalDatabase(db_file=chat_db)
+    yield db
+
+    db.close()
+
+
+@pytest.mark.parametrize("parameterised", [False, True], ids=["f-string", "bound"])
+def test_get_context_repeated(benchmark, sqlite_db, parameterised):
+    conversation_ids = itertools.cycle(range(1, CONVERSATIONS + 1))
+    get_context = (
+        sqlite_db.get_context
+        if parameterised
+        else lambda conversation_id: _get_context_interpolated(
+            sqlite_db, conversation_id
+        )
+    )
+
+    def load():
+        get_context(next(conversation_ids))
+
+    benchmark(load)
+
+
+@pytest.mark.parametrize("structured", [False, True], ids=["predicate_sql", "filter"])
+def test_get_messages_repeated(benchmark, sqlite_db, structured):
+    conversation_ids = itertools.cycle(range(1, CONVERSATIONS + 1))
+
+    def load():
+        conversation_id = next(conversation_ids)
+        if structured:
+            where = MessageFilter(conversation_ids=[conversation_id], roles=["user"])
+        else:
+            where = f"conversation_id = {conversation_id} AND role = 'user'"
+        sqlite_db.get_messages(where, limit=20)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        benchmark(load)
+
+
+def _list_conversations_by_tokens_scanned(db, limit):
+    # The listing before conversations kept their own aggregates, summing
+    # every message of every conversation.
+    return db._query_db(
+        """
+            SELECT conversations.id, COUNT(messages.id), SUM(messages.token_count)
+            FROM conversations
+            LEFT JOIN messages ON messages.conversation_id = conversations.id
+            GROUP BY conversations.id
+            ORDER BY SUM(messages.token_count) DESC
+            LIMIT ?
+        """,
+        (limit,),
+        fetch="all",
+    )
+
+
+@pytest.mark.parametrize("aggregated", [False, True], ids=["scan", "aggregates"])
+def test_list_conversations_by_tokens(benchmark, sqlite_db, aggregated):
+    if aggregated:
+        benchmark(sqlite_db.list_conversations, limit=20, sort="tokens", stats=True)
+    else:
+        benchmark(_list_conversations_by_tokens_scanned, sqlite_db, 20)
+
+
+def _get_next_position_scanned(db, conversation_id):
+    result = db._query_db(
+        """
+            SELECT MAX(conversation_position)
+            FROM messages
+            WHERE conversation_id = ?
+        """,
+        (conversation_id,),
+        fetch="one",
+    )
+    return result[0] + 1 if result[0] is not None else 0
+
+
+@pytest.mark.parametrize("aggregated", [False, True], ids=["scan", "aggregates"])
+def test_get_next_position(benchmark, sqlite_db, aggregated):
+    conversation_ids = itertools.cycle(range(1, CONVERSATIONS + 1))
+    if aggregated:
+        get_next_position = sqlite_db.get_next_position
+    else:
+        get_next_position = functools.partial(_get_next_position_scanned, sqlite_db)
+
+    benchmark(lambda: get_next_position(next(conversation_ids)))
@@ -0,0 +1,34 @@
+import os
+import random
+
+import pytest
+
+MESSAGES = int(os.getenv("BENCH_SEARCH_MESSAGES", 100_000))
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel"]
+
+
+@pytest.fixture
+def search_db(local_db):
+    rng = random.Random(0)
+    local_db.put_conversation(1)
+    local_db.put_messages(
+        (
+            {"role": "user", "content": " ".join(rng.choices(WORDS, k=40))},
+            1,
+            position,
+            40,
+        )
+        for position in range(MESSAGES)
+    )
+    local_db.put_messages([({"role": "user", "content": "needle"}, 1, MESSAGES, 1)])
+    return local_db
+
+
+def test_find_message_like(benchmark, search_db):
+    result = benchmark(search_db.find_message, "needle")
+    assert result.shape[0] == 1
+
+
+def test_find_message_full_text(benchmark, search_db):
+    result = benchmark(search_db.find_message, "needle", full_text=True)
+    assert result.shape[0] == 1
@@ -0,0 +1,72 @@
+import threading
+import pytest
+
+CONCURRENT_WRITERS = 8
+TURNS_PER_WRITER = 10
+
+
+def _save_turn(db, conversation_id):
+    # The writes of Chatbot._save_turn.
+    with db.transaction():
+        db.put_conversation(conversation_id)
+        position = db.get_next_position(conversation_id)
+        db.put_messages(
+            [
+                ({"role": "user", "content": "A prompt"}, conversation_id, position, 3),
+                (
+                    {"role": "assistant", "content": "A reply"},
+                    conversation_id,
+                    position + 1,
+                    3,
+                ),
+            ]
+        )
+        db.update_conversation(conversation_id)
+
+
+def test_get_context(benchmark, storage):
+    context = benchmark(storage.get_context, 1)
+    assert len(context) > 0
+
+
+def test_get_context_window(benchmark, storage):
+    benchmark(storage.get_context_window, 1, 1000, 4)
+
+
+def test_find_message(benchmark, storage):
+    benchmark(storage.find_message, "latency", full_text=True, limit=20)
+
+
+def test_list_conversations(benchmark, storage):
+    conversations = benchmark(storage.list_conversations, limit=20)
+    assert conversations.shape[0] == 20
+
+
+def test_create_conversation(benchmark, storage):
+    benchmark(storage.create_conversation)
+
+
+def test_save_turn(benchmark, storage):
+    conversation_id = storage.create_conversation()
+    benchmark(_save_turn, storage, conversation_id)
+
+
+@pytest.mark.parametrize("writers", [1, CONCURRENT_WRITERS])
+def test_concurrent_turns(benchmark, storage, writers):
+    conversation_ids = [storage.create_conversation() for _ in range(writers)]
+
+    def write(conversation_id):
+        for _ in range(TURNS_PER_WRITER):
+            _save_turn(storage, conversation_id)
+
+    def run():
+        threads = [
+            threading.Thread(target=write, args=(conversation_id,))
+            for conversation_id in conversation_ids
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    benchmark.pedantic(run, rounds=5)
@@ -1,6 +1,5 @@
-from chatgpt.chatbot_magic import load_ipython_extension
-from chatgpt.chatbot import Chatbot
+from chatgpt.chatbot_magic import LazyChatbot, load_ipython_extension
 from IPython import get_ipython
 
-load_ipython_extension(get_ipython())
-chatbot = Chatbot(database="local")
+magics = load_ipython_extension(get_ipython())
+chatbot = LazyChatbot(magics)
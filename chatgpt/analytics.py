@@ -0,0 +1,186 @@
+"""
+Reports over the whole chat history of a StorageBackend.
+
+Every report is aggregated by the database and only the groups come back, one
+row per period, per role and token count, or per conversation size, so
+memory stays bounded however many messages the history holds. The
+statistics are then computed over those groups with NumPy and pandas.
+"""
+import json
+from .database import CONVERSATION_SORTS
+from .filters import MessageFilter
+
+# SQL truncating created_at to the start of its period in UTC, per dialect.
+# Weeks start on Monday, as date_trunc has them.
+PERIODS = {
+    "hour": {
+        "sqlite": "strftime('%Y-%m-%d %H:00:00', created_at)",
+        "postgres": "date_trunc('hour', created_at AT TIME ZONE 'UTC')",
+    },
+    "day": {
+        "sqlite": "date(created_at)",
+        "postgres": "date_trunc('day', created_at AT TIME ZONE 'UTC')",
+    },
+    "week": {
+        "sqlite": "date(created_at, '-6 days', 'weekday 1')",
+        "postgres": "date_trunc('week', created_at AT TIME ZONE 'UTC')",
+    },
+    "month": {
+        "sqlite": "strftime('%Y-%m-01', created_at)",
+        "postgres": "date_trunc('month', created_at AT TIME ZONE 'UTC')",
+    },
+}
+PERCENTILES = (0.5, 0.9, 0.99)
+TOP_CONVERSATIONS = 10
+
+
+def token_usage(database, period="day", where=None):
+    """
+    Count the messages and tokens written in every period.
+
+    :param period: "hour", "day", "week" or "month".
+    :param where:
+        A MessageFilter selecting the messages to count. Messages written
+        before created_at was recorded are left out.
+    :return:
+        A DataFrame indexed by the start of each period, oldest first, with
+        the messages and tokens written in it.
+    """
+    import pandas as pd
+
+    if period not in PERIODS:
+        raise ValueError(
+            f"Unknown period {period!r}. Must be one of {', '.join(PERIODS)}."
+        )
+    bucket = PERIODS[period][database.DIALECT]
+    conditions, params = _compile(database, where)
+    query = f"""
+        SELECT {bucket} AS period, COUNT(*), COALESCE(SUM(token_count), 0)
+        FROM messages
+        WHERE {" AND ".join(["created_at IS NOT NULL", *conditions])}
+        GROUP BY period
+        ORDER BY period
+    """
+    usage = database.read_query(query, params, ["period", "messages", "tokens"])
+    usage["period"] = pd.to_datetime(usage["period"])
+    return usage.set_index("period")
+
+
+def role_tokens(database, percentiles=PERCENTILES, where=None):
+    """
+    Describe the distribution of the token counts of each role's messages.
+
+    The database counts the messages of every (role, token count) pair, and
+    the percentiles are read off their cumulative counts by nearest rank, so
+    they are exact without loading a message.
+
+    :param where: A MessageFilter selecting the messages to describe.
+    :return:
+        A DataFrame indexed by role with the number of messages, their
+        tokens in total, the mean, minimum, maximum and percentiles.
+    """
+    import numpy as np
+    import pandas as pd
+
+    conditions, params = _compile(database, where)
+    query = f"""
+        SELECT role, token_count, COUNT(*)
+        FROM messages
+        WHERE {" AND ".join(["token_count IS NOT NULL", *conditions])}
+        GROUP BY role, token_count
+        ORDER BY role, token_count
+    """
+    counts = database.read_query(query, params, ["role", "token_count", "count"])
+    rows = {}
+    for role, group in counts.groupby("role", sort=True):
+        values = group["token_count"].to_numpy()
+        weights = group["count"].to_numpy()
+        cumulative = np.cumsum(weights)
+        messages = cumulative[-1]
+        ranks = np.ceil(np.asarray(percentiles) * messages).clip(1, messages)
+        quantiles = values[np.searchsorted(cumulative, ranks)]
+        tokens = int(np.dot(values, weights))
+        rows[role] = {
+            "messages": int(messages),
+            "tokens": tokens,
+            "mean": tokens / messages,
+            "min": values[0],
+            "max": values[-1],
+            **{f"p{q * 100:g}": value for q, value in zip(percentiles, quantiles)},
+        }
+    columns = ["messages", "tokens", "mean", "min", "max"]
+    columns += [f"p{q * 100:g}" for q in percentiles]
+    distribution = pd.DataFrame.from_dict(rows, orient="index", columns=columns)
+    return distribution.rename_axis("role")
+
+
+def conversation_lengths(database, bins=10, by="messages"):
+    """
+    Histogram the sizes of conversations, from the aggregates every
+    conversation keeps rather than from its messages.
+
+    :param bins:
+        A number of equal-width bins, or their edges, as np.histogram takes.
+    :param by: "messages", "tokens" or "cost".
+    :return:
+        A DataFrame of the start and end of every bin and the number of
+        conversations in it.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if by == "last_updated" or by not in CONVERSATION_SORTS:
+        raise ValueError(
+            f"Unknown size {by!r}. Must be 'messages', 'tokens' or 'cost'."
+        )
+    column = CONVERSATION_SORTS[by]
+    sizes = database.read_query(
+        f"SELECT {column}, COUNT(*) FROM conversations GROUP BY {column}",
+        (),
+        ["size", "count"],
+    )
+    counts, edges = np.histogram(sizes["size"], bins=bins, weights=sizes["count"])
+    return pd.DataFrame(
+        {"start": edges[:-1], "end": edges[1:], "conversations": counts.astype(int)}
+    )
+
+
+def top_conversations(database, n=TOP_CONVERSATIONS, by="tokens"):
+    """
+    :param by: "tokens", "messages" or "cost".
+    :return: The n biggest conversations, with their aggregates.
+    """
+    return database.list_conversations(limit=n, sort=by, stats=True)
+
+
+def report(database, period="day", top=TOP_CONVERSATIONS):
+    """
+    Run every report.
+
+    :return: A dictionary of DataFrames, by report name.
+    """
+    return {
+        "token_usage": token_usage(database, period),
+        "role_tokens": role_tokens(database),
+        "conversation_lengths": conversation_lengths(database),
+        "top_conversations": top_conversations(database, top),
+    }
+
+
+def report_json(reports):
+    """
+    Convert the DataFrames of report to lists of records that json.dumps
+    takes, with dates in ISO 8601 and missing values as None.
+    """
+    return {
+        name: json.loads(
+            frame.reset_index(drop=frame.index.name is None).to_json(
+                orient="records", date_format="iso"
+            )
+        )
+        for name, frame in reports.items()
+    }
+
+
+def _compile(database, where):
+    return (where or MessageFilter()).compile(database.DIALECT)
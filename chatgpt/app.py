@@ -1,10 +1,26 @@
 from flask import Flask, Response, render_template, request
 import json
-from .chatbot import Chatbot
+import os
+from .analytics import TOP_CONVERSATIONS, report, report_json
+from .chatbot import Chatbot, HOME
+from .metrics import metrics
+from .storage import open_database
+from .titles import TitleWorker
 
 app = Flask(__name__)
 
-chatbot = Chatbot()
+# "local", or a postgresql:// URL to share the history between hosts.
+database = open_database(
+    os.getenv("CHATGPT_DATABASE", "local"), f"{HOME}/.chatgpt/chat.db"
+)
+title_worker = TitleWorker(database, resume_pending=True)
+
+
+def sse(data, event=None):
+    payload = f"data: {json.dumps(data)}\n\n"
+    if event is not None:
+        payload = f"event: {event}\n{payload}"
+    return payload
 
 
 @app.route("/")
@@ -12,22 +28,48 @@ def index():
     return render_template("index.html")
 
 
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/report")
+def analytics_report():
+    try:
+        reports = report(
+            database,
+            period=request.args.get("period", "day"),
+            top=request.args.get("top", TOP_CONVERSATIONS, type=int),
+        )
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return report_json(reports)
+
+
 @app.route("/api/chat", methods=["POST"])
 def chat():
-    print(request.json)
     prompt = request.json["prompt"]
-    context = chatbot.database._get_context(chatbot.conversation_id)
+    chatbot = Chatbot(
+        conversation_id=request.json.get("conversation_id"),
+        database=database,
+        title_worker=title_worker,
+    )
 
     def generate_response():
-        for new_message in chatbot._submit_prompt_for_streaming(
-            prompt, context, display=False
-        ):
-            yield json.dumps({"response": new_message})
+        yield sse({"conversation_id": chatbot.conversation_id}, "conversation")
+        try:
+            for new_message in chatbot.stream_to_me(prompt):
+                yield sse({"response": new_message})
+        except Exception as e:
+            # The reply was not saved; tell the client rather than leave the
+            # stream hanging.
+            print(f"Error: {e}")
+            yield sse({"error": str(e)}, "error")
 
     return Response(
         generate_response(),
-        mimetype="text/json",
-        headers={"Transfer-Encoding": "chunked"},
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
 
 
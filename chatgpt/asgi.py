@@ -0,0 +1,192 @@
+"""
+An ASGI application serving the chat UI and a Server-Sent Events chat API.
+
+Run it with any ASGI server, for example::
+
+    uvicorn chatgpt.asgi:app --workers 4
+
+Every request to ``POST /api/chat`` names the conversation it belongs to
+with a ``conversation_id``; requests without one start a new conversation
+whose id is sent back as the first event of the stream.
+"""
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from .async_chatbot import AsyncChatbot
+from .chatbot import HOME
+from .metrics import metrics
+from .storage import open_database
+from .titles import TitleWorker
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+
+class ChatApplication:
+    def __init__(
+        self,
+        db_path=None,
+        max_concurrency=64,
+        max_sessions=1024,
+        database=None,
+        scheduler=None,
+    ):
+        """
+        :param database:
+            "local" for the SQLite file at db_path, a postgresql:// URL or a
+            StorageBackend. Defaults to the CHATGPT_DATABASE variable, or
+            "local".
+        :param scheduler:
+            The RequestScheduler of every session's completions. Defaults to
+            the process-wide one, whose limits are read from the environment;
+            see RequestScheduler.from_env.
+        """
+        if db_path is None:
+            os.makedirs(f"{HOME}/.chatgpt", exist_ok=True)
+            db_path = f"{HOME}/.chatgpt/chat.db"
+        if database is None:
+            database = os.getenv("CHATGPT_DATABASE", "local")
+        self.database = open_database(database, db_path)
+        self.title_worker = TitleWorker(self.database, resume_pending=True)
+        self.scheduler = scheduler
+        self.max_sessions = max_sessions
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.sessions = OrderedDict()
+        self._session_lock = asyncio.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["path"] == "/" and scope["method"] == "GET":
+                await self._index(send)
+            elif scope["path"] == "/metrics" and scope["method"] == "GET":
+                await self._respond(
+                    send,
+                    200,
+                    metrics.prometheus().encode("utf-8"),
+                    b"text/plain; version=0.0.4",
+                )
+            elif scope["path"] == "/api/chat" and scope["method"] == "POST":
+                await self._chat(receive, send)
+            else:
+                await self._respond(send, 404, b"Not Found")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.to_thread(self.database.create_tables)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.to_thread(self.title_worker.close)
+                self.database.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _index(self, send):
+        with open(os.path.join(TEMPLATE_DIR, "index.html"), "rb") as f:
+            body = f.read()
+        await self._respond(send, 200, body, b"text/html; charset=utf-8")
+
+    async def _chat(self, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+        request = json.loads(body)
+        chatbot, lock = await self._get_session(request.get("conversation_id"))
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            }
+        )
+        stream = asyncio.create_task(
+            self._stream_reply(chatbot, lock, request["prompt"], send)
+        )
+        disconnect = asyncio.create_task(self._wait_for_disconnect(receive))
+        done, pending = await asyncio.wait(
+            {stream, disconnect}, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if stream in done:
+            stream.result()
+
+    async def _stream_reply(self, chatbot, lock, prompt, send):
+        # Turns of one conversation are serialised; different conversations
+        # stream concurrently. Each send waits for the server to accept the
+        # event, so a slow client slows down its own upstream read.
+        try:
+            async with lock:
+                await self._send_event(
+                    send, {"conversation_id": chatbot.conversation_id}, "conversation"
+                )
+                async for content in chatbot.astream_to_me(prompt):
+                    await self._send_event(send, {"response": content})
+        except Exception as e:
+            # The reply was not saved; tell the client rather than leave the
+            # stream hanging.
+            print(f"Error: {e}")
+            await self._send_event(send, {"error": str(e)}, "error")
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _get_session(self, conversation_id):
+        async with self._session_lock:
+            if conversation_id in self.sessions:
+                self.sessions.move_to_end(conversation_id)
+                return self.sessions[conversation_id]
+            chatbot = await asyncio.to_thread(
+                AsyncChatbot,
+                conversation_id=conversation_id,
+                database=self.database,
+                semaphore=self.semaphore,
+                scheduler=self.scheduler,
+                title_worker=self.title_worker,
+            )
+            session = (chatbot, asyncio.Lock())
+            self.sessions[chatbot.conversation_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    async def _wait_for_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    async def _send_event(self, send, data, event=None):
+        payload = f"data: {json.dumps(data)}\n\n"
+        if event is not None:
+            payload = f"event: {event}\n{payload}"
+        await send(
+            {
+                "type": "http.response.body",
+                "body": payload.encode("utf-8"),
+                "more_body": True,
+            }
+        )
+
+    async def _respond(self, send, status, body, content_type=b"text/plain"):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", content_type)],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+app = ChatApplication()
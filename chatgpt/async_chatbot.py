@@ -0,0 +1,207 @@
+import asyncio
+import openai
+from .chatbot import Chatbot
+from .metrics import TurnMetrics, stage_timer
+from .scheduler import PRIORITY_USER
+from .streaming import StreamBuffer
+
+
+class AsyncChatbot(Chatbot):
+    """
+    A Chatbot whose turns can run concurrently on one event loop.
+
+    Completions go through openai's aiohttp-based client and database work
+    runs in worker threads, so a conversation waiting on the API never blocks
+    the others. Pass the same semaphore to several bots to bound the number
+    of completions in flight across all of them.
+
+    Cancelling a turn while its completion is in flight leaves the database
+    untouched; the prompt and reply are only written once both exist.
+    """
+
+    def __init__(self, *args, semaphore=None, max_concurrency=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(max_concurrency)
+        self.semaphore = semaphore
+
+    async def atalk_to_me(self, prompt, context=None):
+        turn = TurnMetrics(self.engine)
+        prompt_token_count = await asyncio.to_thread(self._count_tokens, prompt)
+        prompt_tokens = None
+        if context is None:
+            with turn.time("context"):
+                context, prompt_tokens = await asyncio.to_thread(
+                    self._build_context, prompt_token_count
+                )
+        if self.system is not None:
+            context = [{"role": "system", "content": self.system}] + context
+        new_message = await self._asubmit_prompt(
+            prompt, context, turn=turn, prompt_tokens=prompt_tokens
+        )
+        with turn.time("save"):
+            completion_tokens = await asyncio.to_thread(
+                self._save_turn, context[-1], new_message, prompt_token_count
+            )
+        await asyncio.to_thread(
+            self._record_turn, turn, context, prompt_tokens, completion_tokens
+        )
+
+        if self.title is None:
+            await asyncio.to_thread(self._queue_title)
+        return new_message
+
+    async def astream_to_me(self, prompt, context=None, flush="token"):
+        """
+        Like atalk_to_me, but yield the reply as it streams in.
+
+        The prompt and the full reply are saved once the stream finishes; a
+        stream that is closed or cancelled early is not saved.
+        """
+        turn = TurnMetrics(self.engine)
+        prompt_token_count = await asyncio.to_thread(self._count_tokens, prompt)
+        prompt_tokens = None
+        if context is None:
+            with turn.time("context"):
+                context, prompt_tokens = await asyncio.to_thread(
+                    self._build_context, prompt_token_count
+                )
+        if self.system is not None:
+            context = [{"role": "system", "content": self.system}] + context
+        parts = []
+        async for content in self._asubmit_prompt_for_streaming(
+            prompt, context, flush=flush, turn=turn, prompt_tokens=prompt_tokens
+        ):
+            parts.append(content)
+            yield content
+        new_message = {"role": "assistant", "content": "".join(parts)}
+        with turn.time("save"):
+            completion_tokens = await asyncio.to_thread(
+                self._save_turn, context[-1], new_message, prompt_token_count
+            )
+        await asyncio.to_thread(
+            self._record_turn, turn, context, prompt_tokens, completion_tokens
+        )
+
+        if self.title is None:
+            await asyncio.to_thread(self._queue_title)
+
+    async def aupdate_conversation_title(self, title=None):
+        if title is not None:
+            self.title = title
+            await asyncio.to_thread(
+                self.database.update_conversation_title, self.conversation_id, title
+            )
+            return
+        self.title = await asyncio.to_thread(self._get_title, self.conversation_id)
+        if self.title is None:
+            await asyncio.to_thread(self._queue_title)
+
+    async def _asubmit_prompt(
+        self,
+        prompt,
+        context,
+        engine=None,
+        temperature=None,
+        max_tokens=None,
+        n=1,
+        display=False,
+        use_cache=True,
+        priority=PRIORITY_USER,
+        turn=None,
+        prompt_tokens=None,
+    ):
+        if engine is None:
+            engine = self.engine
+        if temperature is None:
+            temperature = self.temperature
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+
+        context.append({"role": "user", "content": prompt})
+        request = dict(
+            model=engine,
+            messages=context,
+            temperature=temperature,
+            stream=False,
+            max_tokens=max_tokens,
+            n=n,
+        )
+        cacheable, response = await asyncio.to_thread(
+            self._from_cache, request, use_cache, turn
+        )
+        if response is not None:
+            return self._get_content(response, display=display)
+        if prompt_tokens is None:
+            prompt_tokens = await asyncio.to_thread(self._count_prompt_tokens, context)
+        tokens = self._estimate_tokens(request, prompt_tokens)
+        async with self.semaphore:
+            with stage_timer("completion", turn):
+                response = await self.scheduler.asubmit(
+                    lambda: openai.ChatCompletion.acreate(**request),
+                    tokens=tokens,
+                    priority=priority,
+                )
+        self._reconcile_tokens(tokens, response.get("usage"))
+        if cacheable:
+            await asyncio.to_thread(self.cache.put, request, response)
+        if turn is not None:
+            turn.record_usage(response.get("usage"))
+        content = self._get_content(response, display=display)
+        return content
+
+    async def _asubmit_prompt_for_streaming(
+        self,
+        prompt,
+        context,
+        engine=None,
+        temperature=None,
+        max_tokens=None,
+        n=1,
+        flush="token",
+        turn=None,
+        prompt_tokens=None,
+    ):
+        """
+        Yield the reply to a prompt as the API streams it, buffered according
+        to the flush policy of StreamBuffer.
+
+        The concurrency slot is held until the stream is exhausted or closed.
+        """
+        if engine is None:
+            engine = self.engine
+        if temperature is None:
+            temperature = self.temperature
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+
+        context.append({"role": "user", "content": prompt})
+        buffer = StreamBuffer(flush)
+        request = dict(
+            model=engine,
+            messages=context,
+            temperature=temperature,
+            stream=True,
+            max_tokens=max_tokens,
+            n=n,
+        )
+        if prompt_tokens is None:
+            prompt_tokens = await asyncio.to_thread(self._count_prompt_tokens, context)
+        tokens = self._estimate_tokens(request, prompt_tokens)
+        async with self.semaphore:
+            with stage_timer("completion", turn):
+                response = await self.scheduler.asubmit(
+                    lambda: openai.ChatCompletion.acreate(**request),
+                    tokens=tokens,
+                )
+                async for chunk in response:
+                    delta = chunk["choices"][0]["delta"]
+                    if "content" in delta.keys():
+                        message = buffer.add(delta["content"])
+                        if message:
+                            if turn is not None:
+                                turn.mark_first_token()
+                            yield message
+        message = buffer.flush()
+        if message:
+            yield message
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import time
+from .database import ConnectionManager
+
+
+class CompletionCache:
+    """
+    A SQLite-backed cache of completions for deterministic requests.
+
+    Requests are keyed on a hash of their normalised model, messages,
+    temperature, max_tokens and n. Entries expire after ttl seconds, and the
+    least recently used ones are evicted beyond max_entries.
+    """
+
+    def __init__(self, db_file, ttl=None, max_entries=10000):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connections = ConnectionManager(db_file)
+        self._query_db(
+            """
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                created REAL,
+                last_used REAL
+            )
+        """
+        )
+        self._query_db(
+            """
+            CREATE INDEX IF NOT EXISTS completions_last_used
+            ON completions (last_used)
+        """
+        )
+
+    def close(self):
+        self.connections.close()
+
+    @staticmethod
+    def is_cacheable(request):
+        """
+        Only non-streamed requests at temperature 0 are deterministic enough
+        to replay.
+        """
+        return not request.get("stream", False) and request.get("temperature") == 0
+
+    @staticmethod
+    def key(request):
+        normalised = {
+            "model": request["model"],
+            "messages": [
+                {"role": message["role"], "content": message["content"]}
+                for message in request["messages"]
+            ],
+            "temperature": request.get("temperature"),
+            "max_tokens": request.get("max_tokens"),
+            "n": request.get("n", 1),
+        }
+        payload = json.dumps(normalised, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, request):
+        key = self.key(request)
+        now = time.time()
+        result = self._query_db(
+            "SELECT response, created FROM completions WHERE key = ?",
+            (key,),
+            fetch="one",
+        )
+        if result is None or (self.ttl is not None and now - result[1] > self.ttl):
+            self.misses += 1
+            return None
+        self._query_db("UPDATE completions SET last_used = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(result[0])
+
+    def put(self, request, response):
+        now = time.time()
+        self._query_db(
+            """
+            INSERT OR REPLACE INTO completions (key, response, created, last_used)
+            VALUES (?, ?, ?, ?)
+        """,
+            (self.key(request), json.dumps(response), now, now),
+        )
+        self._query_db(
+            """
+            DELETE FROM completions
+            WHERE key NOT IN (
+                SELECT key
+                FROM completions
+                ORDER BY last_used DESC
+                LIMIT ?
+            )
+        """,
+            (self.max_entries,),
+        )
+
+    def _query_db(self, query, params=None, fetch=None):
+        cur = self.connections.get().cursor()
+        cur.execute(query, params or ())
+        data = cur.fetchone() if fetch == "one" else None
+        cur.close()
+        return data
@@ -1,20 +1,52 @@
-import openai
 import os
-from .database import LocalDatabase
-from IPython.display import display, Markdown
-import tiktoken
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .cache import CompletionCache
+from .filters import MessageFilter
+from .metrics import TurnMetrics, metrics, stage_timer, summarize_turns
+from .scheduler import (
+    EXPECTED_COMPLETION_TOKENS,
+    PRIORITY_BACKGROUND,
+    PRIORITY_USER,
+    default_scheduler,
+)
+from .storage import open_database
+from .streaming import StreamBuffer
+from .titles import TitleWorker, batch_title_prompt, heuristic_title, parse_titles
+from .tokens import (
+    MESSAGE_OVERHEAD,
+    REPLY_OVERHEAD,
+    count_tokens,
+    count_tokens_batch,
+    get_context_window,
+)
 
 HOME = os.getenv("HOME")
 
+# How often, in seconds, a process sweeps abandoned conversations.
+GARBAGE_COLLECTION_INTERVAL = 3600
+# How old, in seconds, an empty conversation must be before it counts as
+# abandoned, so that other sessions' fresh conversations survive a sweep.
+ABANDONED_CONVERSATION_AGE = 3600
+
+# Share of the context budget freed up whenever the summary is extended, so
+# that the next few turns fit without another summarisation round trip.
+SUMMARY_HEADROOM = 0.25
+
 
 class Chatbot:
+    _last_garbage_collection = None
+
     def __init__(
         self,
         conversation_id: int = None,
-        database: str = "local",
+        database="local",
         db_path: str = None,
         max_tokens: int = 3200,
         system=None,
+        cache=False,
+        scheduler=None,
+        title_worker=None,
     ):
         if db_path is None:
             self.db_path = f"{HOME}/.chatgpt/chat.db"
@@ -25,35 +57,89 @@ class Chatbot:
         self.engine = "gpt-3.5-turbo"
         self.temperature = 0.8
         self.max_tokens = max_tokens
+        self.summary_tokens = 256
         self.system = system
 
-        if database == "local":
-            self.database = LocalDatabase(db_file=self.db_path)
-        self.database._create_tables()
-        current_conversations = self.list_conversations()
-        empty_conversations = current_conversations[
-            current_conversations["title"].isnull()
-        ]
-        self.delete_conversation(empty_conversations["id"].tolist())
+        if cache is True:
+            cache = CompletionCache(
+                os.path.join(os.path.dirname(self.db_path), "completion_cache.db")
+            )
+        self.cache = cache or None
+        # Bots share one scheduler per process unless given their own, so the
+        # rate limits are enforced across all of them.
+        self.scheduler = default_scheduler if scheduler is None else scheduler
+        # Pass a TitleWorker to share one background thread between bots;
+        # otherwise each bot starts its own on first use.
+        self.title_worker = title_worker
+        self._owns_title_worker = False
+
+        # A backend passed in may be shared with other sessions, so only one
+        # opened here is closed with the bot.
+        self._owns_database = isinstance(database, str)
+        self.database = open_database(database, self.db_path)
+        self.database.create_tables()
 
         if conversation_id is None:
-            max_id = self.database._get_max_conversation_id()
-            self.conversation_id = max_id + 1
-            self.database._put_conversation(self.conversation_id)
+            self.conversation_id = self.database.create_conversation()
             self.title = None
         else:
             self.conversation_id = conversation_id
-            conversation_attributes = self.database._get_conversation_attributes(
+            conversation_attributes = self.database.get_conversation_attributes(
                 conversation_id
             )
             if conversation_attributes is None:
                 self.title = None
-                self.database._put_conversation(self.conversation_id)
+                self.database.put_conversation(self.conversation_id)
             else:
                 self.title = conversation_attributes.get("title", None)
 
+        import openai
+
         openai.api_key = os.getenv("OPENAI_API_KEY")
 
+    def close(self):
+        if self._owns_title_worker:
+            self.title_worker.close()
+        if self._owns_database:
+            self.database.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def collect_garbage(self, min_age=ABANDONED_CONVERSATION_AGE):
+        """
+        Delete conversations that were started but never used.
+
+        :param min_age:
+            Seconds since a conversation was last updated before it may be
+            deleted, so that other sessions' fresh conversations survive.
+        :return: The number of conversations deleted.
+        """
+        Chatbot._last_garbage_collection = time.monotonic()
+        return self.database.delete_empty_conversations(
+            exclude=[self.conversation_id], min_age=min_age
+        )
+
+    def choose_candidate(self, candidate_id):
+        """
+        Save a candidate from fan_out as the reply to its prompt.
+        """
+        candidate = self.database.get_candidate(candidate_id)
+        if candidate is None or candidate["conversation_id"] != self.conversation_id:
+            raise ValueError(
+                f"Candidate {candidate_id} does not belong to this conversation."
+            )
+        prompt_message = {"role": "user", "content": candidate["prompt"]}
+        new_message = {"role": "assistant", "content": candidate["content"]}
+        with self.database.transaction():
+            self._save_turn(
+                prompt_message, new_message, self._count_tokens(candidate["prompt"])
+            )
+            self.database.choose_candidate(candidate_id)
+
+        if self.title is None:
+            self._queue_title()
+        return new_message
+
     def delete_message(self, message_id):
         self.database.delete_message(message_id)
 
@@ -64,19 +150,121 @@ class Chatbot:
         else:
             self.database.delete_conversation(conversation_id)
 
-    def get_messages(self):
-        return self.database.get_messages(f"conversation_id = {self.conversation_id}")
+    def fan_out(self, prompt, engines=None, n=1, context=None):
+        """
+        Ask several models, or one model for several candidates, to reply to
+        the same prompt concurrently, and yield the candidates as each
+        request finishes.
+
+        Every candidate is stored for comparison, but none is saved to the
+        conversation until it is passed to choose_candidate.
+
+        :param engines: The models to ask, defaulting to self.engine.
+        :param n: The number of candidates to ask each model for.
+        :return:
+            A generator of dictionaries with the candidate's id, engine,
+            choice_index, content, latency_seconds, prompt_tokens and
+            completion_tokens.
+        """
+        if engines is None:
+            engines = [self.engine]
+        prompt_token_count = self._count_tokens(prompt)
+        prompt_tokens = None
+        if context is None:
+            context, prompt_tokens = self._build_context(prompt_token_count)
+        if self.system is not None:
+            context = [{"role": "system", "content": self.system}] + context
+        position = self.database.get_next_position(self.conversation_id)
+
+        with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+            futures = [
+                executor.submit(
+                    self._submit_candidates,
+                    prompt,
+                    list(context),
+                    engine,
+                    n,
+                    prompt_tokens,
+                )
+                for engine in engines
+            ]
+            for future in as_completed(futures):
+                for candidate in future.result():
+                    candidate.update(
+                        conversation_id=self.conversation_id,
+                        conversation_position=position,
+                        prompt=prompt,
+                    )
+                    candidate["id"] = self.database.put_candidate(candidate)
+                    yield candidate
+
+    def get_candidates(self, conversation_id=None):
+        """
+        Get the stored candidates of this conversation, or of another one.
+        """
+        if conversation_id is None:
+            conversation_id = self.conversation_id
+        return self.database.get_candidates(conversation_id)
+
+    def get_messages(self, limit=None, after_id=None, **criteria):
+        """
+        Get this conversation's messages, optionally narrowed down further.
+
+        :param criteria: Any other MessageFilter criteria, e.g. roles=["user"].
+        """
+        return self.database.get_messages(
+            MessageFilter(conversation_ids=[self.conversation_id], **criteria),
+            limit=limit,
+            after_id=after_id,
+        )
+
+    def find_message(self, search_string, full_text=False, limit=None, offset=0):
+        return self.database.find_message(
+            search_string, full_text=full_text, limit=limit, offset=offset
+        )
+
+    def list_conversations(
+        self, limit=None, offset=0, sort="last_updated", stats=False
+    ):
+        """
+        :param sort: "last_updated", "tokens", "messages" or "cost".
+        :param stats:
+            Add each conversation's message and token counts, last position
+            and estimated cost in US dollars.
+        """
+        return self.database.list_conversations(
+            limit=limit, offset=offset, sort=sort, stats=stats
+        )
+
+    def get_stats(self, conversation_id=None):
+        """
+        Summarise the cost and latency of every conversation's turns, or of
+        one conversation's.
+        """
+        return summarize_turns(self.database.get_turn_metrics(conversation_id))
+
+    def get_report(self, period="day", top=10):
+        """
+        Report on the whole history: token usage per period, the token
+        distribution of each role, conversation sizes and the top conversations
+        by tokens. See chatgpt.analytics.
 
-    def find_message(self, search_string):
-        return self.database.find_message(search_string)
+        :param period: "hour", "day", "week" or "month".
+        :return: A dictionary of DataFrames, by report name.
+        """
+        from .analytics import report
 
-    def list_conversations(self):
-        return self.database.list_conversations()
+        return report(self.database, period=period, top=top)
 
     def print_context(self, markdown=True):
-        context = self.database._get_context(self.conversation_id)
+        from IPython.display import display, Markdown
+
+        context = self.database.get_context(self.conversation_id)
         if len(context) > 0 and self.title is None:
-            self.update_conversation_title()
+            self._queue_title()
+        else:
+            # Pick up a generated title that has landed since.
+            self.title = self._get_title(self.conversation_id)
         if markdown:
             output = f"# {self.title}\n\n"
         else:
@@ -92,92 +280,337 @@ class Chatbot:
                 print(message["role"].upper(), message["content"], sep="\n", end="\n\n")
 
     def talk_to_me(self, prompt, context=None):
+        turn = TurnMetrics(self.engine)
+        prompt_token_count = self._count_tokens(prompt)
+        prompt_tokens = None
         if context is None:
-            context = self.database._get_context(self.conversation_id)
+            with turn.time("context"):
+                context, prompt_tokens = self._build_context(prompt_token_count)
         if self.system is not None:
             context = [{"role": "system", "content": self.system}] + context
-        new_message = self._submit_prompt(prompt, context)
-        prompt_token_count = self._count_tokens(prompt)
-        new_message_token_count = self._count_tokens(new_message["content"])
-        self.database._put_message(
-            context[-1], self.conversation_id, len(context) - 1, prompt_token_count
-        )
-        self.database._put_message(
-            new_message, self.conversation_id, len(context), new_message_token_count
+        new_message = self._submit_prompt(
+            prompt, context, turn=turn, prompt_tokens=prompt_tokens
         )
+        with turn.time("save"):
+            completion_tokens = self._save_turn(
+                context[-1], new_message, prompt_token_count
+            )
+        self._record_turn(turn, context, prompt_tokens, completion_tokens)
+
+        if self.title is None:
+            self._queue_title()
+
+    def stream_to_me(self, prompt, context=None, flush="token"):
+        """
+        Like talk_to_me, but yield the reply as it streams in.
+
+        The prompt and the full reply are saved once the stream finishes; a
+        stream that is closed early is not saved.
+
+        :param flush:
+            When to yield buffered content: "token", "line", or a number of
+            milliseconds between yields.
+        """
+        turn = TurnMetrics(self.engine)
+        prompt_token_count = self._count_tokens(prompt)
+        prompt_tokens = None
+        if context is None:
+            with turn.time("context"):
+                context, prompt_tokens = self._build_context(prompt_token_count)
+        if self.system is not None:
+            context = [{"role": "system", "content": self.system}] + context
+        parts = []
+        for content in self._submit_prompt_for_streaming(
+            prompt,
+            context,
+            display=False,
+            flush=flush,
+            turn=turn,
+            prompt_tokens=prompt_tokens,
+        ):
+            parts.append(content)
+            yield content
+        new_message = {"role": "assistant", "content": "".join(parts)}
+        with turn.time("save"):
+            completion_tokens = self._save_turn(
+                context[-1], new_message, prompt_token_count
+            )
+        self._record_turn(turn, context, prompt_tokens, completion_tokens)
 
         if self.title is None:
-            self.update_conversation_title()
-        self.database._update_conversation(self.conversation_id)
+            self._queue_title()
 
     def update_conversation_title(self, title=None):
-        context = self.database._get_context(self.conversation_id)
-        if title is None:
-            title = self._get_title(self.conversation_id)
-        if title is None:
-            self.title = self._generate_title(context[:1])
-        else:
+        """
+        Set the conversation's title, or keep the one it has. A conversation
+        without one gets a placeholder while a title is generated in the
+        background.
+        """
+        if title is not None:
             self.title = title
-        self.database.update_conversation_title(self.conversation_id, self.title)
+            self.database.update_conversation_title(self.conversation_id, title)
+            return
+        self.title = self._get_title(self.conversation_id)
+        if self.title is None:
+            self._queue_title()
 
     def upload_conversation(self, conversation_list):
         """
         Upload a conversation to the database.
 
         :param conversation_list:
-            A list of dictionaries with schema {role: str, content: str}.
+            A list of dictionaries with schema {role: str, content: str}, and
+            optionally token_count: int to skip re-encoding the content.
         """
-        max_id = self.database._get_max_conversation_id()
-        new_conversation_id = max_id + 1
-        self.database._put_conversation(new_conversation_id)
-        self.conversation_id = new_conversation_id
-
-        for index, message in enumerate(conversation_list):
-            role = message["role"]
-            content = message["content"]
-
-            if role not in ["user", "assistant"]:
+        for message in conversation_list:
+            if message["role"] not in ["user", "assistant"]:
                 raise ValueError(
                     "Invalid role in the conversation list. "
                     "Must be 'user' or 'assistant'."
                 )
 
-            token_count = self._count_tokens(content)
+        uncounted = [
+            message["content"]
+            for message in conversation_list
+            if message.get("token_count") is None
+        ]
+        counted = iter(self._count_tokens_batch(uncounted))
+        rows = []
+        for index, message in enumerate(conversation_list):
+            token_count = message.get("token_count")
+            if token_count is None:
+                token_count = next(counted)
+            rows.append(
+                (
+                    {"role": message["role"], "content": message["content"]},
+                    index,
+                    token_count,
+                )
+            )
 
-            self.database._put_message(
-                {"role": role, "content": content},
-                new_conversation_id,
-                index,
-                token_count,
+        with self.database.transaction():
+            new_conversation_id = self.database.create_conversation()
+            self.database.put_messages(
+                (message, new_conversation_id, index, token_count)
+                for message, index, token_count in rows
             )
+            self.database.update_conversation(new_conversation_id)
 
         self.conversation_id = new_conversation_id
-        self.update_conversation_title()
-        self.database._update_conversation(self.conversation_id)
+        self.title = None
+        self._queue_title()
 
         return new_conversation_id
 
+    def _build_context(self, prompt_token_count):
+        """
+        Select the newest stored messages that fit in the model's context
+        window next to the system prompt, the new prompt and the tokens
+        reserved for the completion (max_tokens).
+
+        Older messages are represented by a stored rolling summary, which is
+        only extended, never regenerated, when more history overflows.
+
+        :return:
+            The context, and the prompt tokens of the request it makes with
+            the system prompt and the new prompt, from the stored token counts.
+        """
+        prompt_tokens = prompt_token_count + MESSAGE_OVERHEAD + REPLY_OVERHEAD
+        if self.system is not None:
+            prompt_tokens += self._count_tokens(self.system) + MESSAGE_OVERHEAD
+        budget = get_context_window(self.engine) - self.max_tokens - prompt_tokens
+
+        summary = self.database.get_summary(self.conversation_id)
+        covered = -1 if summary is None else summary["last_position"]
+        if summary is not None:
+            budget -= summary["token_count"] + MESSAGE_OVERHEAD
+        context, first_position, token_count = self.database.get_context_window(
+            self.conversation_id, budget, MESSAGE_OVERHEAD, covered
+        )
+
+        if first_position > covered + 1:
+            if summary is not None:
+                budget += summary["token_count"] + MESSAGE_OVERHEAD
+            budget -= self.summary_tokens + MESSAGE_OVERHEAD
+            context, first_position, token_count = self.database.get_context_window(
+                self.conversation_id,
+                int(budget * (1 - SUMMARY_HEADROOM)),
+                MESSAGE_OVERHEAD,
+                covered,
+            )
+            overflow = self.database.get_context_range(
+                self.conversation_id, covered + 1, first_position - 1
+            )
+            if overflow:
+                content = self._generate_summary(
+                    overflow, None if summary is None else summary["content"]
+                )
+                summary = {
+                    "first_position": 0
+                    if summary is None
+                    else summary["first_position"],
+                    "last_position": first_position - 1,
+                    "content": content,
+                    "token_count": self._count_tokens(content),
+                }
+                self.database.put_summary(self.conversation_id, **summary)
+
+        prompt_tokens += token_count
+        if summary is not None:
+            context.insert(0, {"role": "assistant", "content": summary["content"]})
+            prompt_tokens += summary["token_count"] + MESSAGE_OVERHEAD
+        return context, prompt_tokens
+
     def _count_tokens(self, text: str) -> int:
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
         try:
-            tokens = list(encoding.encode(text))
-            return len(tokens)
+            with metrics.timer("count_tokens"):
+                return count_tokens(text, self.engine)
         except Exception as e:
             print(f"Error: {e}")
             return 0
 
-    def _generate_summary(self, context):
+    def _count_tokens_batch(self, texts):
+        try:
+            with metrics.timer("count_tokens"):
+                return count_tokens_batch(texts, self.engine)
+        except Exception as e:
+            print(f"Error: {e}")
+            return [0] * len(texts)
+
+    def _create_completion(
+        self,
+        use_cache=True,
+        priority=PRIORITY_USER,
+        turn=None,
+        prompt_tokens=None,
+        **request,
+    ):
+        """
+        Call the completion API, answering deterministic requests from the
+        completion cache when one is configured and use_cache is set.
+
+        Calls that reach the API are admitted by the scheduler, which also
+        retries them on rate limit and transient errors.
+
+        :param turn: The TurnMetrics recording cache hits and token usage.
+        :param prompt_tokens:
+            The prompt tokens of the request if already known, so that the
+            scheduler's estimate need not count them.
+        """
+        import openai
+
+        cacheable, response = self._from_cache(request, use_cache, turn)
+        if response is not None:
+            return response
+        tokens = self._estimate_tokens(request, prompt_tokens)
+        response = self.scheduler.submit(
+            lambda: openai.ChatCompletion.create(**request),
+            tokens=tokens,
+            priority=priority,
+        )
+        if not request.get("stream", False):
+            self._reconcile_tokens(tokens, response.get("usage"))
+        if cacheable:
+            self.cache.put(request, response)
+        if turn is not None and not request.get("stream", False):
+            turn.record_usage(response.get("usage"))
+        return response
+
+    def _from_cache(self, request, use_cache=True, turn=None):
+        """
+        Look a deterministic request up in the completion cache, when one is
+        configured and use_cache is set, counting the hit or miss.
+
+        :return:
+            Whether the response belongs in the cache, and the cached response
+            or None.
+        """
+        if not (
+            self.cache is not None
+            and use_cache
+            and CompletionCache.is_cacheable(request)
+        ):
+            return False, None
+        response = self.cache.get(request)
+        if response is None:
+            metrics.increment("cache_misses")
+            return True, None
+        metrics.increment("cache_hits")
+        if turn is not None:
+            turn.cache_hit = True
+            turn.record_usage({"prompt_tokens": 0, "completion_tokens": 0})
+        return True, response
+
+    def _estimate_tokens(self, request, prompt_tokens=None):
+        """
+        Tokens a request is charged against the tokens-per-minute limit up
+        front: its prompt plus the completion tokens it is expected to
+        generate, rather than all max_tokens it may. The messages are only
+        counted when prompt_tokens isn't given.
+        """
+        if prompt_tokens is None:
+            prompt_tokens = self._count_prompt_tokens(request["messages"])
+        completion_tokens = min(request["max_tokens"], EXPECTED_COMPLETION_TOKENS)
+        return prompt_tokens + completion_tokens * request["n"]
+
+    def _count_prompt_tokens(self, messages):
+        """
+        Count the prompt tokens of a request by encoding its messages.
+        """
+        return (
+            sum(
+                self._count_tokens(message["content"]) + MESSAGE_OVERHEAD
+                for message in messages
+            )
+            + REPLY_OVERHEAD
+        )
+
+    def _reconcile_tokens(self, charged, usage):
+        """
+        Settle the tokens charged for a request against the usage the API
+        reported, if it did.
+        """
+        if usage and usage.get("total_tokens") is not None:
+            self.scheduler.reconcile(charged, usage["total_tokens"])
+
+    def _generate_summary(self, context, previous_summary=None):
+        if previous_summary is not None:
+            context = [
+                {
+                    "role": "assistant",
+                    "content": f"Summary of the conversation so far: "
+                    f"{previous_summary}",
+                }
+            ] + context
         new_message = self._submit_prompt(
-            "Can you summarize this conversation:\n\n", context, display=False
+            "Can you summarize this conversation:\n\n",
+            context,
+            max_tokens=self.summary_tokens,
+            display=False,
+            priority=PRIORITY_BACKGROUND,
         )
         return new_message["content"].replace("\n", " ")
 
-    def _generate_title(self, context):
-        print("\n\nGenerating title...\n")
+    def _generate_titles(self, messages):
+        """
+        Title several conversations, given their first messages, with a single
+        completion. Titles the reply does not cover are None.
+        """
+        if len(messages) == 1:
+            new_message = self._submit_prompt(
+                "Can you generate a title for this conversation:\n\n",
+                list(messages),
+                display=False,
+                priority=PRIORITY_BACKGROUND,
+            )
+            return [new_message["content"].replace("\n", " ")]
         new_message = self._submit_prompt(
-            "Can you generate a title for this conversation:\n\n", context
+            batch_title_prompt(messages),
+            [],
+            display=False,
+            priority=PRIORITY_BACKGROUND,
         )
-        return new_message["content"].replace("\n", " ")
+        return parse_titles(new_message["content"], len(messages))
 
     def _get_content(self, response, display):
         message = response["choices"][0]["message"]
@@ -187,23 +620,132 @@ class Chatbot:
             print(role, content, sep=": ")
         return message
 
-    def _get_content_streamed(self, response):
-        message = ""
+    def _get_contents(self, response):
+        return [choice["message"] for choice in response["choices"]]
+
+    def _get_content_streamed(self, response, flush="token"):
+        buffer = StreamBuffer(flush)
         for chunk in response:
             delta = chunk["choices"][0]["delta"]
             if "content" in delta.keys():
-                content = delta["content"]
-                message += content
-                if "\n" in content:
+                message = buffer.add(delta["content"])
+                if message:
                     yield message
-                    message = ""
+        message = buffer.flush()
+        if message:
+            yield message
 
     def _get_title(self, conversation_id):
-        conversation_attributes = self.database._get_conversation_attributes(
+        conversation_attributes = self.database.get_conversation_attributes(
             conversation_id
         )
         return conversation_attributes.get("title", None)
 
+    def _queue_title(self):
+        """
+        Give the conversation a placeholder title from its first message, and
+        queue it for a generated title without waiting for the completion.
+        """
+        first_message = self.database.get_first_message(self.conversation_id)
+        if first_message is None:
+            return
+        self.title = heuristic_title(first_message["content"])
+        self.database.update_conversation_title(
+            self.conversation_id, self.title, pending=True
+        )
+        if self.title_worker is None:
+            self.title_worker = TitleWorker(self.database)
+            self._owns_title_worker = True
+        self.title_worker.submit(self.conversation_id, self._generate_titles)
+
+    def _record_turn(self, turn, context, prompt_tokens, completion_tokens):
+        """
+        Close a turn's metrics and store them, using the given token counts
+        where the API did not report the usage.
+
+        :param prompt_tokens:
+            The prompt tokens from _build_context, or None to count the
+            context, which is only done if the API did not report them.
+        :param completion_tokens: The token count of the reply, as stored.
+        """
+        if turn.prompt_tokens is None and prompt_tokens is None:
+            prompt_tokens = self._count_prompt_tokens(context)
+        turn.finish(prompt_tokens, completion_tokens)
+        self.database.put_turn_metrics(self.conversation_id, turn)
+
+    def _save_turn(self, prompt_message, new_message, prompt_token_count):
+        """
+        Persist a prompt and its reply, and bump last_updated, atomically.
+
+        :return: The token count of the reply.
+        """
+        new_message_token_count = self._count_tokens(new_message["content"])
+        with self.database.transaction():
+            # Another Chatbot may have swept this conversation while it was
+            # still empty, so make sure the row exists before referencing it.
+            self.database.put_conversation(self.conversation_id)
+            position = self.database.get_next_position(self.conversation_id)
+            self.database.put_messages(
+                [
+                    (
+                        prompt_message,
+                        self.conversation_id,
+                        position,
+                        prompt_token_count,
+                    ),
+                    (
+                        new_message,
+                        self.conversation_id,
+                        position + 1,
+                        new_message_token_count,
+                    ),
+                ]
+            )
+            self.database.update_conversation(self.conversation_id)
+
+        last = Chatbot._last_garbage_collection
+        if last is None or time.monotonic() - last > GARBAGE_COLLECTION_INTERVAL:
+            self.collect_garbage()
+        return new_message_token_count
+
+    def _submit_candidates(self, prompt, context, engine, n, prompt_tokens=None):
+        """
+        Ask one model for n candidate replies, timing the round trip.
+
+        :param prompt_tokens:
+            The prompt tokens of the request if already known, as from
+            _build_context.
+        """
+        context.append({"role": "user", "content": prompt})
+        started = time.perf_counter()
+        with stage_timer("completion"):
+            response = self._create_completion(
+                prompt_tokens=prompt_tokens,
+                model=engine,
+                messages=context,
+                temperature=self.temperature,
+                stream=False,
+                max_tokens=self.max_tokens,
+                n=n,
+            )
+        latency = time.perf_counter() - started
+        usage = response.get("usage") or {}
+        if usage.get("prompt_tokens") is not None:
+            prompt_tokens = usage["prompt_tokens"]
+        elif prompt_tokens is None:
+            prompt_tokens = self._count_prompt_tokens(context)
+        return [
+            {
+                "engine": engine,
+                "choice_index": index,
+                "content": message["content"],
+                "latency_seconds": latency,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self._count_tokens(message["content"]),
+            }
+            for index, message in enumerate(self._get_contents(response))
+        ]
+
     def _submit_prompt(
         self,
         prompt,
@@ -213,6 +755,10 @@ class Chatbot:
         max_tokens=None,
         n=1,
         display=True,
+        use_cache=True,
+        priority=PRIORITY_USER,
+        turn=None,
+        prompt_tokens=None,
     ):
         if engine is None:
             engine = self.engine
@@ -222,14 +768,19 @@ class Chatbot:
             max_tokens = self.max_tokens
 
         context.append({"role": "user", "content": prompt})
-        response = openai.ChatCompletion.create(
-            model=self.engine,
-            messages=context,
-            temperature=temperature,
-            stream=False,
-            max_tokens=max_tokens,
-            n=n,
-        )
+        with stage_timer("completion", turn):
+            response = self._create_completion(
+                use_cache=use_cache,
+                priority=priority,
+                turn=turn,
+                prompt_tokens=prompt_tokens,
+                model=engine,
+                messages=context,
+                temperature=temperature,
+                stream=False,
+                max_tokens=max_tokens,
+                n=n,
+            )
         content = self._get_content(response, display=display)
         return content
 
@@ -242,6 +793,9 @@ class Chatbot:
         max_tokens=None,
         n=1,
         display=True,
+        flush="token",
+        turn=None,
+        prompt_tokens=None,
         **kwargs,
     ):
         if engine is None:
@@ -252,39 +806,19 @@ class Chatbot:
             max_tokens = self.max_tokens
 
         context.append({"role": "user", "content": prompt})
-        response = openai.ChatCompletion.create(
-            model=self.engine,
-            messages=context,
-            temperature=temperature,
-            stream=True,
-            max_tokens=max_tokens,
-            n=n,
-        )
-        content = self._get_content_streamed(response)
-        for new_message in content:
-            yield new_message
-
-    def _truncate_context(self, context):
-        truncated_context = []
-        summary_context = []
-
-        context_length = 0
-        max_context_length = int(
-            0.8 * (self.max_tokens - 100)
-        )  # 80% of the available tokens
-
-        for message in reversed(context):
-            message_length = len(message["content"].split())
-
-            if context_length + message_length <= max_context_length:
-                truncated_context.append(message)
-                context_length += message_length
-            else:
-                summary_context.append(message)
-
-        if summary_context:
-            summary_context = list(reversed(summary_context))
-            summary = self._generate_summary(summary_context)
-            truncated_context.insert(0, {"role": "assistant", "content": summary})
-
-        return list(reversed(truncated_context))
+        with stage_timer("completion", turn):
+            response = self._create_completion(
+                turn=turn,
+                prompt_tokens=prompt_tokens,
+                model=engine,
+                messages=context,
+                temperature=temperature,
+                stream=True,
+                max_tokens=max_tokens,
+                n=n,
+            )
+            content = self._get_content_streamed(response, flush=flush)
+            for new_message in content:
+                if turn is not None:
+                    turn.mark_first_token()
+                yield new_message
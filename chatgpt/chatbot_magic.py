@@ -2,16 +2,46 @@ from IPython.core.magic import Magics, magics_class, line_magic, cell_magic
 from chatgpt.chatbot import Chatbot
 from IPython.display import display
 
+# Rows shown by %gpt ls; pass a page number or message id for more.
+PAGE_SIZE = 20
+
 
 @magics_class
 class ChatbotMagics(Magics):
     def __init__(self, shell):
         super().__init__(shell)
-        self.chatbot = Chatbot()
+        self._chatbot = None
+
+    @property
+    def chatbot(self):
+        # Built on first use, so kernels that never chat never pay for
+        # openai, tiktoken, pandas or opening the database.
+        if self._chatbot is None:
+            self._chatbot = Chatbot()
+        return self._chatbot
 
     @cell_magic
     def chat(self, line, cell):
-        self.chatbot.talk_to_me(cell)
+        print("assistant", end=": ", flush=True)
+        for content in self.chatbot.stream_to_me(cell):
+            print(content, end="", flush=True)
+        print()
+
+    @cell_magic
+    def compare(self, line, cell):
+        """
+        %%compare [engine ...] [n=N]: ask several models, or one model for N
+        candidates, at once. Keep a candidate with %gpt choose <id>.
+        """
+        engines = [word for word in line.split() if not word.startswith("n=")]
+        n = next((int(word[2:]) for word in line.split() if word.startswith("n=")), 1)
+        for candidate in self.chatbot.fan_out(cell, engines=engines or None, n=n):
+            print(
+                f"[{candidate['id']}] {candidate['engine']} "
+                f"({candidate['latency_seconds']:.2f}s, "
+                f"{candidate['completion_tokens']} tokens)"
+            )
+            print(candidate["content"], end="\n\n", flush=True)
 
     @line_magic
     def gpt(self, line):
@@ -27,8 +57,16 @@ class ChatbotMagics(Magics):
                 %gpt ls conversations
 
                 help: print this message
-                ls conversations: list conversations
-                ls messages: list messages
+                ls conversations [page]: list conversations, a page at a time
+                ls conversations --sort tokens [page]: biggest first, with
+                    their message and token counts and cost; also sorts by
+                    messages or cost
+                ls messages [after_id]: list messages after a message id
+                stats [conversation_id]: show cost and latency per conversation
+                report [hour|day|week|month]: token usage over time, token
+                    distributions per role and conversation sizes
+                choose candidate_id: save a %%compare candidate as the reply
+                candidates: show the candidates of this conversation
                 set conversation_id: set conversation id
                 set max_tokens: set max tokens
                 set system: set system
@@ -43,6 +81,12 @@ class ChatbotMagics(Magics):
 
                 %%chat
 
+                What is the capital of France?
+
+                To compare models, or several candidates, use %%compare:
+
+                %%compare gpt-3.5-turbo gpt-4 n=2
+
                 What is the capital of France?
                 """
             )
@@ -50,9 +94,35 @@ class ChatbotMagics(Magics):
             self.chatbot.print_context()
         elif _input[0] == "ls":
             if _input[1] == "conversations":
-                display(self.chatbot.list_conversations())
+                args = _input[2:]
+                sort = "last_updated"
+                if "--sort" in args:
+                    sort = args.pop(args.index("--sort") + 1)
+                    args.remove("--sort")
+                page = int(args[0]) if args else 1
+                display(
+                    self.chatbot.list_conversations(
+                        limit=PAGE_SIZE,
+                        offset=(page - 1) * PAGE_SIZE,
+                        sort=sort,
+                        stats=sort != "last_updated",
+                    )
+                )
             elif _input[1] == "messages":
-                display(self.chatbot.get_messages())
+                after_id = int(_input[2]) if len(_input) > 2 else None
+                display(self.chatbot.get_messages(limit=PAGE_SIZE, after_id=after_id))
+        elif _input[0] == "choose":
+            self.chatbot.choose_candidate(int(_input[1]))
+        elif _input[0] == "candidates":
+            display(self.chatbot.get_candidates())
+        elif _input[0] == "stats":
+            conversation_id = int(_input[1]) if len(_input) > 1 else None
+            display(self.chatbot.get_stats(conversation_id))
+        elif _input[0] == "report":
+            period = _input[1] if len(_input) > 1 else "day"
+            for name, frame in self.chatbot.get_report(period).items():
+                print(name.replace("_", " ").capitalize())
+                display(frame)
         elif _input[0] == "set":
             param, value = _input[1], _input[2]
             if param in ("max_tokens", "conversation_id"):
@@ -73,6 +143,23 @@ class ChatbotMagics(Magics):
             print("temperature", self.chatbot.temperature, sep=": ")
 
 
+class LazyChatbot:
+    """
+    A stand-in for the Chatbot behind the magics, built on first access.
+    """
+
+    def __init__(self, magics):
+        object.__setattr__(self, "_magics", magics)
+
+    def __getattr__(self, name):
+        return getattr(self._magics.chatbot, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._magics.chatbot, name, value)
+
+
 # Function to load the extension in IPython
 def load_ipython_extension(ipython):
-    ipython.register_magics(ChatbotMagics)
+    magics = ChatbotMagics(ipython)
+    ipython.register_magics(magics)
+    return magics
@@ -0,0 +1,209 @@
+"""
+Bulk export and import of the chat history as Parquet or Arrow IPC files.
+
+A history is a directory holding one file per table, ``conversations`` and
+``messages``. Both directions stream record batches, so memory stays bounded
+by the batch size rather than the size of the history. Requires pyarrow,
+installed with ``pip install -e ".[arrow]"``.
+"""
+import os
+from datetime import datetime, timezone
+from .tokens import DEFAULT_MODEL, count_tokens_batch
+
+BATCH_SIZE = 65536
+
+EXTENSIONS = {"parquet": "parquet", "arrow": "arrow"}
+
+TABLES = {
+    "conversations": [
+        ("id", "int64"),
+        ("title", "string"),
+        ("tags", "string"),
+        ("last_updated", "string"),
+    ],
+    "messages": [
+        ("id", "int64"),
+        ("role", "string"),
+        ("content", "string"),
+        ("conversation_id", "int64"),
+        ("conversation_position", "int64"),
+        ("token_count", "int64"),
+        ("created_at", "string"),
+    ],
+}
+
+# The columns exported as text, which PostgreSQL reads as datetimes.
+TIMESTAMPS = {"last_updated", "created_at"}
+
+
+def _to_text(value):
+    # PostgreSQL returns timestamps as datetimes. Write them in UTC, in the
+    # format of SQLite's CURRENT_TIMESTAMP.
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(sep=" ", timespec="seconds")
+    return value
+
+
+def _schema(table):
+    import pyarrow as pa
+
+    return pa.schema([(name, getattr(pa, type)()) for name, type in TABLES[table]])
+
+
+def _path(directory, table, format):
+    if format not in EXTENSIONS:
+        raise ValueError(f"Unknown format {format!r}. Must be 'parquet' or 'arrow'.")
+    return os.path.join(directory, f"{table}.{EXTENSIONS[format]}")
+
+
+def _open_writer(path, schema, format):
+    import pyarrow as pa
+
+    if format == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.ParquetWriter(path, schema)
+    return pa.ipc.new_file(path, schema)
+
+
+def _read_batches(path, format, batch_size):
+    import pyarrow as pa
+
+    if format == "parquet":
+        import pyarrow.parquet as pq
+
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            yield reader.get_batch(index)
+
+
+def export_history(database, directory, format="parquet", batch_size=BATCH_SIZE):
+    """
+    Write every conversation and message to directory.
+
+    The tables are read from one snapshot, so the files are consistent with
+    each other while other sessions go on writing.
+
+    :param format: "parquet" or "arrow" (Arrow IPC).
+    :return: The number of rows written per table.
+    """
+    import pyarrow as pa
+
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    with database.snapshot() as conn:
+        for table, columns in TABLES.items():
+            schema = _schema(table)
+            cur = conn.execute(
+                f"SELECT {', '.join(name for name, _ in columns)} "
+                f"FROM {table} ORDER BY id"
+            )
+            counts[table] = 0
+            path = _path(directory, table, format)
+            with _open_writer(path, schema, format) as writer:
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    arrays = [
+                        pa.array(
+                            [_to_text(value) for value in values]
+                            if field.name in TIMESTAMPS
+                            else values,
+                            type=field.type,
+                        )
+                        for values, field in zip(zip(*rows), schema)
+                    ]
+                    batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+                    writer.write_batch(batch)
+                    counts[table] += len(rows)
+            cur.close()
+    return counts
+
+
+def import_history(
+    database,
+    directory,
+    format="parquet",
+    batch_size=BATCH_SIZE,
+    model=DEFAULT_MODEL,
+    recount_tokens=False,
+):
+    """
+    Append the conversations and messages in directory to the database.
+
+    Conversation ids are shifted past the largest id already in use, so an
+    import never collides with existing conversations, and message ids are
+    assigned afresh. Missing token counts are computed a batch at a time, and
+    the new messages are indexed for full-text search in one pass.
+
+    :param recount_tokens: Recount every message instead of only the missing.
+    :return:
+        The number of rows imported per table, and the offset added to the
+        conversation ids.
+    """
+    import pyarrow.compute as pc
+
+    counts = {"conversations": 0, "messages": 0}
+    with database.bulk_insert() as insert:
+        offset = database.get_max_conversation_id()
+        conversations = _path(directory, "conversations", format)
+        for batch in _read_batches(conversations, format, batch_size):
+            insert(
+                "conversations",
+                ["id", "title", "tags", "last_updated"],
+                zip(
+                    pc.add(batch.column("id"), offset).to_pylist(),
+                    batch.column("title").to_pylist(),
+                    batch.column("tags").to_pylist(),
+                    batch.column("last_updated").to_pylist(),
+                ),
+            )
+            counts["conversations"] += batch.num_rows
+
+        messages = _path(directory, "messages", format)
+        for batch in _read_batches(messages, format, batch_size):
+            contents = batch.column("content")
+            token_counts = batch.column("token_count").to_pylist()
+            if recount_tokens:
+                token_counts = count_tokens_batch(contents.to_pylist(), model)
+            elif batch.column("token_count").null_count:
+                missing = pc.is_null(batch.column("token_count"))
+                counted = iter(
+                    count_tokens_batch(pc.filter(contents, missing).to_pylist(), model)
+                )
+                token_counts = [
+                    next(counted) if count is None else count for count in token_counts
+                ]
+            # Exports from before created_at was recorded lack the column.
+            if "created_at" in batch.schema.names:
+                created_at = batch.column("created_at").to_pylist()
+            else:
+                created_at = [None] * batch.num_rows
+            insert(
+                "messages",
+                [
+                    "role",
+                    "content",
+                    "conversation_id",
+                    "conversation_position",
+                    "token_count",
+                    "created_at",
+                ],
+                zip(
+                    batch.column("role").to_pylist(),
+                    contents.to_pylist(),
+                    pc.add(batch.column("conversation_id"), offset).to_pylist(),
+                    batch.column("conversation_position").to_pylist(),
+                    token_counts,
+                    created_at,
+                ),
+            )
+            counts["messages"] += batch.num_rows
+    counts["offset"] = offset
+    return counts
@@ -0,0 +1,398 @@
+import bisect
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from .metrics import metrics
+
+# How many conversations a CachedDatabase keeps in memory by default.
+HOT_CONVERSATIONS = 32
+
+CachedMessage = namedtuple(
+    "CachedMessage", ["position", "role", "content", "token_count"]
+)
+
+_MISSING = object()
+
+# The conversations cached under each store key, kept for as long as a
+# CachedDatabase uses them.
+_stores = weakref.WeakValueDictionary()
+_stores_lock = threading.Lock()
+
+
+class _CachedConversation:
+    __slots__ = ("messages", "summary")
+
+    def __init__(self, messages, summary=_MISSING):
+        # CachedMessages, ordered by position.
+        self.messages = messages
+        self.summary = summary
+
+
+class _ConversationStore:
+    __slots__ = ("conversations", "lock", "__weakref__")
+
+    def __init__(self):
+        self.conversations = OrderedDict()
+        self.lock = threading.RLock()
+
+
+def _get_store(key):
+    if key is None:
+        return _ConversationStore()
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = _ConversationStore()
+        return store
+
+
+class CachedDatabase:
+    """
+    A StorageBackend keeping the messages and summary of the most recently
+    used conversations in memory, in front of another backend.
+
+    Writes go through to the backend and then update the cache, so a hot
+    conversation is read from the backend once and never again. Deleting a
+    message or a conversation evicts it. Within a transaction the cache
+    updates wait for the commit, and a rollback drops them.
+
+    The cache only sees writes made through it. CachedDatabases given the
+    same store key share their cache, so give every one in front of the same
+    database the same key. Writes from other processes aren't seen, except
+    that a position handed out within a transaction always comes from the
+    backend: a cached conversation another writer got ahead of is dropped
+    there, and read again.
+
+    :param database: The StorageBackend to cache.
+    :param max_conversations:
+        How many conversations to keep, evicting the least recently used.
+    :param store_key:
+        The key of a cache shared with the other CachedDatabases of this
+        process, e.g. the path of a SQLite file, or None for a cache of its
+        own.
+    """
+
+    def __init__(self, database, max_conversations=HOT_CONVERSATIONS, store_key=None):
+        self.database = database
+        self.max_conversations = max_conversations
+        self.store_key = store_key
+        store = _get_store(store_key)
+        # Held on to, so the store lives as long as this does.
+        self._store_ref = store
+        self._conversations = store.conversations
+        self._lock = store.lock
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        # Everything the cache has no business with goes straight through.
+        return getattr(self.database, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.store_key is None:
+            self.clear()
+        self.database.close()
+
+    def clear(self):
+        with self._lock:
+            self._conversations.clear()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed calls in a transaction of the backend.
+
+        The cache takes the writes once the transaction commits. Until then
+        this thread reads the conversations written to from the backend, and
+        other threads read them from the cache as last committed. Statements
+        run on the yielded connection can't be followed, so if any writes
+        are among them, the commit clears the whole cache.
+        """
+        if getattr(self._local, "staged", None) is not None:
+            with self.database.transaction():
+                yield self._local.connection
+            return
+        self._local.written, self._local.staged = set(), []
+        try:
+            with self.database.transaction() as conn:
+                self._local.connection = _WatchedConnection(conn)
+                yield self._local.connection
+            staged = self._local.staged
+            if self._local.connection.wrote:
+                staged = [self.clear]
+        finally:
+            self._local.written = self._local.staged = None
+            self._local.connection = None
+        for update in staged:
+            update()
+
+    def delete_message(self, message_id):
+        message = self.database.get_message(message_id)
+        self.database.delete_message(message_id)
+        if message is not None:
+            conversation_id = message["conversation_id"]
+            self._update([conversation_id], lambda: self._evict(conversation_id))
+
+    def delete_conversation(self, conversation_id):
+        self.database.delete_conversation(conversation_id)
+        self._update([conversation_id], lambda: self._evict(conversation_id))
+
+    def delete_empty_conversations(self, exclude=(), min_age=0):
+        deleted = self.database.delete_empty_conversations(exclude, min_age)
+        if deleted:
+            self._update([], self._evict_empty)
+        return deleted
+
+    @contextmanager
+    def bulk_insert(self):
+        """
+        Insert in bulk through the backend, and clear the cache, which the
+        inserts go around.
+        """
+        with self.database.bulk_insert() as insert:
+            yield insert
+        self._update([], self.clear)
+
+    def import_history(self, directory, format="parquet", **kwargs):
+        """
+        Import through the backend, see chatgpt.columnar.import_history, and
+        clear the cache, which the bulk inserts go around.
+        """
+        imported = self.database.import_history(directory, format, **kwargs)
+        self._update([], self.clear)
+        return imported
+
+    def create_conversation(self):
+        conversation_id = self.database.create_conversation()
+        self._update(
+            [conversation_id],
+            lambda: self._store(conversation_id, _CachedConversation([], None)),
+        )
+        return conversation_id
+
+    def get_context(self, conversation_id):
+        return [
+            {"role": message.role, "content": message.content}
+            for message in self._get_messages(conversation_id)
+        ]
+
+    def get_context_range(self, conversation_id, first_position, last_position):
+        return [
+            {"role": message.role, "content": message.content}
+            for message in self._get_messages(conversation_id)
+            if first_position <= message.position <= last_position
+        ]
+
+    def get_context_window(
+        self, conversation_id, max_tokens, message_overhead=0, after_position=-1
+    ):
+        """
+        Get the newest messages of a conversation that fit in a token budget;
+        see LocalDatabase.get_context_window.
+        """
+        messages = self._get_messages(conversation_id)
+        selected = []
+        token_count = 0
+        for message in reversed(messages):
+            running_tokens = token_count + (message.token_count or 0) + message_overhead
+            if message.position <= after_position or running_tokens > max_tokens:
+                break
+            selected.append(message)
+            token_count = running_tokens
+        selected.reverse()
+        if selected:
+            first_position = selected[0].position
+        else:
+            first_position = max(
+                self.get_next_position(conversation_id), after_position + 1
+            )
+        context = [
+            {"role": message.role, "content": message.content} for message in selected
+        ]
+        return context, first_position, token_count
+
+    def get_conversation_messages(self, conversation_id):
+        return list(self._get_messages(conversation_id))
+
+    def get_first_message(self, conversation_id):
+        messages = self._get_messages(conversation_id)
+        if not messages:
+            return None
+        return {"role": messages[0].role, "content": messages[0].content}
+
+    def get_next_position(self, conversation_id):
+        written = getattr(self._local, "written", None)
+        if written is None:
+            messages = self._get_messages(conversation_id)
+            return messages[-1].position + 1 if messages else 0
+        # About to write: ask the backend, whose transaction holds off other
+        # writers, and drop the cached copy if one of them got ahead of it.
+        position = self.database.get_next_position(conversation_id)
+        if conversation_id not in written:
+            with self._lock:
+                conversation = self._conversations.get(conversation_id)
+                messages = conversation.messages if conversation else None
+                if (
+                    messages is not None
+                    and (messages[-1].position + 1 if messages else 0) != position
+                ):
+                    self._evict(conversation_id)
+        return position
+
+    def get_summary(self, conversation_id):
+        conversation = self._get_conversation(conversation_id)
+        with self._lock:
+            if conversation.summary is _MISSING:
+                conversation.summary = self.database.get_summary(conversation_id)
+            return conversation.summary
+
+    def put_message(self, message, conversation_id, conversation_position, token_count):
+        self.put_messages(
+            [(message, conversation_id, conversation_position, token_count)]
+        )
+
+    def put_messages(self, rows):
+        rows = list(rows)
+        self.database.put_messages(rows)
+        self._update(
+            {conversation_id for _, conversation_id, _, _ in rows},
+            lambda: self._add_messages(rows),
+        )
+
+    def put_summary(
+        self, conversation_id, first_position, last_position, content, token_count
+    ):
+        self.database.put_summary(
+            conversation_id, first_position, last_position, content, token_count
+        )
+        summary = {
+            "first_position": first_position,
+            "last_position": last_position,
+            "content": content,
+            "token_count": token_count,
+        }
+        self._update(
+            [conversation_id], lambda: self._set_summary(conversation_id, summary)
+        )
+
+    def _add_messages(self, rows):
+        with self._lock:
+            for message, conversation_id, position, token_count in rows:
+                conversation = self._conversations.get(conversation_id)
+                if conversation is None:
+                    continue
+                messages = conversation.messages
+                index = bisect.bisect_left(
+                    messages, position, key=lambda message: message.position
+                )
+                # A concurrent load may already have read this message.
+                if index < len(messages) and messages[index].position == position:
+                    continue
+                messages.insert(
+                    index,
+                    CachedMessage(
+                        position, message["role"], message["content"], token_count
+                    ),
+                )
+
+    def _evict(self, *conversation_ids):
+        with self._lock:
+            for conversation_id in conversation_ids:
+                self._conversations.pop(conversation_id, None)
+
+    def _evict_empty(self):
+        with self._lock:
+            self._evict(
+                *[
+                    conversation_id
+                    for conversation_id, conversation in self._conversations.items()
+                    if not conversation.messages
+                ]
+            )
+
+    def _get_conversation(self, conversation_id):
+        if conversation_id in (getattr(self._local, "written", None) or ()):
+            # Written to by this thread's open transaction: only the backend
+            # has the uncommitted writes, and the cache mustn't take them yet.
+            rows = self.database.get_conversation_messages(conversation_id)
+            return _CachedConversation([CachedMessage(*row) for row in rows])
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is not None:
+                self._conversations.move_to_end(conversation_id)
+                metrics.increment("conversation_cache_hits")
+                return conversation
+            # Load under the lock, so no append can slip in between the read
+            # and the store and be lost.
+            metrics.increment("conversation_cache_misses")
+            rows = self.database.get_conversation_messages(conversation_id)
+            conversation = _CachedConversation([CachedMessage(*row) for row in rows])
+            self._store(conversation_id, conversation)
+            return conversation
+
+    def _get_messages(self, conversation_id):
+        conversation = self._get_conversation(conversation_id)
+        with self._lock:
+            return list(conversation.messages)
+
+    def _store(self, conversation_id, conversation):
+        with self._lock:
+            self._conversations[conversation_id] = conversation
+            self._conversations.move_to_end(conversation_id)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def _set_summary(self, conversation_id, summary):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is not None:
+                conversation.summary = summary
+
+    def _update(self, conversation_ids, update):
+        """
+        Apply a write to the cache now, or once the transaction this thread
+        is in commits.
+
+        :param conversation_ids: The conversations the write is to.
+        :param update: A function updating the cache.
+        """
+        staged = getattr(self._local, "staged", None)
+        if staged is None:
+            update()
+        else:
+            self._local.written.update(conversation_ids)
+            staged.append(update)
+
+
+class _WatchedConnection:
+    """
+    A backend connection noting whether statements other than SELECTs were
+    run on it, whose writes a CachedDatabase can't follow.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.wrote = False
+
+    def __getattr__(self, name):
+        if name in ("cursor", "executescript", "copy"):
+            self.wrote = True
+        return getattr(self._conn, name)
+
+    def execute(self, query, *args, **kwargs):
+        self._note(query)
+        return self._conn.execute(query, *args, **kwargs)
+
+    def executemany(self, query, *args, **kwargs):
+        self._note(query)
+        return self._conn.executemany(query, *args, **kwargs)
+
+    def _note(self, query):
+        if not str(query).lstrip().upper().startswith("SELECT"):
+            self.wrote = True
@@ -1,28 +1,518 @@
+import re
 import sqlite3
-import pandas as pd
+import threading
+import time
+from contextlib import contextmanager
+from .filters import resolve_filter
+from .metrics import cost_sql, metrics
+
+# Recompute the message aggregates of conversations from their messages, for
+# the ones a trigger per row would be too slow to maintain.
+REFRESH_MESSAGE_AGGREGATES = """
+    UPDATE conversations
+    SET (message_count, total_tokens, last_position) = (
+        SELECT
+            COUNT(*),
+            COALESCE(SUM(token_count), 0),
+            MAX(conversation_position)
+        FROM messages
+        WHERE messages.conversation_id = conversations.id
+    )
+"""
+
+# The prices of metrics.PRICES when version 9 started storing costs, which
+# it backfills the earlier turns with. Later price changes must not change
+# what the migration computes.
+PRICES_AT_VERSION_9 = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+# Each entry upgrades the schema by one version; the index + 1 is the
+# PRAGMA user_version a database is at once the entry has been applied.
+MIGRATIONS = [
+    # 1: the original, unindexed schema.
+    (
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role TEXT,
+            content TEXT,
+            conversation_id INTEGER,
+            conversation_position INTEGER,
+            token_count INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            tags TEXT,
+            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ),
+    # 2: foreign keys from messages to conversations, plus lookup indexes.
+    (
+        """
+        INSERT OR IGNORE INTO conversations (id)
+        SELECT DISTINCT conversation_id
+        FROM messages
+        WHERE conversation_id IS NOT NULL
+        """,
+        """
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role TEXT,
+            content TEXT,
+            conversation_id INTEGER
+                REFERENCES conversations (id) ON DELETE CASCADE,
+            conversation_position INTEGER,
+            token_count INTEGER
+        )
+        """,
+        """
+        INSERT INTO messages_new (
+            id,
+            role,
+            content,
+            conversation_id,
+            conversation_position,
+            token_count
+        )
+        SELECT
+            id,
+            role,
+            content,
+            conversation_id,
+            conversation_position,
+            token_count
+        FROM messages
+        """,
+        "DROP TABLE messages",
+        "ALTER TABLE messages_new RENAME TO messages",
+        """
+        CREATE INDEX messages_conversation_position
+        ON messages (conversation_id, conversation_position)
+        """,
+        """
+        CREATE INDEX conversations_last_updated
+        ON conversations (last_updated)
+        """,
+    ),
+    # 3: an FTS5 index over message content, kept in sync by triggers.
+    (
+        """
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content,
+            content = 'messages',
+            content_rowid = 'id'
+        )
+        """,
+        """
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content)
+            VALUES (new.id, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content)
+            VALUES (new.id, new.content);
+        END
+        """,
+        # Backfill the index from messages written before this version.
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ),
+    # 4: rolling summaries of the history that no longer fits the context.
+    (
+        """
+        CREATE TABLE summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER
+                REFERENCES conversations (id) ON DELETE CASCADE,
+            first_position INTEGER,
+            last_position INTEGER,
+            content TEXT,
+            token_count INTEGER
+        )
+        """,
+        """
+        CREATE INDEX summaries_conversation_position
+        ON summaries (conversation_id, last_position)
+        """,
+        """
+        CREATE TRIGGER summaries_invalidate AFTER DELETE ON messages BEGIN
+            DELETE FROM summaries
+            WHERE conversation_id = old.conversation_id
+            AND old.conversation_position
+                BETWEEN first_position AND last_position;
+        END
+        """,
+    ),
+    # 5: mark placeholder titles awaiting a generated one.
+    (
+        """
+        ALTER TABLE conversations
+        ADD COLUMN title_pending INTEGER NOT NULL DEFAULT 0
+        """,
+    ),
+    # 6: latency, token and cache metrics of every turn.
+    (
+        """
+        CREATE TABLE turn_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER
+                REFERENCES conversations (id) ON DELETE CASCADE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            model TEXT,
+            turn_seconds REAL,
+            context_seconds REAL,
+            completion_seconds REAL,
+            first_token_seconds REAL,
+            save_seconds REAL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            cache_hit INTEGER
+        )
+        """,
+        """
+        CREATE INDEX turn_metrics_conversation
+        ON turn_metrics (conversation_id)
+        """,
+    ),
+    # 7: candidate replies of fanned-out prompts, kept for comparison.
+    (
+        """
+        CREATE TABLE candidates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER
+                REFERENCES conversations (id) ON DELETE CASCADE,
+            conversation_position INTEGER,
+            prompt TEXT,
+            engine TEXT,
+            choice_index INTEGER,
+            content TEXT,
+            latency_seconds REAL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            chosen INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX candidates_conversation_position
+        ON candidates (conversation_id, conversation_position)
+        """,
+    ),
+    # 8: when each message was written, NULL for messages from before. ADD
+    # COLUMN takes no CURRENT_TIMESTAMP default, so inserts set it instead.
+    (
+        "ALTER TABLE messages ADD COLUMN created_at DATETIME",
+        "CREATE INDEX messages_created_at ON messages (created_at)",
+    ),
+    # 9: per-conversation aggregates, kept up to date by triggers so listing,
+    # pruning and numbering messages never scan a conversation. The cost is
+    # what the turns of a conversation were billed, context included.
+    (
+        """
+        ALTER TABLE conversations
+        ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0
+        """,
+        """
+        ALTER TABLE conversations
+        ADD COLUMN total_tokens INTEGER NOT NULL DEFAULT 0
+        """,
+        "ALTER TABLE conversations ADD COLUMN last_position INTEGER",
+        "ALTER TABLE conversations ADD COLUMN cost REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE turn_metrics ADD COLUMN cost REAL",
+        f"UPDATE turn_metrics SET cost = {cost_sql(PRICES_AT_VERSION_9)}",
+        REFRESH_MESSAGE_AGGREGATES,
+        """
+        UPDATE conversations
+        SET cost = (
+            SELECT COALESCE(SUM(cost), 0)
+            FROM turn_metrics
+            WHERE turn_metrics.conversation_id = conversations.id
+        )
+        """,
+        """
+        CREATE INDEX conversations_total_tokens
+        ON conversations (total_tokens)
+        """,
+        """
+        CREATE TRIGGER messages_aggregate_insert AFTER INSERT ON messages BEGIN
+            UPDATE conversations
+            SET
+                message_count = message_count + 1,
+                total_tokens = total_tokens + COALESCE(new.token_count, 0),
+                last_position = MAX(
+                    COALESCE(last_position, -1), new.conversation_position
+                )
+            WHERE id = new.conversation_id;
+        END
+        """,
+        """
+        CREATE TRIGGER messages_aggregate_delete AFTER DELETE ON messages BEGIN
+            UPDATE conversations
+            SET
+                message_count = message_count - 1,
+                total_tokens = total_tokens - COALESCE(old.token_count, 0),
+                last_position = CASE
+                    WHEN old.conversation_position < last_position
+                    THEN last_position
+                    ELSE (
+                        SELECT MAX(conversation_position)
+                        FROM messages
+                        WHERE conversation_id = old.conversation_id
+                    )
+                END
+            WHERE id = old.conversation_id;
+        END
+        """,
+        """
+        CREATE TRIGGER messages_aggregate_update
+        AFTER UPDATE OF token_count ON messages
+        BEGIN
+            UPDATE conversations
+            SET total_tokens = total_tokens
+                - COALESCE(old.token_count, 0)
+                + COALESCE(new.token_count, 0)
+            WHERE id = new.conversation_id;
+        END
+        """,
+        """
+        CREATE TRIGGER turn_metrics_cost AFTER INSERT ON turn_metrics BEGIN
+            UPDATE conversations
+            SET cost = cost + COALESCE(new.cost, 0)
+            WHERE id = new.conversation_id;
+        END
+        """,
+    ),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+MESSAGE_COLUMNS = [
+    "id",
+    "role",
+    "content",
+    "conversation_id",
+    "conversation_position",
+    "token_count",
+]
+CONVERSATION_COLUMNS = ["id", "title", "tags", "last_updated"]
+CONVERSATION_STAT_COLUMNS = ["message_count", "total_tokens", "last_position", "cost"]
+# How list_conversations can order conversations, newest or biggest first.
+CONVERSATION_SORTS = {
+    "last_updated": "last_updated",
+    "messages": "message_count",
+    "tokens": "total_tokens",
+    "cost": "cost",
+}
+CANDIDATE_COLUMNS = [
+    "id",
+    "conversation_id",
+    "conversation_position",
+    "prompt",
+    "engine",
+    "choice_index",
+    "content",
+    "latency_seconds",
+    "prompt_tokens",
+    "completion_tokens",
+    "chosen",
+]
+TURN_METRIC_COLUMNS = [
+    "conversation_id",
+    "created_at",
+    "model",
+    "turn_seconds",
+    "context_seconds",
+    "completion_seconds",
+    "first_token_seconds",
+    "save_seconds",
+    "prompt_tokens",
+    "completion_tokens",
+    "cache_hit",
+    "cost",
+]
+
+
+class ConnectionManager:
+    """
+    Hand out long-lived SQLite connections, one per thread.
+
+    Connections are opened lazily on first use, configured once with
+    ``PRAGMAS`` and reused until ``close`` is called.
+    """
+
+    PRAGMAS = (
+        # First, so that switching to WAL waits for other processes too.
+        "PRAGMA busy_timeout = 5000",
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA foreign_keys = ON",
+        "PRAGMA temp_store = MEMORY",
+    )
+    # Prepared statements kept per connection. Every query is parameterised,
+    # so this comfortably holds all of them.
+    CACHED_STATEMENTS = 256
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_file,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=self.CACHED_STATEMENTS,
+            )
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._local = threading.local()
 
 
 class LocalDatabase:
+    # The SQL dialect of MessageFilter.compile and the analytics queries.
+    DIALECT = "sqlite"
+
     def __init__(self, db_file="chat.db"):
         self.db_file = db_file
+        self.connections = ConnectionManager(db_file)
 
-    def find_message(self, search_string):
-        search_string = f"%{search_string}%"
-        query = """
-            SELECT * FROM messages
-            WHERE content LIKE ?
-        """
-        data = self._query_db(query, (search_string,), fetch="all")
-        columns = [
-            "id",
-            "role",
-            "content",
-            "conversation_id",
-            "conversation_position",
-            "token_count",
-        ]
-        df = pd.DataFrame(data, columns=columns)
-        return df
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connections.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed writes as one atomic transaction.
+
+        Nested calls join the outermost transaction, which commits once on
+        exit or rolls back if an exception escapes.
+        """
+        conn = self.connections.get()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Run the enclosed reads against one consistent snapshot of the
+        database.
+
+        Unlike transaction, this takes no write lock: the deferred
+        transaction only pins what the reads see, and other sessions keep
+        writing meanwhile.
+        """
+        conn = self.connections.get()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("ROLLBACK")
+
+    @contextmanager
+    def bulk_insert(self):
+        """
+        Run the enclosed inserts in a transaction that indexes new messages
+        for full-text search and adds them to the aggregates of their
+        conversations with one statement each at the end, rather than with
+        triggers per row.
+
+        :return:
+            A function insert(table, columns, rows) appending rows, tuples of
+            the values of columns, to table.
+        """
+        triggers = ("messages_fts_insert", "messages_aggregate_insert")
+        with self.transaction() as conn:
+            trigger_sql = [
+                conn.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                    (trigger,),
+                ).fetchone()[0]
+                for trigger in triggers
+            ]
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+            last_id = last_id.fetchone()[0]
+            for trigger in triggers:
+                conn.execute(f"DROP TRIGGER {trigger}")
+
+            def insert(table, columns, rows):
+                conn.executemany(
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' for _ in columns)})",
+                    rows,
+                )
+
+            yield insert
+            conn.execute(
+                """
+                INSERT INTO messages_fts (rowid, content)
+                SELECT id, content
+                FROM messages
+                WHERE id > ?
+            """,
+                (last_id,),
+            )
+            conn.execute(
+                REFRESH_MESSAGE_AGGREGATES
+                + """
+                WHERE id IN (
+                    SELECT conversation_id
+                    FROM messages
+                    WHERE id > ?
+                )
+            """,
+                (last_id,),
+            )
+            for sql in trigger_sql:
+                conn.execute(sql)
 
     def delete_message(self, message_id):
         query = """
@@ -32,25 +522,35 @@ class LocalDatabase:
         self._query_db(query, (message_id,))
 
     def delete_conversation(self, conversation_id):
+        # Messages go with their conversation via ON DELETE CASCADE.
         query = """
-            SELECT COUNT(*)
-            FROM messages
-            WHERE conversation_id = ?
+            DELETE FROM conversations
+            WHERE id = ?
         """
-        message_count = self._query_db(query, (conversation_id,), fetch="one")[0]
+        self._query_db(query, (conversation_id,))
 
-        if message_count > 0:
-            query = """
-                DELETE FROM messages
-                WHERE conversation_id = ?
-            """
-            self._query_db(query, (conversation_id,))
+    def delete_empty_conversations(self, exclude=(), min_age=0):
+        """
+        Delete untitled conversations without messages in one statement.
 
-        query = """
+        :param exclude: Conversation ids to keep regardless.
+        :param min_age:
+            Only delete conversations last updated at least this many seconds
+            ago.
+        :return: The number of conversations deleted.
+        """
+        exclude = list(exclude)
+        placeholders = ", ".join("?" for _ in exclude)
+        query = f"""
             DELETE FROM conversations
-            WHERE id = ?
+            WHERE title IS NULL
+            AND last_updated <= datetime('now', ?)
+            AND id NOT IN ({placeholders})
+            AND message_count = 0
         """
-        self._query_db(query, (conversation_id,))
+        with self.transaction() as conn:
+            cur = conn.execute(query, [f"-{min_age} seconds", *exclude])
+            return cur.rowcount
 
     def get_message(self, message_id):
         query = """
@@ -78,81 +578,297 @@ class LocalDatabase:
         else:
             return None
 
-    def get_messages(self, predicate_sql=None):
+    def export_history(self, directory, format="parquet", **kwargs):
+        """
+        Write all conversations and messages to Parquet or Arrow IPC files;
+        see chatgpt.columnar.export_history.
+        """
+        from .columnar import export_history
+
+        return export_history(self, directory, format=format, **kwargs)
+
+    def find_message(self, search_string, full_text=False, limit=None, offset=0):
         """
-        Get all messages with their attributes as a pandas DataFrame.
+        Find messages whose content matches a search string.
 
-        :param predicate_sql: An optional SQL WHERE clause to filter the results.
+        :param search_string:
+            A substring to look for or, with full_text, the words to find, such
+            as ``tiktoken``, ``"exact phrase"`` or ``token*`` for a prefix.
+        :param full_text:
+            Search the FTS5 index and rank results by bm25 instead of
+            scanning every message with LIKE. Adds ``snippet`` and ``rank``
+            columns to the result.
+        :param limit: An optional maximum number of rows to return.
+        :param offset: The number of matching rows to skip.
+        :return: A pandas DataFrame containing the matching messages.
+        """
+        query, params, columns = self._find_message_query(search_string, full_text)
+        limit = -1 if limit is None else limit
+        return self._query_df(
+            f"{query} LIMIT ? OFFSET ?", (*params, limit, offset), columns
+        )
+
+    def import_history(self, directory, format="parquet", **kwargs):
+        """
+        Append conversations and messages from Parquet or Arrow IPC files;
+        see chatgpt.columnar.import_history.
+        """
+        from .columnar import import_history
+
+        return import_history(self, directory, format=format, **kwargs)
+
+    def iter_find_message(self, search_string, full_text=False, chunk_size=1000):
+        """
+        Like find_message, but yield the matches in DataFrame chunks.
+        """
+        query, params, columns = self._find_message_query(search_string, full_text)
+        return self._iter_df(query, params, columns, chunk_size)
+
+    def get_messages(self, where=None, limit=None, after_id=None, predicate_sql=None):
+        """
+        Get messages with their attributes as a pandas DataFrame, by id.
+
+        :param where: An optional MessageFilter to select the messages.
+        :param limit: An optional maximum number of rows to return.
+        :param after_id:
+            Only return messages with a larger id, to fetch the page after
+            one ending with this id.
+        :param predicate_sql:
+            Deprecated: a raw SQL condition, also accepted in place of where.
         :return: A pandas DataFrame containing message attributes.
         """
-        query = "SELECT * FROM messages"
+        where, predicate_sql = resolve_filter(where, predicate_sql)
+        query, params = self._messages_query(where, predicate_sql, after_id)
+        limit = -1 if limit is None else limit
+        return self._query_df(f"{query} LIMIT ?", (*params, limit), MESSAGE_COLUMNS)
 
-        if predicate_sql is not None:
-            query += f" WHERE {predicate_sql}"
+    def iter_messages(self, where=None, chunk_size=1000, predicate_sql=None):
+        """
+        Like get_messages, but yield the messages in DataFrame chunks.
+        """
+        where, predicate_sql = resolve_filter(where, predicate_sql)
+        query, params = self._messages_query(where, predicate_sql)
+        return self._iter_df(query, params, MESSAGE_COLUMNS, chunk_size)
 
-        result = self._query_db(query, fetch="all")
+    def get_candidates(self, conversation_id=None):
+        query = f"""
+            SELECT {", ".join(CANDIDATE_COLUMNS)}
+            FROM candidates
+        """
+        params = ()
+        if conversation_id is not None:
+            query += " WHERE conversation_id = ?"
+            params = (conversation_id,)
+        query += " ORDER BY id"
+        return self._query_df(query, params, CANDIDATE_COLUMNS)
 
-        messages_df = pd.DataFrame(
-            result,
-            columns=[
-                "id",
-                "role",
-                "content",
-                "conversation_id",
-                "conversation_position",
-                "token_count",
-            ],
-        )
+    def get_turn_metrics(self, conversation_id=None):
+        query = f"""
+            SELECT {", ".join(TURN_METRIC_COLUMNS)}
+            FROM turn_metrics
+        """
+        params = ()
+        if conversation_id is not None:
+            query += " WHERE conversation_id = ?"
+            params = (conversation_id,)
+        query += " ORDER BY id"
+        return self._query_df(query, params, TURN_METRIC_COLUMNS)
+
+    def read_query(self, query, params=(), columns=None):
+        """
+        Run a read-only query with ? placeholders.
 
-        return messages_df
+        :return: The rows as a DataFrame with the given column names.
+        """
+        return self._query_df(query, params, columns)
 
-    def list_conversations(self):
+    def list_conversations(
+        self, limit=None, offset=0, sort="last_updated", stats=False
+    ):
+        """
+        :param sort: One of CONVERSATION_SORTS, ordering the biggest first.
+        :param stats: Add the CONVERSATION_STAT_COLUMNS to the listing.
+        """
+        columns = _conversation_columns(stats)
+        query = f"""
+            SELECT {", ".join(columns)}
+            FROM conversations
+            ORDER BY {_sort_column(sort)} DESC
+            LIMIT ? OFFSET ?
+        """
+        limit = -1 if limit is None else limit
+        return self._query_df(query, (limit, offset), columns)
+
+    def iter_conversations(self, chunk_size=1000):
+        """
+        Like list_conversations, but yield the conversations in DataFrame
+        chunks.
+        """
         query = """
-            SELECT * FROM conversations
+            SELECT id, title, tags, last_updated
+            FROM conversations
             ORDER BY last_updated DESC
         """
-        data = self._query_db(query, fetch="all")
-        columns = ["id", "title", "tags", "last_updated"]
-        df = pd.DataFrame(data, columns=columns)
-        return df
+        return self._iter_df(query, (), CONVERSATION_COLUMNS, chunk_size)
 
-    def _create_tables(self):
-        self._query_db(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                role TEXT,
-                content TEXT,
-                conversation_id INTEGER,
-                conversation_position INTEGER,
-                token_count INTEGER
-            )
+    def create_tables(self):
         """
-        )
-        self._query_db(
-            """
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT,
-                tags TEXT,
-                last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
+        Create the schema, or upgrade an existing database in place.
+
+        The schema version is tracked in PRAGMA user_version; every migration
+        newer than it is applied in order, each in its own transaction. The
+        version is read again under each transaction's write lock, so
+        processes starting together on the same file never apply a migration
+        twice.
+        """
+        conn = self.connections.get()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # Table rebuilds need foreign key enforcement off, and the pragma is
+        # a no-op inside a transaction.
+        conn.execute("PRAGMA foreign_keys = OFF")
+        try:
+            while True:
+                with self.transaction():
+                    version = conn.execute("PRAGMA user_version").fetchone()[0]
+                    if version >= SCHEMA_VERSION:
+                        break
+                    for statement in MIGRATIONS[version]:
+                        conn.execute(statement)
+                    if conn.execute("PRAGMA foreign_key_check").fetchone():
+                        raise sqlite3.IntegrityError(
+                            f"Migration to schema version {version + 1} "
+                            "left dangling foreign keys"
+                        )
+                    conn.execute(f"PRAGMA user_version = {version + 1}")
+        finally:
+            conn.execute("PRAGMA foreign_keys = ON")
+
+    def create_conversation(self):
+        """
+        Insert a conversation with the next free id.
+
+        :return: The id of the new conversation.
         """
+        with self.transaction():
+            conversation_id = self.get_max_conversation_id() + 1
+            self.put_conversation(conversation_id)
+        return conversation_id
+
+    def _find_message_query(self, search_string, full_text):
+        columns = list(MESSAGE_COLUMNS)
+        if full_text:
+            query = """
+                SELECT
+                    messages.id,
+                    messages.role,
+                    messages.content,
+                    messages.conversation_id,
+                    messages.conversation_position,
+                    messages.token_count,
+                    snippet(messages_fts, 0, '**', '**', '...', 16),
+                    bm25(messages_fts) AS rank
+                FROM messages_fts
+                JOIN messages ON messages.id = messages_fts.rowid
+                WHERE messages_fts MATCH ?
+                ORDER BY rank
+            """
+            columns += ["snippet", "rank"]
+            search_string = _fts_query(search_string)
+        else:
+            search_string = f"%{search_string}%"
+            query = """
+                SELECT
+                    id,
+                    role,
+                    content,
+                    conversation_id,
+                    conversation_position,
+                    token_count
+                FROM messages
+                WHERE content LIKE ?
+                ORDER BY id
+            """
+        return query, (search_string,), columns
+
+    def get_context(self, conversation_id):
+        context = self._query_db(
+            """
+                SELECT role, content
+                FROM messages
+                WHERE conversation_id = ?
+                ORDER BY conversation_position
+            """,
+            (conversation_id,),
+            fetch="all",
         )
+        return [{"role": role, "content": content} for role, content in context]
 
-    def _get_context(self, conversation_id):
+    def get_context_range(self, conversation_id, first_position, last_position):
         context = self._query_db(
-            f"""
+            """
                 SELECT role, content
                 FROM messages
-                WHERE conversation_id = {conversation_id}
+                WHERE conversation_id = ?
+                AND conversation_position BETWEEN ? AND ?
                 ORDER BY conversation_position
             """,
+            (conversation_id, first_position, last_position),
             fetch="all",
         )
         return [{"role": role, "content": content} for role, content in context]
 
-    def _get_conversation_attributes(self, conversation_id):
+    def get_context_window(
+        self, conversation_id, max_tokens, message_overhead=0, after_position=-1
+    ):
+        """
+        Get the newest messages of a conversation that fit in a token budget.
+
+        A running sum over the stored token counts, newest first, picks the
+        messages in a single query without loading the rest of the history.
+
+        :param max_tokens: The number of tokens the messages may use.
+        :param message_overhead: Extra tokens to charge for every message.
+        :param after_position: Only consider messages after this position.
+        :return:
+            The selected messages, oldest first, as in get_context, the
+            position of the oldest one (the next free position if none fit)
+            and the tokens they use, message_overhead included.
+        """
+        rows = self._query_db(
+            """
+                SELECT role, content, conversation_position, running_tokens
+                FROM (
+                    SELECT
+                        role,
+                        content,
+                        conversation_position,
+                        SUM(COALESCE(token_count, 0) + ?) OVER (
+                            ORDER BY conversation_position DESC
+                            ROWS UNBOUNDED PRECEDING
+                        ) AS running_tokens
+                    FROM messages
+                    WHERE conversation_id = ?
+                    AND conversation_position > ?
+                )
+                WHERE running_tokens <= ?
+                ORDER BY conversation_position
+            """,
+            (message_overhead, conversation_id, after_position, max_tokens),
+            fetch="all",
+        )
+        if rows:
+            first_position, token_count = rows[0][2], rows[0][3]
+        else:
+            first_position = max(
+                self.get_next_position(conversation_id), after_position + 1
+            )
+            token_count = 0
+        context = [{"role": role, "content": content} for role, content, _, _ in rows]
+        return context, first_position, token_count
+
+    def get_conversation_attributes(self, conversation_id):
         query = """
             SELECT id, title, tags, last_updated
             FROM conversations
@@ -168,13 +884,142 @@ class LocalDatabase:
             }
         return None
 
-    def _get_max_conversation_id(self):
+    def get_candidate(self, candidate_id):
+        result = self._query_db(
+            f"SELECT {', '.join(CANDIDATE_COLUMNS)} FROM candidates WHERE id = ?",
+            (candidate_id,),
+            fetch="one",
+        )
+        return None if result is None else dict(zip(CANDIDATE_COLUMNS, result))
+
+    def get_conversation_messages(self, conversation_id):
+        """
+        Get every message of a conversation as (conversation_position, role,
+        content, token_count) tuples, ordered by position.
+        """
+        return self._query_db(
+            """
+                SELECT conversation_position, role, content, token_count
+                FROM messages
+                WHERE conversation_id = ?
+                ORDER BY conversation_position
+            """,
+            (conversation_id,),
+            fetch="all",
+        )
+
+    def get_first_message(self, conversation_id):
+        result = self._query_db(
+            """
+                SELECT role, content
+                FROM messages
+                WHERE conversation_id = ?
+                ORDER BY conversation_position
+                LIMIT 1
+            """,
+            (conversation_id,),
+            fetch="one",
+        )
+        return None if result is None else {"role": result[0], "content": result[1]}
+
+    def get_max_conversation_id(self):
         result = self._query_db("SELECT MAX(id) FROM conversations", fetch="one")
         return result[0] if result[0] is not None else 0
 
+    def get_next_position(self, conversation_id):
+        result = self._query_db(
+            """
+            SELECT last_position
+            FROM conversations
+            WHERE id = ?
+        """,
+            (conversation_id,),
+            fetch="one",
+        )
+        if result is None or result[0] is None:
+            return 0
+        return result[0] + 1
+
+    def get_pending_titles(self):
+        """
+        Get the ids of conversations whose title is a placeholder.
+        """
+        result = self._query_db(
+            "SELECT id FROM conversations WHERE title_pending = 1 ORDER BY id",
+            fetch="all",
+        )
+        return [row[0] for row in result]
+
+    def get_summary(self, conversation_id):
+        """
+        Get the summary covering the most history of a conversation, if any.
+        """
+        result = self._query_db(
+            """
+            SELECT first_position, last_position, content, token_count
+            FROM summaries
+            WHERE conversation_id = ?
+            ORDER BY last_position DESC
+            LIMIT 1
+        """,
+            (conversation_id,),
+            fetch="one",
+        )
+        if result:
+            return {
+                "first_position": result[0],
+                "last_position": result[1],
+                "content": result[2],
+                "token_count": result[3],
+            }
+        return None
+
+    def _iter_df(self, query, params, columns, chunk_size):
+        """
+        Step through a query's results, yielding DataFrames of at most
+        chunk_size rows, so only one chunk is held in memory at a time.
+        """
+        import pandas as pd
+
+        cur = self.connections.get().execute(query, params)
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield pd.DataFrame(rows, columns=columns)
+        finally:
+            cur.close()
+
+    def _messages_query(self, where, predicate_sql=None, after_id=None):
+        query = """
+            SELECT
+                id,
+                role,
+                content,
+                conversation_id,
+                conversation_position,
+                token_count
+            FROM messages
+            WHERE id > ?
+        """
+        conditions, params = where.compile(self.DIALECT)
+        for condition in conditions:
+            query += f" AND {condition}"
+        if predicate_sql is not None:
+            query += f" AND ({predicate_sql})"
+        query += " ORDER BY id"
+        return query, (-1 if after_id is None else int(after_id), *params)
+
+    def _query_df(self, query, params, columns):
+        import pandas as pd
+
+        data = self._query_db(query, params, fetch="all")
+        return pd.DataFrame(data, columns=columns)
+
     def _query_db(self, query, params=None, fetch=None):
-        conn = sqlite3.connect(self.db_file)
-        cur = conn.cursor()
+        started = time.perf_counter()
+        cur = self.connections.get().cursor()
         if params:
             cur.execute(query, params)
         else:
@@ -183,23 +1028,40 @@ class LocalDatabase:
             data = cur.fetchall()
         elif fetch == "one":
             data = cur.fetchone()
-        conn.commit()
-        conn.close()
+        cur.close()
+        metrics.observe("db_query", time.perf_counter() - started)
         if fetch in ("all", "one"):
             return data
 
-    def _put_conversation(self, conversation_id):
+    def choose_candidate(self, candidate_id):
+        self._query_db("UPDATE candidates SET chosen = 1 WHERE id = ?", (candidate_id,))
+
+    def put_candidate(self, candidate):
+        """
+        :param candidate: A dictionary with the CANDIDATE_COLUMNS but id and chosen.
+        :return: The id of the new candidate.
+        """
+        columns = [c for c in CANDIDATE_COLUMNS if c not in ("id", "chosen")]
+        with self.transaction() as conn:
+            cur = conn.execute(
+                f"""
+                INSERT INTO candidates ({", ".join(columns)})
+                VALUES ({", ".join("?" * len(columns))})
+            """,
+                [candidate.get(column) for column in columns],
+            )
+            return cur.lastrowid
+
+    def put_conversation(self, conversation_id):
         self._query_db(
             """
-            INSERT INTO conversations (id)
+            INSERT OR IGNORE INTO conversations (id)
             VALUES (?)
         """,
             (conversation_id,),
         )
 
-    def _put_message(
-        self, message, conversation_id, conversation_position, token_count
-    ):
+    def put_message(self, message, conversation_id, conversation_position, token_count):
         self._query_db(
             """
             INSERT INTO messages (
@@ -207,9 +1069,10 @@ class LocalDatabase:
                 content,
                 conversation_id,
                 conversation_position,
-                token_count
+                token_count,
+                created_at
             )
-            VALUES (?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, datetime('now'))
         """,
             (
                 message["role"],
@@ -220,16 +1083,138 @@ class LocalDatabase:
             ),
         )
 
-    def _update_conversation(self, conversation_id):
+    def put_messages(self, rows):
+        """
+        Insert many messages with a single executemany in one transaction.
+
+        :param rows:
+            An iterable of (message, conversation_id, conversation_position,
+            token_count) tuples, matching the arguments of put_message.
+        """
+        with self.transaction() as conn:
+            conn.executemany(
+                """
+                INSERT INTO messages (
+                    role,
+                    content,
+                    conversation_id,
+                    conversation_position,
+                    token_count,
+                    created_at
+                )
+                VALUES (?, ?, ?, ?, ?, datetime('now'))
+            """,
+                (
+                    (
+                        message["role"],
+                        message["content"],
+                        conversation_id,
+                        conversation_position,
+                        token_count,
+                    )
+                    for (
+                        message,
+                        conversation_id,
+                        conversation_position,
+                        token_count,
+                    ) in rows
+                ),
+            )
+
+    def put_summary(
+        self, conversation_id, first_position, last_position, content, token_count
+    ):
+        """
+        Store a summary of a conversation's messages from first_position to
+        last_position, replacing the summaries it supersedes.
+        """
+        with self.transaction():
+            self._query_db(
+                "DELETE FROM summaries WHERE conversation_id = ?",
+                (conversation_id,),
+            )
+            self._query_db(
+                """
+                INSERT INTO summaries (
+                    conversation_id,
+                    first_position,
+                    last_position,
+                    content,
+                    token_count
+                )
+                VALUES (?, ?, ?, ?, ?)
+            """,
+                (conversation_id, first_position, last_position, content, token_count),
+            )
+
+    def put_turn_metrics(self, conversation_id, turn):
+        row = turn.as_row()
+        columns = ["conversation_id"] + list(row)
+        self._query_db(
+            f"""
+            INSERT INTO turn_metrics ({", ".join(columns)})
+            VALUES ({", ".join("?" * len(columns))})
+        """,
+            (conversation_id, *row.values()),
+        )
+
+    def replace_pending_title(self, conversation_id, title):
+        """
+        Set a generated title, unless the placeholder has been replaced since.
+        """
+        self._query_db(
+            """
+            UPDATE conversations
+            SET title = ?, title_pending = 0
+            WHERE id = ? AND title_pending = 1
+        """,
+            (title, conversation_id),
+        )
+
+    def update_conversation(self, conversation_id):
         self._query_db(
             "UPDATE conversations SET last_updated = datetime('now') WHERE id = ?",
             (conversation_id,),
         )
 
-    def update_conversation_title(self, conversation_id, title):
+    def update_conversation_title(self, conversation_id, title, pending=False):
+        """
+        :param pending:
+            Whether title is a placeholder to be replaced by a generated one.
+        """
         query = """
             UPDATE conversations
-            SET title = ?
+            SET title = ?, title_pending = ?
             WHERE id = ?
         """
-        self._query_db(query, (title, conversation_id))
+        self._query_db(query, (title, int(pending), conversation_id))
+
+
+def _conversation_columns(stats):
+    return CONVERSATION_COLUMNS + (CONVERSATION_STAT_COLUMNS if stats else [])
+
+
+def _sort_column(sort):
+    try:
+        return CONVERSATION_SORTS[sort]
+    except KeyError:
+        raise ValueError(
+            f"Unknown sort {sort!r}. Must be one of {', '.join(CONVERSATION_SORTS)}."
+        ) from None
+
+
+def _fts_query(search_string):
+    """
+    Turn a search string into an FTS5 query matching all of its terms, each
+    quoted as an FTS5 string so punctuation such as ``don't`` or ``C++`` is
+    searched for rather than parsed. ``"exact phrase"`` and ``prefix*`` keep
+    their meaning.
+    """
+    terms = []
+    for phrase, term in re.findall(r'"([^"]*)"|(\S+)', search_string):
+        prefix = not phrase and len(term) > 1 and term.endswith("*")
+        if prefix:
+            term = term[:-1]
+        text = phrase or term
+        terms.append('"' + text.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
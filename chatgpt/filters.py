@@ -0,0 +1,110 @@
+import json
+import warnings
+from datetime import datetime, timezone
+
+
+class MessageFilter:
+    """
+    Select messages by conversation, role, position, creation time and token
+    count. Criteria left as None match every message; bounds are inclusive.
+
+    A filter compiles to conditions with bound parameters whose text depends
+    only on which criteria are set, not on their values, so repeating a query
+    with other values reuses the statement already prepared for it.
+
+    :param conversation_ids: The conversations to include.
+    :param roles: The roles to include, e.g. ["user", "assistant"].
+    :param created_after:
+        A datetime, or a "YYYY-MM-DD HH:MM:SS" string in UTC. Messages
+        written before created_at was recorded never match a date bound.
+    """
+
+    def __init__(
+        self,
+        conversation_ids=None,
+        roles=None,
+        min_position=None,
+        max_position=None,
+        created_after=None,
+        created_before=None,
+        min_tokens=None,
+        max_tokens=None,
+    ):
+        self.conversation_ids = conversation_ids
+        self.roles = roles
+        self.min_position = min_position
+        self.max_position = max_position
+        self.created_after = created_after
+        self.created_before = created_before
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+
+    def __repr__(self):
+        criteria = ", ".join(
+            f"{name}={value!r}"
+            for name, value in vars(self).items()
+            if value is not None
+        )
+        return f"MessageFilter({criteria})"
+
+    def compile(self, dialect="sqlite"):
+        """
+        :param dialect: "sqlite" or "postgres".
+        :return: A list of SQL conditions on messages, and their parameters.
+        """
+        placeholder = "?" if dialect == "sqlite" else "%s"
+        conditions = []
+        params = []
+        for column, values, array_type in (
+            ("conversation_id", self.conversation_ids, "BIGINT"),
+            ("role", self.roles, "TEXT"),
+        ):
+            if values is None:
+                continue
+            # One parameter however many values, so the statement is shared.
+            if dialect == "sqlite":
+                conditions.append(f"{column} IN (SELECT value FROM json_each(?))")
+                params.append(json.dumps(list(values)))
+            else:
+                conditions.append(f"{column} = ANY(%s::{array_type}[])")
+                params.append(list(values))
+        for column, operator, value in (
+            ("conversation_position", ">=", self.min_position),
+            ("conversation_position", "<=", self.max_position),
+            ("created_at", ">=", self.created_after),
+            ("created_at", "<=", self.created_before),
+            ("token_count", ">=", self.min_tokens),
+            ("token_count", "<=", self.max_tokens),
+        ):
+            if value is None:
+                continue
+            if column == "created_at" and dialect == "sqlite":
+                value = _sqlite_datetime(value)
+            conditions.append(f"{column} {operator} {placeholder}")
+            params.append(value)
+        return conditions, params
+
+
+def _sqlite_datetime(value):
+    # SQLite compares created_at as text written by datetime('now').
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def resolve_filter(where=None, predicate_sql=None):
+    """
+    Split the where argument of get_messages and iter_messages into a
+    MessageFilter and the raw SQL that older callers pass instead.
+    """
+    if isinstance(where, str):
+        where, predicate_sql = None, where
+    if predicate_sql is not None:
+        warnings.warn(
+            "Filtering messages with raw SQL is deprecated; pass a MessageFilter.",
+            DeprecationWarning,
+            stacklevel=3,
+        )
+    return where or MessageFilter(), predicate_sql
@@ -0,0 +1,251 @@
+import threading
+import time
+from contextlib import contextmanager
+from .tokens import DEFAULT_MODEL
+
+# US dollars per 1,000 prompt and completion tokens.
+PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def get_price(model=DEFAULT_MODEL):
+    """
+    Look up the prompt and completion prices of a model, matching dated
+    snapshots by their longest known prefix.
+    """
+    for name in sorted(PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            return PRICES[name]
+    return PRICES[DEFAULT_MODEL]
+
+
+def get_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = get_price(model)
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def cost_sql(prices):
+    """
+    A SQL expression computing the cost of a turn_metrics row like get_cost,
+    for migrations backfilling the costs they start storing.
+
+    :param prices:
+        A price table like PRICES, frozen as it stood when the migration was
+        written, so that the migration backfills the same costs whenever it
+        runs.
+    """
+
+    def cost(prices):
+        prompt_price, completion_price = prices
+        return (
+            f"(COALESCE(prompt_tokens, 0) * {prompt_price}"
+            f" + COALESCE(completion_tokens, 0) * {completion_price}) / 1000"
+        )
+
+    cases = " ".join(
+        f"WHEN model LIKE '{name}%' THEN {cost(prices[name])}"
+        for name in sorted(prices, key=len, reverse=True)
+    )
+    return f"CASE {cases} ELSE {cost(prices[DEFAULT_MODEL])} END"
+
+
+class Metrics:
+    """
+    In-memory latency histograms and counters for this process.
+
+    Histograms are keyed by stage, e.g. "db_query" or "completion", and the
+    whole registry can be exported in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = [[0] * len(BUCKETS), 0.0, 0]
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def snapshot(self):
+        """
+        :return:
+            A dictionary with the count and total seconds of every stage, and
+            the value of every counter.
+        """
+        with self._lock:
+            return {
+                "stages": {
+                    stage: {"count": count, "seconds": total}
+                    for stage, (_, total, count) in self._histograms.items()
+                },
+                "counters": dict(self._counters),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def prometheus(self):
+        lines = [
+            "# HELP chatgpt_stage_seconds Time spent in each stage of a turn.",
+            "# TYPE chatgpt_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, (buckets, total, count) in sorted(self._histograms.items()):
+                for bound, bucket in zip(BUCKETS, buckets):
+                    lines.append(
+                        f'chatgpt_stage_seconds_bucket{{stage="{stage}",le="{bound}"}}'
+                        f" {bucket}"
+                    )
+                lines.append(
+                    f'chatgpt_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}'
+                )
+                lines.append(f'chatgpt_stage_seconds_sum{{stage="{stage}"}} {total}')
+                lines.append(f'chatgpt_stage_seconds_count{{stage="{stage}"}} {count}')
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"# TYPE chatgpt_{name}_total counter")
+                lines.append(f"chatgpt_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+# The registry shared by every Chatbot and database in this process.
+metrics = Metrics()
+
+
+def stage_timer(stage, turn=None):
+    """
+    Time a stage of the given turn, or only in the registry without one.
+    """
+    return metrics.timer(stage) if turn is None else turn.time(stage)
+
+
+class TurnMetrics:
+    """
+    Durations, token counts and cache use of a single turn.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.cache_hit = False
+
+    @contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.durations[stage] = self.durations.get(stage, 0.0) + elapsed
+            metrics.observe(stage, elapsed)
+
+    def mark(self, stage):
+        """
+        Record the time since the turn started, e.g. for the first token.
+        """
+        elapsed = time.perf_counter() - self.started
+        self.durations[stage] = elapsed
+        metrics.observe(stage, elapsed)
+
+    def mark_first_token(self):
+        if "first_token" not in self.durations:
+            self.mark("first_token")
+
+    def record_usage(self, usage):
+        """
+        :param usage: The usage field of a completion response, if any.
+        """
+        if usage:
+            self.prompt_tokens = usage.get("prompt_tokens")
+            self.completion_tokens = usage.get("completion_tokens")
+
+    def finish(self, prompt_tokens, completion_tokens):
+        """
+        Close the turn, using the given token counts where the API reported
+        no usage.
+        """
+        self.mark("turn")
+        if self.prompt_tokens is None:
+            self.prompt_tokens = prompt_tokens
+        if self.completion_tokens is None:
+            self.completion_tokens = completion_tokens
+        metrics.increment("prompt_tokens", self.prompt_tokens)
+        metrics.increment("completion_tokens", self.completion_tokens)
+        metrics.increment("turns")
+
+    def as_row(self):
+        return {
+            "model": self.model,
+            "turn_seconds": self.durations.get("turn"),
+            "context_seconds": self.durations.get("context"),
+            "completion_seconds": self.durations.get("completion"),
+            "first_token_seconds": self.durations.get("first_token"),
+            "save_seconds": self.durations.get("save"),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hit": int(self.cache_hit),
+            "cost": get_cost(
+                self.model, self.prompt_tokens or 0, self.completion_tokens or 0
+            ),
+        }
+
+
+def summarize_turns(turns):
+    """
+    Summarise turn metrics per conversation.
+
+    :param turns: A DataFrame as returned by LocalDatabase.get_turn_metrics.
+    :return:
+        A DataFrame indexed by conversation_id with the number of turns, the
+        tokens used, the cost in US dollars stored with each turn, at the
+        prices of its time, and latency percentiles.
+    """
+    import pandas as pd
+
+    # Columns that are NULL throughout come back as objects.
+    turns = turns.astype(
+        {"turn_seconds": float, "first_token_seconds": float, "cost": float}
+    )
+    grouped = turns.groupby("conversation_id")
+    return pd.DataFrame(
+        {
+            "turns": grouped.size(),
+            "prompt_tokens": grouped["prompt_tokens"].sum(),
+            "completion_tokens": grouped["completion_tokens"].sum(),
+            "cost": grouped["cost"].sum(),
+            "cache_hits": grouped["cache_hit"].sum(),
+            "turn_p50": grouped["turn_seconds"].quantile(0.5),
+            "turn_p95": grouped["turn_seconds"].quantile(0.95),
+            "first_token_p50": grouped["first_token_seconds"].quantile(0.5),
+        }
+    )
@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+# Lower values are admitted first.
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+# The default limits, those of a pay-as-you-go gpt-3.5-turbo account. The
+# CHATGPT_REQUESTS_PER_MINUTE and CHATGPT_TOKENS_PER_MINUTE variables
+# override them, and 0 or "off" turns a limit off.
+REQUESTS_PER_MINUTE = 3500
+TOKENS_PER_MINUTE = 90000
+
+# Completion tokens charged up front for a request, where max_tokens is only
+# the worst case. The charge is corrected once the API reports the usage.
+EXPECTED_COMPLETION_TOKENS = 256
+
+# Seconds between the checks of a coroutine waiting for admission. Threads
+# are woken as the queue moves, but the event loop can't be.
+POLL_INTERVAL = 0.01
+
+
+class TokenBucket:
+    """
+    A bucket holding up to one minute's worth of a rate limit, refilled
+    continuously. A bucket without a limit never makes anyone wait.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = None if per_minute is None else per_minute / 60
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until amount can be taken. Requests larger than the bucket
+        only wait for it to fill up.
+        """
+        if self.capacity is None:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level - amount)
+
+
+class RequestScheduler:
+    """
+    Admit completion calls under requests- and tokens-per-minute budgets.
+
+    Callers wait in a priority queue until both token buckets can cover the
+    request, so user turns go ahead of background work such as titles and
+    summaries. Rate limit and transient errors are retried with jittered
+    exponential backoff, honouring any Retry-After header.
+
+    :param requests_per_minute: The request limit, or None for no limit.
+    :param tokens_per_minute: The token limit, or None for no limit.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+        max_retries=6,
+        base_delay=1.0,
+        max_delay=60.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._condition = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._metrics = {
+            "admitted": 0,
+            "retries": 0,
+            "failures": 0,
+            "max_queue_depth": 0,
+            "total_wait_time": 0.0,
+            "max_wait_time": 0.0,
+        }
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """
+        A scheduler with the limits set by CHATGPT_REQUESTS_PER_MINUTE and
+        CHATGPT_TOKENS_PER_MINUTE, where 0 or "off" turns a limit off.
+        """
+        for name, variable, default in (
+            ("requests_per_minute", "CHATGPT_REQUESTS_PER_MINUTE", REQUESTS_PER_MINUTE),
+            ("tokens_per_minute", "CHATGPT_TOKENS_PER_MINUTE", TOKENS_PER_MINUTE),
+        ):
+            value = os.getenv(variable, "").strip().lower()
+            if not value:
+                kwargs.setdefault(name, default)
+            elif value in ("0", "off"):
+                kwargs.setdefault(name, None)
+            else:
+                kwargs.setdefault(name, int(value))
+        return cls(**kwargs)
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def metrics(self):
+        with self._condition:
+            metrics = dict(self._metrics, queue_depth=len(self._queue))
+        admitted = metrics["admitted"]
+        metrics["mean_wait_time"] = (
+            metrics["total_wait_time"] / admitted if admitted else 0.0
+        )
+        return metrics
+
+    def submit(self, fn, tokens=0, priority=PRIORITY_USER):
+        """
+        Call fn once admitted, retrying it on rate limit and transient errors.
+
+        :param fn: A function making one completion call.
+        :param tokens: The estimated number of tokens the call will use.
+        :param priority: PRIORITY_USER or PRIORITY_BACKGROUND.
+        """
+        for attempt in range(self.max_retries + 1):
+            self._admit(tokens, priority)
+            try:
+                return fn()
+            except self._retryable_errors() as error:
+                time.sleep(self._retry_delay(attempt, error))
+
+    async def asubmit(self, fn, tokens=0, priority=PRIORITY_USER):
+        """
+        Like submit, for a coroutine function fn, waiting for admission on the
+        event loop rather than in a thread. A call cancelled before it
+        completes gives its tokens back.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._aadmit(tokens, priority)
+            try:
+                return await fn()
+            except self._retryable_errors() as error:
+                await asyncio.sleep(self._retry_delay(attempt, error))
+            except asyncio.CancelledError:
+                self.reconcile(tokens, 0)
+                raise
+
+    def reconcile(self, charged, used):
+        """
+        Correct the tokens charged for an admitted request once the API has
+        reported what it actually used, refunding or charging the difference.
+        """
+        with self._condition:
+            self.tokens.consume(used - charged)
+            self._condition.notify_all()
+
+    def _admit(self, tokens, priority):
+        entry = self._enqueue(priority)
+        with self._condition:
+            wait = self._poll(entry, tokens)
+            while wait != 0:
+                self._condition.wait(wait)
+                wait = self._poll(entry, tokens)
+
+    async def _aadmit(self, tokens, priority):
+        entry = self._enqueue(priority)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._poll(entry, tokens)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait or POLL_INTERVAL, POLL_INTERVAL))
+        except asyncio.CancelledError:
+            with self._condition:
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                self._condition.notify_all()
+            raise
+
+    def _enqueue(self, priority):
+        entry = (priority, next(self._counter), time.monotonic())
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+            self._metrics["max_queue_depth"] = max(
+                self._metrics["max_queue_depth"], len(self._queue)
+            )
+        return entry
+
+    def _poll(self, entry, tokens):
+        """
+        Admit entry if it heads the queue and both buckets can cover it. Must
+        be called holding the condition.
+
+        :return:
+            0 once admitted, otherwise the seconds until the buckets can cover
+            it, or None while other entries are ahead of it.
+        """
+        if self._queue[0] != entry:
+            return None
+        now = time.monotonic()
+        wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+        if wait > 0:
+            return wait
+        heapq.heappop(self._queue)
+        self.requests.consume(1)
+        self.tokens.consume(tokens)
+        waited = now - entry[2]
+        self._metrics["admitted"] += 1
+        self._metrics["total_wait_time"] += waited
+        self._metrics["max_wait_time"] = max(self._metrics["max_wait_time"], waited)
+        self._condition.notify_all()
+        return 0
+
+    def _retry_delay(self, attempt, error):
+        with self._condition:
+            if attempt == self.max_retries:
+                self._metrics["failures"] += 1
+                raise error
+            self._metrics["retries"] += 1
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        delay = random.uniform(delay / 2, delay)
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        if retry_after is not None:
+            delay = max(delay, float(retry_after))
+        return delay
+
+    @staticmethod
+    def _retryable_errors():
+        import openai
+
+        return (
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.APIConnectionError,
+            openai.error.Timeout,
+            openai.error.TryAgain,
+        )
+
+
+default_scheduler = RequestScheduler.from_env()
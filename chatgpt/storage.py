@@ -0,0 +1,243 @@
+"""
+The interface every storage backend of the chat history implements.
+
+LocalDatabase keeps the history in a SQLite file, for a single user or a
+single host. PostgresDatabase keeps it in a PostgreSQL server, so several app
+workers and hosts can share it. Chatbot, AsyncChatbot, TitleWorker and the
+apps only use the methods of StorageBackend, so either can be passed as their
+``database``.
+"""
+
+import os
+from typing import Protocol, runtime_checkable
+
+POSTGRES_SCHEMES = ("postgres://", "postgresql://")
+
+
+@runtime_checkable
+class StorageBackend(Protocol):
+    """
+    Messages are dictionaries with "role" and "content" keys. Methods that
+    return many rows return pandas DataFrames, or iterators of them.
+    """
+
+    # "sqlite" or "postgres": the SQL dialect of the backend's tables, which
+    # MessageFilter and chatgpt.analytics compile their queries to.
+    DIALECT: str
+
+    def close(self):
+        """
+        Close every connection. The backend reconnects on its next use.
+        """
+
+    def transaction(self):
+        """
+        A context manager running the enclosed calls as one atomic
+        transaction. Nested calls join the outermost transaction.
+        """
+
+    def snapshot(self):
+        """
+        A context manager running the enclosed reads against one consistent
+        snapshot of the database, without holding up writers.
+        """
+
+    def bulk_insert(self):
+        """
+        A context manager running the enclosed inserts in one transaction,
+        yielding a function insert(table, columns, rows) that appends rows,
+        tuples of the values of columns, to a table.
+        """
+
+    def delete_message(self, message_id):
+        ...
+
+    def delete_conversation(self, conversation_id):
+        ...
+
+    def delete_empty_conversations(self, exclude=(), min_age=0):
+        """
+        :return: The number of untitled, empty conversations deleted.
+        """
+
+    def get_message(self, message_id):
+        """
+        :return: A dictionary of the MESSAGE_COLUMNS, or None.
+        """
+
+    def export_history(self, directory, format="parquet", **kwargs):
+        """
+        :return: The number of rows written per table.
+        """
+
+    def find_message(self, search_string, full_text=False, limit=None, offset=0):
+        ...
+
+    def import_history(self, directory, format="parquet", **kwargs):
+        """
+        :return:
+            The number of rows imported per table, and the offset added to the
+            conversation ids.
+        """
+
+    def iter_find_message(self, search_string, full_text=False, chunk_size=1000):
+        ...
+
+    def get_messages(self, where=None, limit=None, after_id=None, predicate_sql=None):
+        """
+        :param where: A MessageFilter.
+        """
+
+    def iter_messages(self, where=None, chunk_size=1000, predicate_sql=None):
+        ...
+
+    def get_candidates(self, conversation_id=None):
+        ...
+
+    def get_turn_metrics(self, conversation_id=None):
+        ...
+
+    def read_query(self, query, params=(), columns=None):
+        """
+        Run a read-only query written in the backend's DIALECT, with its
+        placeholders, as chatgpt.analytics does for its reports.
+
+        :return: The rows as a DataFrame with the given column names.
+        """
+
+    def list_conversations(
+        self, limit=None, offset=0, sort="last_updated", stats=False
+    ):
+        """
+        :param sort: One of CONVERSATION_SORTS.
+        :param stats:
+            Add the CONVERSATION_STAT_COLUMNS, which are maintained as
+            messages and turns are written rather than counted.
+        """
+
+    def iter_conversations(self, chunk_size=1000):
+        ...
+
+    def update_conversation_title(self, conversation_id, title, pending=False):
+        ...
+
+    def create_tables(self):
+        """
+        Create the schema, or upgrade an existing one in place.
+        """
+
+    def create_conversation(self):
+        """
+        Insert a conversation with the next free id, safely against other
+        sessions doing the same.
+
+        :return: The id of the new conversation.
+        """
+
+    def get_context(self, conversation_id):
+        ...
+
+    def get_context_range(self, conversation_id, first_position, last_position):
+        ...
+
+    def get_context_window(
+        self, conversation_id, max_tokens, message_overhead=0, after_position=-1
+    ):
+        ...
+
+    def get_conversation_attributes(self, conversation_id):
+        ...
+
+    def get_candidate(self, candidate_id):
+        ...
+
+    def get_conversation_messages(self, conversation_id):
+        """
+        :return:
+            Every message of the conversation as (conversation_position,
+            role, content, token_count) tuples, ordered by position.
+        """
+
+    def get_first_message(self, conversation_id):
+        ...
+
+    def get_max_conversation_id(self):
+        ...
+
+    def get_next_position(self, conversation_id):
+        """
+        Within a transaction, this also keeps other sessions from adding to
+        the conversation until it ends.
+        """
+
+    def get_pending_titles(self):
+        ...
+
+    def get_summary(self, conversation_id):
+        ...
+
+    def choose_candidate(self, candidate_id):
+        ...
+
+    def put_candidate(self, candidate):
+        ...
+
+    def put_conversation(self, conversation_id):
+        ...
+
+    def put_message(self, message, conversation_id, conversation_position, token_count):
+        ...
+
+    def put_messages(self, rows):
+        ...
+
+    def put_summary(
+        self, conversation_id, first_position, last_position, content, token_count
+    ):
+        ...
+
+    def put_turn_metrics(self, conversation_id, turn):
+        ...
+
+    def replace_pending_title(self, conversation_id, title):
+        ...
+
+    def update_conversation(self, conversation_id):
+        ...
+
+
+def open_database(database="local", db_path=None, hot_conversations=None):
+    """
+    Open the storage backend a Chatbot or an app was configured with.
+
+    :param database:
+        "local" for a SQLite file at db_path, a postgresql:// URL, or a
+        StorageBackend to use as is.
+    :param hot_conversations:
+        How many conversations of a local database to keep in memory; see
+        CachedDatabase. Every local database opened on the same file shares
+        the cache. Shared databases are never cached, as other hosts write
+        to them too.
+    """
+    if database == "local":
+        from .conversation_cache import HOT_CONVERSATIONS, CachedDatabase
+        from .database import LocalDatabase
+
+        if hot_conversations is None:
+            hot_conversations = HOT_CONVERSATIONS
+        database = LocalDatabase(db_file=db_path)
+        if hot_conversations:
+            store_key = None
+            if database.db_file != ":memory:":
+                store_key = os.path.abspath(database.db_file)
+            database = CachedDatabase(database, hot_conversations, store_key)
+        return database
+    if isinstance(database, str):
+        if database.startswith(POSTGRES_SCHEMES):
+            from .postgres import PostgresDatabase
+
+            return PostgresDatabase(database)
+        raise ValueError(
+            f"Unknown database {database!r}. Must be 'local' or a postgresql:// URL."
+        )
+    return database
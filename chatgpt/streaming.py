@@ -0,0 +1,43 @@
+import time
+
+
+class StreamBuffer:
+    """
+    Collect streamed reply content and decide when to hand it to the reader.
+
+    :param flush:
+        "token" to flush every delta as it arrives, "line" to flush once a
+        delta contains a newline, or a number of milliseconds to wait
+        between flushes.
+    """
+
+    def __init__(self, flush="token"):
+        if flush not in ("token", "line") and not isinstance(flush, (int, float)):
+            raise ValueError(
+                "Invalid flush policy. Must be 'token', 'line' or milliseconds."
+            )
+        self.flush_policy = flush
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def add(self, content):
+        """
+        Buffer a delta, returning the pending text if it is due to be flushed.
+        """
+        self.pending.append(content)
+        if self.flush_policy == "token":
+            due = True
+        elif self.flush_policy == "line":
+            due = "\n" in content
+        else:
+            elapsed = (time.monotonic() - self.last_flush) * 1000
+            due = elapsed >= self.flush_policy
+        if due:
+            return self.flush()
+        return None
+
+    def flush(self):
+        text = "".join(self.pending)
+        self.pending = []
+        self.last_flush = time.monotonic()
+        return text
@@ -0,0 +1,152 @@
+import queue
+import re
+import threading
+
+# Words of the first message kept in a placeholder title.
+HEURISTIC_TITLE_WORDS = 8
+
+# Characters of each first message included in a batched title request.
+TITLE_EXCERPT_LENGTH = 1000
+
+
+def heuristic_title(content):
+    """
+    A placeholder title made from the first words of a message.
+    """
+    words = content.split()
+    title = " ".join(words[:HEURISTIC_TITLE_WORDS])
+    if len(words) > HEURISTIC_TITLE_WORDS:
+        title += "..."
+    return title
+
+
+def batch_title_prompt(messages):
+    """
+    A prompt asking for one numbered title per conversation, given the first
+    message of each.
+    """
+    prompt = (
+        "Can you generate a title for each of these conversations? Reply with "
+        "one line per conversation, in the form <number>: <title>.\n\n"
+    )
+    return prompt + "\n\n".join(
+        f"{number}: {message['content'][:TITLE_EXCERPT_LENGTH]}"
+        for number, message in enumerate(messages, 1)
+    )
+
+
+def parse_titles(content, count):
+    """
+    Read the numbered titles of a batched title request, one per line in the
+    form "<number>: <title>". Missing titles are None.
+    """
+    titles = [None] * count
+    for line in content.splitlines():
+        match = re.match(r"\s*(\d+)\s*[:.)-]\s*(.+)", line)
+        if match and 1 <= int(match.group(1)) <= count:
+            titles[int(match.group(1)) - 1] = match.group(2).strip().strip('"')
+    return titles
+
+
+class TitleWorker:
+    """
+    Generate conversation titles in a background thread.
+
+    Conversations queued within batch_delay seconds of each other are titled
+    together with a single completion, up to batch_size at a time. Until a
+    generated title lands the conversation keeps its placeholder title, which
+    stays marked as pending in the database.
+
+    :param resume_pending:
+        Also queue the conversations left pending by earlier processes when
+        the worker starts. Only one long-lived worker per database should.
+    """
+
+    def __init__(self, database, batch_size=8, batch_delay=0.5, resume_pending=False):
+        self.database = database
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.resume_pending = resume_pending
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, conversation_id, generate_titles):
+        """
+        Queue a conversation to be titled.
+
+        :param generate_titles:
+            A function taking a list of first messages and returning a title,
+            or None, for each.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                if self.resume_pending:
+                    for pending_id in self.database.get_pending_titles():
+                        self._put(pending_id, generate_titles)
+            self._put(conversation_id, generate_titles)
+
+    def join(self):
+        """
+        Block until every queued conversation has been processed.
+        """
+        self._queue.join()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _put(self, conversation_id, generate_titles):
+        if conversation_id not in self._queued:
+            self._queued.add(conversation_id)
+            self._queue.put((conversation_id, generate_titles))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._queue.get(timeout=self.batch_delay)
+                except queue.Empty:
+                    break
+                if job is None:
+                    # Finish the batch at hand, then stop.
+                    self._queue.put(None)
+                    self._queue.task_done()
+                    break
+                batch.append(job)
+            try:
+                self._process(batch)
+            except Exception as e:
+                print(f"Error: {e}")
+            finally:
+                with self._lock:
+                    for conversation_id, _ in batch:
+                        self._queued.discard(conversation_id)
+                        self._queue.task_done()
+
+    def _process(self, batch):
+        conversation_ids = [conversation_id for conversation_id, _ in batch]
+        messages = [self.database.get_first_message(id) for id in conversation_ids]
+        jobs = [
+            (conversation_id, message)
+            for conversation_id, message in zip(conversation_ids, messages)
+            if message is not None
+        ]
+        if not jobs:
+            return
+        generate_titles = batch[0][1]
+        titles = generate_titles([message for _, message in jobs])
+        for (conversation_id, _), title in zip(jobs, titles):
+            if title:
+                self.database.replace_pending_title(conversation_id, title)
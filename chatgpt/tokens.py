@@ -0,0 +1,55 @@
+from functools import lru_cache
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+
+# Tokens the chat format adds around every message, and to prime the reply.
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+
+def get_context_window(model=DEFAULT_MODEL):
+    """
+    Look up the context window of a model, matching dated snapshots such as
+    gpt-4-0613 by their longest known prefix.
+    """
+    for name in sorted(CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(name):
+            return CONTEXT_WINDOWS[name]
+    return CONTEXT_WINDOWS[DEFAULT_MODEL]
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=DEFAULT_MODEL):
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text, model=DEFAULT_MODEL):
+    """
+    Count the tokens in a string, memoising repeated strings.
+
+    Special tokens such as ``<|endoftext|>`` are counted as plain text.
+    """
+    return len(get_encoding(model).encode_ordinary(text))
+
+
+def count_tokens_batch(texts, model=DEFAULT_MODEL, num_threads=8):
+    """
+    Count the tokens in many strings at once, encoding them across threads.
+
+    :param texts: A list of strings.
+    :return: A list of token counts in the same order as texts.
+    """
+    encoded = get_encoding(model).encode_ordinary_batch(
+        list(texts), num_threads=num_threads
+    )
+    return [len(tokens) for tokens in encoded]
@@ -1,4 +1,5 @@
 import os
 
-if "test.db" in os.listdir("."):
-    os.remove("test.db")
+for filename in ("test.db", "test.db-wal", "test.db-shm"):
+    if filename in os.listdir("."):
+        os.remove(filename)
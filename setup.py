@@ -9,4 +9,9 @@ setup(
     url="https://github.com/joshuacook/chatgpt",
     packages=["chatgpt"],
     install_requires=["boto3", "jupyterlab", "openai", "gradio", "tiktoken"],
+    extras_require={
+        "server": ["uvicorn"],
+        "arrow": ["pyarrow"],
+        "postgres": ["psycopg[binary,pool]"],
+    },
 )
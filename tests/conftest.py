@@ -0,0 +1,46 @@
+"""
+The backend fixture runs a test against every storage backend. PostgreSQL is
+only used when CHATGPT_TEST_POSTGRES_DSN names a server to create schemas on.
+"""
+import os
+import uuid
+import pytest
+from chatgpt.conversation_cache import CachedDatabase
+from chatgpt.database import LocalDatabase
+
+POSTGRES_DSN = os.getenv("CHATGPT_TEST_POSTGRES_DSN")
+
+
+def _postgres_backend(request):
+    if POSTGRES_DSN is None:
+        pytest.skip("CHATGPT_TEST_POSTGRES_DSN is not set")
+    psycopg = pytest.importorskip("psycopg")
+    from chatgpt.postgres import PostgresDatabase
+
+    # Every test gets a schema of its own, dropped afterwards.
+    schema = f"test_{uuid.uuid4().hex}"
+    with psycopg.connect(POSTGRES_DSN, autocommit=True) as conn:
+        conn.execute(f"CREATE SCHEMA {schema}")
+
+    def drop_schema():
+        with psycopg.connect(POSTGRES_DSN, autocommit=True) as conn:
+            conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+    request.addfinalizer(drop_schema)
+    return PostgresDatabase(
+        psycopg.conninfo.make_conninfo(POSTGRES_DSN, options=f"-csearch_path={schema}")
+    )
+
+
+@pytest.fixture(params=["local", "cached", "postgres"])
+def backend(request, tmp_path):
+    if request.param == "local":
+        db = LocalDatabase(db_file=str(tmp_path / "chat.db"))
+    elif request.param == "cached":
+        db = CachedDatabase(LocalDatabase(db_file=str(tmp_path / "chat.db")))
+    else:
+        db = _postgres_backend(request)
+    db.create_tables()
+    yield db
+
+    db.close()
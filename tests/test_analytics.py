@@ -0,0 +1,74 @@
+import json
+import pandas as pd
+import pytest
+from chatgpt import analytics
+from chatgpt.filters import MessageFilter
+
+
+@pytest.fixture
+def history(backend):
+    for conversation_id, token_counts in ((1, [10, 20, 30, 40]), (2, [5, 5])):
+        backend.put_conversation(conversation_id)
+        backend.put_messages(
+            (
+                {"role": ("user", "assistant")[i % 2], "content": f"Message {i}"},
+                conversation_id,
+                i,
+                token_count,
+            )
+            for i, token_count in enumerate(token_counts)
+        )
+    for message_id, created_at in (
+        (1, "2024-01-01"),
+        (2, "2024-01-01"),
+        (3, "2024-01-03"),
+    ):
+        backend._query_db(
+            f"UPDATE messages SET created_at = '{created_at} 10:00:00+00:00' "
+            f"WHERE id = {message_id}"
+        )
+    return backend
+
+
+def test_token_usage(history):
+    usage = analytics.token_usage(history)
+    assert usage.loc[pd.Timestamp("2024-01-01")].tolist() == [2, 30]
+    assert usage.loc[pd.Timestamp("2024-01-03")].tolist() == [1, 30]
+    assert usage["messages"].sum() == 6
+
+    weekly = analytics.token_usage(history, "week")
+    assert weekly.loc[pd.Timestamp("2024-01-01")].tolist() == [3, 60]
+    users = analytics.token_usage(history, where=MessageFilter(roles=["user"]))
+    assert users["tokens"].sum() == 45
+    with pytest.raises(ValueError):
+        analytics.token_usage(history, "fortnight")
+
+
+def test_role_tokens(history):
+    roles = analytics.role_tokens(history)
+    assert roles.index.tolist() == ["assistant", "user"]
+    assert roles.loc["user"].tolist() == [3, 45, 15, 5, 30, 10, 30, 30]
+    assert roles.loc["assistant", "p50"] == 20
+
+
+def test_conversation_lengths(history):
+    lengths = analytics.conversation_lengths(history, bins=[0, 3, 10])
+    assert lengths["conversations"].tolist() == [1, 1]
+    by_tokens = analytics.conversation_lengths(history, bins=[0, 50, 200], by="tokens")
+    assert by_tokens["conversations"].tolist() == [1, 1]
+    with pytest.raises(ValueError):
+        analytics.conversation_lengths(history, by="last_updated")
+
+
+def test_report_json(history):
+    reports = analytics.report_json(analytics.report(history, top=1))
+    assert set(reports) == {
+        "token_usage",
+        "role_tokens",
+        "conversation_lengths",
+        "top_conversations",
+    }
+    assert reports["token_usage"][0]["period"].startswith("2024-01-01")
+    assert reports["role_tokens"][1]["role"] == "user"
+    assert [c["id"] for c in reports["top_conversations"]] == [1]
+    json.dumps(reports)
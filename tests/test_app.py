@@ -0,0 +1,58 @@
+import json
+import unittest.mock as mock
+import openai
+import pytest
+from chatgpt.database import LocalDatabase
+
+pytest.importorskip("flask")
+
+
+class StubTitleWorker:
+    def submit(self, conversation_id, generate_titles):
+        pass
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    from chatgpt import app
+
+    database = LocalDatabase(db_file=str(tmp_path / "chat.db"))
+    database.create_tables()
+    monkeypatch.setattr(app, "database", database)
+    monkeypatch.setattr(app, "title_worker", StubTitleWorker())
+    yield app
+
+    database.close()
+
+
+def parse_events(content):
+    events = []
+    for event in content.decode().strip().split("\n\n"):
+        name, data = "message", None
+        for line in event.split("\n"):
+            if line.startswith("event: "):
+                name = line[7:]
+            elif line.startswith("data: "):
+                data = json.loads(line[6:])
+        events.append((name, data))
+    return events
+
+
+def test_chat_reports_upstream_errors(app):
+    def chunks():
+        yield {"choices": [{"delta": {"content": "Partial "}}]}
+        raise openai.error.APIError("Upstream went away")
+
+    with mock.patch.object(openai.ChatCompletion, "create", return_value=chunks()):
+        response = app.app.test_client().post(
+            "/api/chat", json={"prompt": "Hello", "conversation_id": 7}
+        )
+        content = response.get_data()
+
+    assert response.status_code == 200
+    assert parse_events(content) == [
+        ("conversation", {"conversation_id": 7}),
+        ("message", {"response": "Partial "}),
+        ("error", {"error": "Upstream went away"}),
+    ]
+    assert app.database.get_context(7) == []
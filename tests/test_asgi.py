@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import unittest.mock as mock
+import openai
+import pytest
+from chatgpt.asgi import ChatApplication
+
+
+def mock_openai_title():
+    return {"choices": [{"message": {"role": "assistant", "content": "A title"}}]}
+
+
+async def mock_openai_acreate(**kwargs):
+    async def chunks():
+        for content in ["This ", "is ", "streamed."]:
+            yield {"choices": [{"delta": {"content": content}}]}
+
+    if kwargs["stream"]:
+        return chunks()
+    return mock_openai_title()
+
+
+async def request(app, method, path, body=b""):
+    messages = []
+    done = asyncio.Event()
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and not message.get(
+            "more_body", False
+        ):
+            done.set()
+
+    await app({"type": "http", "method": method, "path": path}, receive, send)
+    status = messages[0]["status"]
+    content = b"".join(message.get("body", b"") for message in messages[1:])
+    return status, content
+
+
+def parse_events(content):
+    events = []
+    for event in content.decode().strip().split("\n\n"):
+        name, data = "message", None
+        for line in event.split("\n"):
+            if line.startswith("event: "):
+                name = line[7:]
+            elif line.startswith("data: "):
+                data = json.loads(line[6:])
+        events.append((name, data))
+    return events
+
+
+@pytest.fixture
+def app():
+    app = ChatApplication(db_path="test.db")
+    yield app
+
+    app.title_worker.close()
+    app.database.close()
+    for filename in ("test.db", "test.db-wal", "test.db-shm"):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def test_index(app):
+    status, content = asyncio.run(request(app, "GET", "/"))
+    assert status == 200
+    assert b"<title>Chatbot</title>" in content
+
+
+def test_chat_streams_server_sent_events(app):
+    with mock.patch.object(
+        openai.ChatCompletion, "acreate", side_effect=mock_openai_acreate
+    ), mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_title()
+    ):
+        body = json.dumps({"prompt": "Hello", "conversation_id": 7}).encode()
+        status, content = asyncio.run(request(app, "POST", "/api/chat", body))
+        assert app.database.get_conversation_attributes(7)["title"] == "Hello"
+        app.title_worker.join()
+
+    assert status == 200
+    assert parse_events(content) == [
+        ("conversation", {"conversation_id": 7}),
+        ("message", {"response": "This "}),
+        ("message", {"response": "is "}),
+        ("message", {"response": "streamed."}),
+    ]
+    assert 7 in app.sessions
+    assert app.database.get_conversation_attributes(7)["title"] == "A title"
+    assert app.database.get_context(7) == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "This is streamed."},
+    ]
+
+
+def test_chat_reports_upstream_errors(app):
+    async def failing_acreate(**kwargs):
+        async def chunks():
+            yield {"choices": [{"delta": {"content": "Partial "}}]}
+            raise openai.error.APIError("Upstream went away")
+
+        return chunks()
+
+    with mock.patch.object(
+        openai.ChatCompletion, "acreate", side_effect=failing_acreate
+    ):
+        body = json.dumps({"prompt": "Hello", "conversation_id": 7}).encode()
+        status, content = asyncio.run(request(app, "POST", "/api/chat", body))
+
+    assert status == 200
+    assert parse_events(content) == [
+        ("conversation", {"conversation_id": 7}),
+        ("message", {"response": "Partial "}),
+        ("error", {"error": "Upstream went away"}),
+    ]
+    assert app.database.get_context(7) == []
+
+
+def test_unknown_path(app):
+    status, _ = asyncio.run(request(app, "GET", "/missing"))
+    assert status == 404
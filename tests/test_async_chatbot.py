@@ -0,0 +1,143 @@
+import asyncio
+import os
+import time
+import openai
+import pytest
+from aiohttp import web
+from chatgpt.async_chatbot import AsyncChatbot
+from chatgpt.cache import CompletionCache
+
+COMPLETION_LATENCY = 0.2
+
+# The completion requests the fake server has answered.
+completion_requests = []
+
+
+async def fake_completion(request):
+    completion_requests.append(await request.json())
+    await asyncio.sleep(COMPLETION_LATENCY)
+    return web.json_response(
+        {
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": "This is a fake response.",
+                    },
+                }
+            ],
+        }
+    )
+
+
+async def start_fake_server():
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", fake_completion)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1"
+
+
+def remove_test_db():
+    for filename in ("test.db", "test.db-wal", "test.db-shm"):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    yield
+
+    remove_test_db()
+
+
+async def run_conversations(count):
+    runner, api_base = await start_fake_server()
+    openai.api_base = api_base
+    semaphore = asyncio.Semaphore(count)
+    chatbots = [
+        AsyncChatbot(conversation_id=i + 1, db_path="test.db", semaphore=semaphore)
+        for i in range(count)
+    ]
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(chatbot.atalk_to_me(f"Hello {i}") for i, chatbot in enumerate(chatbots))
+        )
+        elapsed = time.perf_counter() - start
+        for chatbot in chatbots:
+            assert (
+                chatbot.title
+                == chatbot.database.get_first_message(chatbot.conversation_id)[
+                    "content"
+                ]
+            )
+            await asyncio.to_thread(chatbot.title_worker.join)
+    finally:
+        for chatbot in chatbots:
+            chatbot.close()
+        await runner.cleanup()
+        openai.api_base = "https://api.openai.com/v1"
+    return elapsed, chatbots
+
+
+def test_concurrent_conversations(fake_openai):
+    single, _ = asyncio.run(run_conversations(1))
+    remove_test_db()
+    concurrent, chatbots = asyncio.run(run_conversations(10))
+
+    assert concurrent < 2 * single
+    for chatbot in chatbots:
+        context = chatbot.database.get_context(chatbot.conversation_id)
+        assert [message["role"] for message in context] == ["user", "assistant"]
+        assert chatbot._get_title(chatbot.conversation_id) == (
+            "This is a fake response."
+        )
+
+
+def test_cancelled_turn_is_not_saved(fake_openai):
+    async def cancel_turn():
+        runner, api_base = await start_fake_server()
+        openai.api_base = api_base
+        chatbot = AsyncChatbot(db_path="test.db")
+        try:
+            task = asyncio.create_task(chatbot.atalk_to_me("Hello"))
+            await asyncio.sleep(COMPLETION_LATENCY / 2)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            return chatbot.database.get_context(chatbot.conversation_id)
+        finally:
+            chatbot.close()
+            await runner.cleanup()
+            openai.api_base = "https://api.openai.com/v1"
+
+    assert asyncio.run(cancel_turn()) == []
+
+
+def test_deterministic_turns_are_answered_from_the_cache(fake_openai, tmp_path):
+    async def repeat_turn():
+        runner, api_base = await start_fake_server()
+        openai.api_base = api_base
+        cache = CompletionCache(str(tmp_path / "completion_cache.db"))
+        chatbot = AsyncChatbot(db_path="test.db", cache=cache)
+        chatbot.temperature = 0
+        chatbot.title = "Titled"
+        try:
+            return [await chatbot.atalk_to_me("Hello", context=[]) for _ in range(2)]
+        finally:
+            chatbot.close()
+            await runner.cleanup()
+            openai.api_base = "https://api.openai.com/v1"
+
+    completion_requests.clear()
+    replies = asyncio.run(repeat_turn())
+
+    assert replies[0] == replies[1]
+    assert len(completion_requests) == 1
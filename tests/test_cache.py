@@ -0,0 +1,64 @@
+import os
+import unittest.mock as mock
+import pytest
+from chatgpt.cache import CompletionCache
+
+
+def completion_request(content="Hello", temperature=0):
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": content}],
+        "temperature": temperature,
+        "max_tokens": 100,
+        "n": 1,
+        "stream": False,
+    }
+
+
+RESPONSE = {"choices": [{"message": {"role": "assistant", "content": "Hi"}}]}
+
+
+@pytest.fixture
+def cache():
+    cache = CompletionCache("test_cache.db", ttl=60, max_entries=2)
+    yield cache
+
+    cache.close()
+    os.remove("test_cache.db")
+
+
+def test_get_and_put(cache):
+    assert cache.get(completion_request()) is None
+    cache.put(completion_request(), RESPONSE)
+
+    assert cache.get(completion_request()) == RESPONSE
+    assert cache.get(completion_request("Bye")) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_is_cacheable():
+    assert CompletionCache.is_cacheable(completion_request())
+    assert not CompletionCache.is_cacheable(completion_request(temperature=0.8))
+    assert not CompletionCache.is_cacheable({**completion_request(), "stream": True})
+
+
+def test_entries_expire(cache):
+    with mock.patch("chatgpt.cache.time.time", return_value=1000.0):
+        cache.put(completion_request(), RESPONSE)
+    with mock.patch("chatgpt.cache.time.time", return_value=1061.0):
+        assert cache.get(completion_request()) is None
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    with mock.patch("chatgpt.cache.time.time", return_value=1.0):
+        cache.put(completion_request("first"), RESPONSE)
+    with mock.patch("chatgpt.cache.time.time", return_value=2.0):
+        cache.put(completion_request("second"), RESPONSE)
+    with mock.patch("chatgpt.cache.time.time", return_value=3.0):
+        cache.get(completion_request("first"))
+    with mock.patch("chatgpt.cache.time.time", return_value=4.0):
+        cache.put(completion_request("third"), RESPONSE)
+    with mock.patch("chatgpt.cache.time.time", return_value=5.0):
+        assert cache.get(completion_request("first")) == RESPONSE
+        assert cache.get(completion_request("second")) is None
+        assert cache.get(completion_request("third")) == RESPONSE
@@ -1,7 +1,11 @@
 import pytest
 import pandas as pd
 import os
+import time
 from chatgpt.chatbot import Chatbot
+from chatgpt.scheduler import RequestScheduler
+from chatgpt.titles import TitleWorker
+from chatgpt.tokens import MESSAGE_OVERHEAD, REPLY_OVERHEAD
 import unittest.mock as mock
 import openai
 
@@ -19,12 +23,37 @@ def mock_openai_response():
     }
 
 
+def mock_openai_stream(tokens):
+    for token in tokens:
+        yield {"choices": [{"delta": {"content": token}}]}
+
+
+class StubTitleWorker:
+    """
+    Record the conversations queued for a title, so that no background thread
+    calls the API once a test's mocks are gone.
+    """
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, conversation_id, generate_titles):
+        self.submitted.append(conversation_id)
+
+    def join(self):
+        pass
+
+    def close(self):
+        pass
+
+
 @pytest.fixture
 def chatbot():
-    chatbot_instance = Chatbot(db_path="test.db")
+    chatbot_instance = Chatbot(db_path="test.db", title_worker=StubTitleWorker())
 
     yield chatbot_instance
 
+    chatbot_instance.close()
     os.remove("test.db")
 
 
@@ -47,7 +76,7 @@ def test_chatbot_init_and_verify_title(chatbot):
 
 def test_talk_to_me(chatbot):
     chatbot.talk_to_me("Hello")
-    context = chatbot.database._get_context(chatbot.conversation_id)
+    context = chatbot.database.get_context(chatbot.conversation_id)
 
     assert len(context) == 2
     assert context[0]["role"] == "user"
@@ -56,6 +85,41 @@ def test_talk_to_me(chatbot):
     assert context[1]["content"] is not None
 
 
+def test_stream_to_me(chatbot):
+    chatbot.title = "Test Conversation"
+    reply = ["First", " line\n", "Second", " line"]
+    with mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_stream(reply)
+    ):
+        streamed = list(chatbot.stream_to_me("Hello", flush="line"))
+
+    assert streamed == ["First line\n", "Second line"]
+    context = chatbot.database.get_context(chatbot.conversation_id)
+    assert context == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "First line\nSecond line"},
+    ]
+
+
+def test_completion_cache():
+    chatbot = Chatbot(db_path="test.db", cache=True, title_worker=StubTitleWorker())
+    chatbot.temperature = 0
+    with mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_response()
+    ) as create:
+        first = chatbot._submit_prompt("Hello", [])
+        second = chatbot._submit_prompt("Hello", [])
+        chatbot._submit_prompt("Hello", [], use_cache=False)
+
+    assert first == second
+    assert create.call_count == 2
+    assert (chatbot.cache.hits, chatbot.cache.misses) == (1, 1)
+
+    chatbot.close()
+    os.remove("test.db")
+    os.remove(chatbot.cache.db_file)
+
+
 def test_delete_message(chatbot):
     with mock.patch.object(
         openai.ChatCompletion, "create", return_value=mock_openai_response()
@@ -63,11 +127,11 @@ def test_delete_message(chatbot):
         chatbot.talk_to_me("First message")
         chatbot.talk_to_me("Second message")
 
-        context = chatbot.database._get_context(chatbot.conversation_id)
+        context = chatbot.database.get_context(chatbot.conversation_id)
         assert len(context) == 4
 
         chatbot.delete_message(3)  # Delete the second response from the assistant
-        context = chatbot.database._get_context(chatbot.conversation_id)
+        context = chatbot.database.get_context(chatbot.conversation_id)
         assert len(context) == 3
 
 
@@ -88,28 +152,68 @@ def test_list_conversations():
     chatbot2 = Chatbot(db_path="test.db", conversation_id=None)  # noqa: F841
     chatbot3 = Chatbot(db_path="test.db", conversation_id=None)  # noqa: F841
 
+    assert chatbot1.list_conversations().shape == (3, 4)
+
+    assert chatbot1.collect_garbage(min_age=0) == 2
     conversations = chatbot1.list_conversations()
     assert conversations.shape == (1, 4)
+    assert conversations["id"].tolist() == [chatbot1.conversation_id]
+
+
+def test_talk_to_me_fits_context_window(chatbot):
+    chatbot.max_tokens = 1000
+    with mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_response()
+    ) as create:
+        chatbot.upload_conversation(
+            [
+                {"role": "user", "content": "Old message", "token_count": 2500},
+                {"role": "assistant", "content": "Old reply", "token_count": 500},
+                {"role": "user", "content": "Recent message", "token_count": 100},
+                {"role": "assistant", "content": "Recent reply", "token_count": 100},
+            ]
+        )
+        chatbot.talk_to_me("Hello")
 
+    sent = [message["content"] for message in create.call_args.kwargs["messages"]]
+    assert sent == [
+        "This is a mocked response.",  # The summary of "Old message".
+        "Old reply",
+        "Recent message",
+        "Recent reply",
+        "Hello",
+    ]
 
-@pytest.mark.focus
-def test_truncate_context():
+    positions = chatbot.get_messages()["conversation_position"].tolist()
+    assert positions == [0, 1, 2, 3, 4, 5]
+
+
+def test_summary_is_extended_not_regenerated(chatbot):
+    chatbot.max_tokens = 3000
+    chatbot.summary_tokens = 100
     with mock.patch.object(
         openai.ChatCompletion, "create", return_value=mock_openai_response()
     ):
-        # Add messages to the conversation
-        chatbot4 = Chatbot(db_path="test.db", max_tokens=20)
-        for i in range(10):
-            chatbot4.talk_to_me(f"Message {i}")
+        chatbot.upload_conversation(
+            [
+                {"role": "user", "content": f"Message {i}", "token_count": 200}
+                for i in range(8)
+            ]
+        )
 
-        context = chatbot4.database._get_context(chatbot4.conversation_id)
-        assert len(context) == 20
+    with mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_response()
+    ) as create:
+        chatbot.talk_to_me("Hello")
+        assert create.call_count == 2
+        summary = chatbot.database.get_summary(chatbot.conversation_id)
+        assert summary["first_position"] == 0
 
-        truncated_context = chatbot4._truncate_context(context)
-        assert len(truncated_context) < 20
+        chatbot.talk_to_me("Hello again")
+        assert create.call_count == 3
 
-        summary_message = truncated_context[0]
-        assert summary_message["role"] == "assistant"
+    sent = create.call_args.kwargs["messages"]
+    assert sent[0]["content"] == summary["content"]
 
 
 def test_delete_conversation(chatbot):
@@ -248,3 +352,138 @@ def test_get_messages(chatbot):
         ]
     )
     pd.testing.assert_frame_equal(messages_df, expected_df)
+
+
+def test_title_is_generated_in_background(chatbot):
+    title = {"choices": [{"message": {"role": "assistant", "content": "Greetings"}}]}
+    with mock.patch.object(
+        openai.ChatCompletion,
+        "create",
+        side_effect=[mock_openai_response(), title],
+    ):
+        chatbot.title_worker = TitleWorker(chatbot.database)
+        chatbot.talk_to_me("Hello there")
+        assert chatbot.title == "Hello there"
+        chatbot.title_worker.close()
+
+    assert chatbot._get_title(chatbot.conversation_id) == "Greetings"
+    assert chatbot.database.get_pending_titles() == []
+
+
+def test_update_conversation_title_queues_a_title(chatbot):
+    with mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_response()
+    ) as create:
+        chatbot.talk_to_me("Hello there")
+        chatbot.update_conversation_title()
+    assert create.call_count == 1
+    assert chatbot.title == "Hello there"
+    assert chatbot.title_worker.submitted == [chatbot.conversation_id]
+    assert chatbot.database.get_pending_titles() == [chatbot.conversation_id]
+
+    chatbot.update_conversation_title("Chosen by the user")
+    assert chatbot._get_title(chatbot.conversation_id) == "Chosen by the user"
+    assert chatbot.database.get_pending_titles() == []
+
+
+def test_turn_metrics_are_recorded(chatbot):
+    chatbot.title = "Test Conversation"
+    response = dict(
+        mock_openai_response(), usage={"prompt_tokens": 12, "completion_tokens": 6}
+    )
+    with mock.patch.object(openai.ChatCompletion, "create", return_value=response):
+        chatbot.talk_to_me("Hello")
+
+    turns = chatbot.database.get_turn_metrics(chatbot.conversation_id)
+    assert len(turns) == 1
+    assert (turns.loc[0, "prompt_tokens"], turns.loc[0, "completion_tokens"]) == (
+        12,
+        6,
+    )
+    assert turns.loc[0, "completion_seconds"] <= turns.loc[0, "turn_seconds"]
+    stats = chatbot.get_stats()
+    assert stats.loc[chatbot.conversation_id, "turns"] == 1
+
+
+def test_streamed_turn_counts_the_prompt_from_stored_tokens(chatbot):
+    chatbot.title = "Test Conversation"
+    chatbot.database.put_conversation(chatbot.conversation_id)
+    chatbot.database.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, chatbot.conversation_id, i, 10)
+        for i in range(2)
+    )
+    with mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_stream(["Hi"])
+    ), mock.patch.object(
+        chatbot, "_count_tokens", side_effect=chatbot._count_tokens
+    ) as count_tokens:
+        list(chatbot.stream_to_me("Hello"))
+
+    assert [call.args[0] for call in count_tokens.call_args_list] == ["Hello", "Hi"]
+    turns = chatbot.database.get_turn_metrics(chatbot.conversation_id)
+    assert turns.loc[0, "prompt_tokens"] == (
+        2 * (10 + MESSAGE_OVERHEAD)
+        + chatbot._count_tokens("Hello")
+        + MESSAGE_OVERHEAD
+        + REPLY_OVERHEAD
+    )
+
+
+def test_submit_prompt_uses_engine(chatbot):
+    with mock.patch.object(
+        openai.ChatCompletion, "create", return_value=mock_openai_response()
+    ) as create:
+        chatbot._submit_prompt("Hello", [], engine="gpt-4", display=False)
+
+    assert create.call_args.kwargs["model"] == "gpt-4"
+
+
+def test_fan_out(chatbot):
+    chatbot.title = "Test Conversation"
+    # Keep earlier tests' token usage from delaying either request.
+    chatbot.scheduler = RequestScheduler(tokens_per_minute=10**9)
+
+    def create(**request):
+        if request["model"] == "gpt-4":
+            time.sleep(0.2)
+        return {
+            "choices": [
+                {
+                    "message": {
+                        "role": "assistant",
+                        "content": f"{request['model']} reply {index}",
+                    }
+                }
+                for index in range(request["n"])
+            ],
+            "usage": {"prompt_tokens": 9, "completion_tokens": 6},
+        }
+
+    with mock.patch.object(openai.ChatCompletion, "create", side_effect=create):
+        candidates = list(
+            chatbot.fan_out("Hello", engines=["gpt-4", "gpt-3.5-turbo"], n=2)
+        )
+
+    assert [candidate["content"] for candidate in candidates] == [
+        "gpt-3.5-turbo reply 0",
+        "gpt-3.5-turbo reply 1",
+        "gpt-4 reply 0",
+        "gpt-4 reply 1",
+    ]
+    assert candidates[2]["latency_seconds"] >= 0.2
+    assert chatbot.database.get_context(chatbot.conversation_id) == []
+    assert len(chatbot.get_candidates()) == 4
+
+    chatbot.choose_candidate(candidates[2]["id"])
+    assert chatbot.database.get_context(chatbot.conversation_id) == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "gpt-4 reply 0"},
+    ]
+    assert chatbot.get_candidates()["chosen"].tolist() == [0, 0, 1, 0]
+
+
+def test_close_leaves_a_shared_database_open(chatbot):
+    other = Chatbot(database=chatbot.database)
+    with mock.patch.object(chatbot.database, "close") as close:
+        other.close()
+    close.assert_not_called()
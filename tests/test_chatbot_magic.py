@@ -0,0 +1,28 @@
+import subprocess
+import sys
+import unittest.mock as mock
+from chatgpt.chatbot_magic import ChatbotMagics, LazyChatbot
+
+
+def test_import_defers_heavy_dependencies():
+    code = (
+        "import sys, chatgpt.chatbot_magic; "
+        "print(sorted({'openai', 'tiktoken', 'pandas'} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_chatbot_is_built_on_first_use():
+    with mock.patch("chatgpt.chatbot_magic.Chatbot") as chatbot_class:
+        magics = ChatbotMagics(shell=None)
+        chatbot = LazyChatbot(magics)
+        magics.gpt("help")
+        chatbot_class.assert_not_called()
+
+        chatbot.max_tokens = 100
+        magics.gpt("attrs")
+        chatbot_class.assert_called_once_with()
+        assert magics.chatbot.max_tokens == 100
@@ -0,0 +1,108 @@
+import os
+import pytest
+from chatgpt.database import LocalDatabase
+from chatgpt.tokens import count_tokens_batch
+
+pytest.importorskip("pyarrow")
+
+
+def make_db(path):
+    db = LocalDatabase(db_file=str(path))
+    db.create_tables()
+    return db
+
+
+@pytest.fixture
+def source(tmp_path):
+    db = make_db(tmp_path / "source.db")
+    for conversation_id in (1, 2):
+        db.put_conversation(conversation_id)
+        db.update_conversation_title(conversation_id, f"Conversation {conversation_id}")
+        db.put_messages(
+            ({"role": "user", "content": f"Message {i}"}, conversation_id, i, i)
+            for i in range(3)
+        )
+    yield db
+
+    db.close()
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_round_trip_remaps_conversation_ids(source, tmp_path, format):
+    directory = str(tmp_path / "export")
+    counts = source.export_history(directory, format=format, batch_size=2)
+    assert counts == {"conversations": 2, "messages": 6}
+    assert os.path.exists(os.path.join(directory, f"messages.{format}"))
+
+    target = make_db(tmp_path / "target.db")
+    target.put_conversation(1)
+    target.put_message({"role": "user", "content": "Existing"}, 1, 0, 1)
+    counts = target.import_history(directory, format=format, batch_size=2)
+
+    assert counts == {"conversations": 2, "messages": 6, "offset": 1}
+    assert target.get_conversation_attributes(3)["title"] == "Conversation 2"
+    assert target.get_context(1) == [{"role": "user", "content": "Existing"}]
+    assert target.get_context(3) == source.get_context(2)
+    target.close()
+
+
+def test_import_counts_missing_tokens(source, tmp_path):
+    source._query_db("UPDATE messages SET token_count = NULL WHERE id % 2 = 0")
+    query = "SELECT content, token_count FROM messages ORDER BY id"
+    exported = source._query_db(query, fetch="all")
+    directory = str(tmp_path / "export")
+    source.export_history(directory)
+
+    target = make_db(tmp_path / "target.db")
+    target.import_history(directory)
+
+    assert target._query_db(query, fetch="all") == [
+        (content, count_tokens_batch([content])[0] if count is None else count)
+        for content, count in exported
+    ]
+    target.close()
+
+
+def test_unknown_format(source, tmp_path):
+    with pytest.raises(ValueError):
+        source.export_history(str(tmp_path), format="csv")
+
+
+def test_import_indexes_messages_and_aggregates(source, tmp_path):
+    directory = str(tmp_path / "export")
+    source.export_history(directory)
+
+    target = make_db(tmp_path / "target.db")
+    target.import_history(directory)
+    assert len(target.find_message("Message", full_text=True)) == 6
+    conversations = target.list_conversations(stats=True)
+    assert conversations["message_count"].tolist() == [3, 3]
+    assert conversations["total_tokens"].tolist() == [3, 3]
+
+    target.put_conversation(10)
+    target.put_message({"role": "user", "content": "Later"}, 10, 0, 1)
+    assert len(target.find_message("Later", full_text=True)) == 1
+    assert target.get_next_position(10) == 1
+    target.close()
+
+
+def test_round_trip_through_every_backend(backend, tmp_path):
+    import pyarrow.parquet as pq
+
+    for conversation_id in (1, 2):
+        backend.put_conversation(conversation_id)
+        backend.put_messages(
+            ({"role": "user", "content": f"Message {i}"}, conversation_id, i, i)
+            for i in range(3)
+        )
+    directory = str(tmp_path / "export")
+    backend.export_history(directory)
+    last_updated = pq.read_table(os.path.join(directory, "conversations.parquet"))
+    assert len(last_updated.column("last_updated")[0].as_py()) == 19
+
+    counts = backend.import_history(directory)
+
+    assert counts == {"conversations": 2, "messages": 6, "offset": 2}
+    assert backend.get_context(4) == backend.get_context(2)
+    assert backend.get_next_position(4) == 3
+    assert len(backend.find_message("Message", full_text=True)) == 12
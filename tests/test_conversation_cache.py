@@ -0,0 +1,223 @@
+import threading
+import pytest
+from chatgpt.chatbot import Chatbot
+from chatgpt.conversation_cache import CachedDatabase
+from chatgpt.database import LocalDatabase
+
+
+@pytest.fixture
+def cached_db(tmp_path):
+    db = CachedDatabase(LocalDatabase(db_file=str(tmp_path / "chat.db")))
+    db.create_tables()
+    yield db
+
+    db.close()
+
+
+def _trace_selects(db):
+    # Record every SELECT the backend runs from now on, but for FTS5's own.
+    selects = []
+
+    def trace(statement):
+        if statement.lstrip().upper().startswith("SELECT") and "_fts_" not in statement:
+            selects.append(statement)
+
+    db.database.connections.get().set_trace_callback(trace)
+    return selects
+
+
+def test_writes_go_through_to_the_cache(cached_db):
+    conversation_id = cached_db.create_conversation()
+    selects = _trace_selects(cached_db)
+
+    cached_db.put_message({"role": "user", "content": "Hello"}, conversation_id, 0, 1)
+    cached_db.put_messages(
+        [({"role": "assistant", "content": "Hi"}, conversation_id, 1, 1)]
+    )
+    cached_db.put_summary(conversation_id, 0, 0, "Greeting", 1)
+
+    assert cached_db.get_context(conversation_id) == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi"},
+    ]
+    assert cached_db.get_next_position(conversation_id) == 2
+    assert cached_db.get_context_window(conversation_id, 1, after_position=0) == (
+        [{"role": "assistant", "content": "Hi"}],
+        1,
+        1,
+    )
+    assert cached_db.get_summary(conversation_id)["content"] == "Greeting"
+    assert selects == []
+    assert cached_db.database.get_context(conversation_id) == cached_db.get_context(
+        conversation_id
+    )
+
+
+def test_loads_a_conversation_once(cached_db):
+    cached_db.database.put_conversation(1)
+    cached_db.database.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 1) for i in range(3)
+    )
+    selects = _trace_selects(cached_db)
+
+    for _ in range(3):
+        assert len(cached_db.get_context(1)) == 3
+        cached_db.get_context_window(1, 100)
+    assert len(selects) == 1
+
+
+def test_deletes_evict(cached_db):
+    cached_db.put_conversation(1)
+    cached_db.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 1) for i in range(3)
+    )
+    assert len(cached_db.get_context(1)) == 3
+
+    cached_db.delete_message(2)
+    assert [m["content"] for m in cached_db.get_context(1)] == [
+        "Message 0",
+        "Message 2",
+    ]
+
+    cached_db.delete_conversation(1)
+    assert cached_db.get_context(1) == []
+
+
+def test_rollback_evicts(cached_db):
+    conversation_id = cached_db.create_conversation()
+    with pytest.raises(RuntimeError):
+        with cached_db.transaction():
+            cached_db.put_message(
+                {"role": "user", "content": "Hello"}, conversation_id, 0, 1
+            )
+            raise RuntimeError
+
+    assert cached_db.get_context(conversation_id) == []
+
+
+def test_transaction_writes_reach_the_cache_on_commit(cached_db):
+    conversation_id = cached_db.create_conversation()
+    seen = []
+
+    def read():
+        seen.append(cached_db.get_context(conversation_id))
+
+    with cached_db.transaction():
+        cached_db.put_message(
+            {"role": "user", "content": "Hello"}, conversation_id, 0, 1
+        )
+        assert len(cached_db.get_context(conversation_id)) == 1
+        other = threading.Thread(target=read)
+        other.start()
+        other.join()
+
+    assert seen == [[]]
+    assert cached_db.get_context(conversation_id) == [
+        {"role": "user", "content": "Hello"}
+    ]
+
+
+def test_passthrough_writes_invalidate(cached_db):
+    cached_db.create_conversation()
+    kept = cached_db.create_conversation()
+    cached_db.put_message({"role": "user", "content": "Hello"}, kept, 0, 1)
+
+    assert cached_db.delete_empty_conversations() == 1
+    assert list(cached_db._conversations) == [kept]
+
+    with cached_db.transaction() as conn:
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (kept,))
+    assert cached_db.get_context(kept) == []
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    db = CachedDatabase(LocalDatabase(db_file=str(tmp_path / "chat.db")), 2)
+    db.create_tables()
+    ids = [db.create_conversation() for _ in range(3)]
+    db.get_context(ids[1])
+
+    assert list(db._conversations) == [ids[2], ids[1]]
+    db.close()
+
+
+def test_steady_state_turns_do_not_read(tmp_path):
+    chatbot = Chatbot(db_path=str(tmp_path / "chat.db"))
+    chatbot.title = "Titled"
+    for _ in range(2):
+        chatbot._build_context(10)
+        chatbot._save_turn(
+            {"role": "user", "content": "Hello"},
+            {"role": "assistant", "content": "Hi"},
+            1,
+        )
+    selects = _trace_selects(chatbot.database)
+
+    for _ in range(3):
+        chatbot._build_context(10)
+        chatbot._save_turn(
+            {"role": "user", "content": "Hello"},
+            {"role": "assistant", "content": "Hi"},
+            1,
+        )
+
+    # Only the next position of each turn, which comes from the backend.
+    assert len(selects) == 3
+    assert all(
+        "SELECT last_position FROM conversations" in " ".join(select.split())
+        for select in selects
+    )
+    assert len(chatbot.database.database.get_context(chatbot.conversation_id)) == 10
+    chatbot.close()
+
+
+def _positions(db, conversation_id):
+    return [row[0] for row in db.get_conversation_messages(conversation_id)]
+
+
+def test_bots_on_one_file_share_the_cache(tmp_path):
+    path = str(tmp_path / "chat.db")
+    first = Chatbot(db_path=path)
+    second = Chatbot(conversation_id=first.conversation_id, db_path=path)
+    first.title = second.title = "Titled"
+    second._build_context(10)
+    first._save_turn(
+        {"role": "user", "content": "Hello"}, {"role": "assistant", "content": "Hi"}, 1
+    )
+
+    context, _ = second._build_context(10)
+    assert [message["content"] for message in context[-2:]] == ["Hello", "Hi"]
+    second._save_turn(
+        {"role": "user", "content": "Again"}, {"role": "assistant", "content": "Hi"}, 1
+    )
+    assert _positions(first.database.database, first.conversation_id) == [0, 1, 2, 3]
+    first.close()
+    second.close()
+
+
+def test_positions_come_from_the_backend_in_transactions(tmp_path):
+    path = str(tmp_path / "chat.db")
+    first = CachedDatabase(LocalDatabase(db_file=path))
+    second = CachedDatabase(LocalDatabase(db_file=path))
+    first.create_tables()
+    conversation_id = first.create_conversation()
+    assert second.get_context(conversation_id) == []
+
+    for db in (first, second):
+        with db.transaction():
+            position = db.get_next_position(conversation_id)
+            db.put_messages(
+                [
+                    (
+                        {"role": "user", "content": "Hello"},
+                        conversation_id,
+                        position,
+                        1,
+                    ),
+                ]
+            )
+
+    assert _positions(first.database, conversation_id) == [0, 1]
+    # The stale copy was dropped, and is read again.
+    assert len(second.get_context(conversation_id)) == 2
+    first.close()
+    second.close()
@@ -1,20 +1,25 @@
 import pytest
 import os
-from chatgpt.database import LocalDatabase
+import sqlite3
+import subprocess
+import sys
+from chatgpt.database import MIGRATIONS, LocalDatabase, SCHEMA_VERSION
 
 
 @pytest.fixture
 def test_db():
     db = LocalDatabase(db_file="test.db")
-    db._create_tables()
+    db.create_tables()
     yield db
 
+    db.close()
     os.remove("test.db")
 
 
 def test_get_message(test_db):
     # Insert a sample message
-    test_db._put_message({"role": "user", "content": "Sample message"}, 1, 1, 1)
+    test_db.put_conversation(1)
+    test_db.put_message({"role": "user", "content": "Sample message"}, 1, 1, 1)
 
     # Test get_message method
     message = test_db.get_message(1)
@@ -25,3 +30,287 @@ def test_get_message(test_db):
     assert message["conversation_id"] == 1
     assert message["conversation_position"] == 1
     assert message["token_count"] == 1
+
+
+def test_connection_is_reused(test_db):
+    conn = test_db.connections.get()
+    test_db.put_conversation(1)
+    test_db.put_message({"role": "user", "content": "Sample message"}, 1, 1, 1)
+    test_db.get_message(1)
+
+    assert test_db.connections.get() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_close_reopens_on_next_query(test_db):
+    conn = test_db.connections.get()
+    test_db.close()
+
+    assert test_db.get_max_conversation_id() == 0
+    assert test_db.connections.get() is not conn
+
+
+def test_put_messages(test_db):
+    test_db.put_conversation(1)
+    test_db.put_messages(
+        [
+            ({"role": "user", "content": "Hello"}, 1, 0, 1),
+            ({"role": "assistant", "content": "Hi"}, 1, 1, 1),
+        ]
+    )
+
+    assert test_db.get_context(1) == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi"},
+    ]
+
+
+def test_transaction_rolls_back_on_error(test_db):
+    with pytest.raises(RuntimeError):
+        with test_db.transaction():
+            test_db.put_conversation(1)
+            test_db.put_messages([({"role": "user", "content": "Hello"}, 1, 0, 1)])
+            raise RuntimeError
+
+    assert test_db.get_max_conversation_id() == 0
+    assert test_db.get_context(1) == []
+
+
+def _query_plan(db, query, params):
+    conn = db.connections.get()
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+    return " ".join(row[-1] for row in rows)
+
+
+def test_create_tables_upgrades_legacy_database():
+    conn = sqlite3.connect("test.db")
+    conn.execute(
+        """
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role TEXT,
+            content TEXT,
+            conversation_id INTEGER,
+            conversation_position INTEGER,
+            token_count INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            tags TEXT,
+            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.execute("INSERT INTO conversations (id, title) VALUES (1, 'Legacy')")
+    conn.execute(
+        "INSERT INTO messages (role, content, conversation_id, "
+        "conversation_position, token_count) VALUES ('user', 'Hello', 1, 0, 1)"
+    )
+    conn.commit()
+    conn.close()
+
+    db = LocalDatabase(db_file="test.db")
+    context_query = """
+        SELECT role, content
+        FROM messages
+        WHERE conversation_id = ?
+        ORDER BY conversation_position
+    """
+    assert "USING INDEX" not in _query_plan(db, context_query, (1,))
+
+    db.create_tables()
+
+    version = db._query_db("PRAGMA user_version", fetch="one")[0]
+    assert version == SCHEMA_VERSION
+    assert db.get_context(1) == [{"role": "user", "content": "Hello"}]
+    assert "USING INDEX messages_conversation_position" in _query_plan(
+        db, context_query, (1,)
+    )
+    assert "USING INDEX conversations_last_updated" in _query_plan(
+        db, "SELECT * FROM conversations ORDER BY last_updated DESC", ()
+    )
+
+    assert db.find_message("hello", full_text=True)["id"].tolist() == [1]
+    stats = db.list_conversations(stats=True).iloc[0]
+    assert (stats["message_count"], stats["total_tokens"]) == (1, 1)
+    assert db.get_next_position(1) == 1
+
+    db.delete_conversation(1)
+    assert db.get_message(1) is None
+
+    db.close()
+    os.remove("test.db")
+
+
+def test_cost_backfill_uses_the_prices_of_its_version():
+    conn = sqlite3.connect("test.db")
+    for statement in [
+        statement for migration in MIGRATIONS[:8] for statement in migration
+    ]:
+        conn.execute(statement)
+    conn.execute("PRAGMA user_version = 8")
+    conn.execute("INSERT INTO conversations (id) VALUES (1)")
+    conn.execute(
+        "INSERT INTO turn_metrics (conversation_id, model, prompt_tokens, "
+        "completion_tokens) VALUES (1, 'gpt-4-0613', 1000, 1000)"
+    )
+    conn.commit()
+    conn.close()
+
+    db = LocalDatabase(db_file="test.db")
+    db.create_tables()
+    # gpt-4 at $0.03 and $0.06 per 1,000 tokens, whatever PRICES says now.
+    assert db.get_turn_metrics(1).loc[0, "cost"] == pytest.approx(0.09)
+    assert db.list_conversations(stats=True).loc[0, "cost"] == pytest.approx(0.09)
+
+    db.close()
+    os.remove("test.db")
+
+
+def test_processes_upgrade_a_new_database_together(tmp_path):
+    code = (
+        "import sys; from chatgpt.database import LocalDatabase; "
+        "LocalDatabase(sys.argv[1]).create_tables()"
+    )
+    for trial in range(5):
+        path = str(tmp_path / f"chat{trial}.db")
+        workers = [
+            subprocess.Popen([sys.executable, "-c", code, path], stderr=subprocess.PIPE)
+            for _ in range(4)
+        ]
+        for worker in workers:
+            _, stderr = worker.communicate()
+            assert worker.returncode == 0, stderr.decode()
+        conn = sqlite3.connect(path)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        conn.close()
+
+
+def test_messages_require_a_conversation(test_db):
+    with pytest.raises(sqlite3.IntegrityError):
+        test_db.put_message({"role": "user", "content": "Orphan"}, 42, 0, 1)
+
+
+def test_find_message_full_text(test_db):
+    test_db.put_conversation(1)
+    test_db.put_messages(
+        [
+            ({"role": "user", "content": "How do tokenizers work?"}, 1, 0, 5),
+            ({"role": "assistant", "content": "A tokenizer splits text"}, 1, 1, 4),
+            ({"role": "user", "content": "Tokenizer tokenizer tokenizer"}, 1, 2, 3),
+        ]
+    )
+
+    found = test_db.find_message("tokenizer", full_text=True)
+    assert found["id"].tolist() == [3, 2]
+    assert "**tokenizer**" in found.iloc[1]["snippet"]
+
+    assert test_db.find_message("token*", full_text=True).shape[0] == 3
+    assert test_db.find_message('"splits text"', full_text=True)["id"].tolist() == [2]
+    assert test_db.find_message("tokenizer", full_text=True, limit=1).shape[0] == 1
+
+    test_db.delete_message(3)
+    assert test_db.find_message("tokenizer", full_text=True)["id"].tolist() == [2]
+
+
+def test_find_message_full_text_punctuation(test_db):
+    test_db.put_conversation(1)
+    test_db.put_messages(
+        [
+            ({"role": "user", "content": "Why don't templates work in C++?"}, 1, 0, 8),
+            ({"role": "assistant", "content": 'Say "AND" or NOT(x)'}, 1, 1, 6),
+        ]
+    )
+
+    for search in ("don't", "C++", "templates?", "NOT(x)", 'AND"', "work*"):
+        assert len(test_db.find_message(search, full_text=True)) == 1, search
+    assert test_db.find_message("don't C++", full_text=True)["id"].tolist() == [1]
+    assert len(next(test_db.iter_find_message("C++", full_text=True))) == 1
+
+
+def test_get_context_window(test_db):
+    test_db.put_conversation(1)
+    test_db.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 10) for i in range(5)
+    )
+
+    window, first_position, token_count = test_db.get_context_window(1, 30)
+    assert [message["content"] for message in window] == [
+        "Message 2",
+        "Message 3",
+        "Message 4",
+    ]
+    assert first_position == 2
+    assert token_count == 30
+    assert len(test_db.get_context_window(1, 30, message_overhead=4)[0]) == 2
+    assert test_db.get_context_window(1, 100, after_position=2)[1] == 3
+    assert test_db.get_context_window(1, 5) == ([], 5, 0)
+    assert test_db.get_next_position(1) == 5
+    assert test_db.get_next_position(2) == 0
+
+
+def test_summary_is_invalidated_by_deleting_a_covered_message(test_db):
+    test_db.put_conversation(1)
+    test_db.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 10) for i in range(5)
+    )
+    test_db.put_summary(1, 0, 1, "First summary", 2)
+    test_db.put_summary(1, 0, 2, "Extended summary", 2)
+
+    assert test_db.get_summary(1) == {
+        "first_position": 0,
+        "last_position": 2,
+        "content": "Extended summary",
+        "token_count": 2,
+    }
+
+    test_db.delete_message(5)
+    assert test_db.get_summary(1) is not None
+
+    test_db.delete_message(2)
+    assert test_db.get_summary(1) is None
+
+
+def test_delete_empty_conversations(test_db):
+    for conversation_id in (1, 2, 3, 4):
+        test_db.put_conversation(conversation_id)
+    test_db.update_conversation_title(2, "Titled")
+    test_db.put_message({"role": "user", "content": "Hello"}, 3, 0, 1)
+
+    assert test_db.delete_empty_conversations(min_age=3600) == 0
+    assert test_db.delete_empty_conversations(exclude=[4]) == 1
+    assert test_db.list_conversations()["id"].sort_values().tolist() == [2, 3, 4]
+
+
+def test_pagination(test_db):
+    test_db.put_conversation(1)
+    test_db.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 2) for i in range(5)
+    )
+
+    first_page = test_db.get_messages(limit=2)
+    assert first_page["id"].tolist() == [1, 2]
+    second_page = test_db.get_messages(limit=2, after_id=first_page["id"].iloc[-1])
+    assert second_page["id"].tolist() == [3, 4]
+
+    with pytest.warns(DeprecationWarning):
+        chunks = list(test_db.iter_messages("conversation_id = 1", chunk_size=2))
+    assert [chunk["id"].tolist() for chunk in chunks] == [[1, 2], [3, 4], [5]]
+
+    assert test_db.find_message("Message", limit=2, offset=2)["id"].tolist() == [
+        3,
+        4,
+    ]
+    chunks = list(test_db.iter_find_message("message", full_text=True, chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 2]
+
+    for conversation_id in (2, 3):
+        test_db.put_conversation(conversation_id)
+    assert len(test_db.list_conversations(limit=2)) == 2
+    assert len(test_db.list_conversations(limit=2, offset=2)) == 1
+    assert [len(chunk) for chunk in test_db.iter_conversations(chunk_size=2)] == [2, 1]
@@ -0,0 +1,43 @@
+import json
+from chatgpt.database import LocalDatabase
+from chatgpt.filters import MessageFilter
+
+
+def test_compile_depends_only_on_the_criteria_set():
+    first = MessageFilter(conversation_ids=[1], roles=["user"], min_tokens=5)
+    second = MessageFilter(conversation_ids=[2, 3, 4], roles=["system"], min_tokens=9)
+
+    conditions, params = first.compile()
+    assert conditions == second.compile()[0]
+    assert conditions == [
+        "conversation_id IN (SELECT value FROM json_each(?))",
+        "role IN (SELECT value FROM json_each(?))",
+        "token_count >= ?",
+    ]
+    assert [json.loads(params[0]), json.loads(params[1]), params[2]] == [
+        [1],
+        ["user"],
+        5,
+    ]
+    assert MessageFilter().compile() == ([], [])
+
+
+def test_compile_for_postgres():
+    conditions, params = MessageFilter(
+        conversation_ids=[1, 2], created_after="2023-01-01 00:00:00"
+    ).compile("postgres")
+    assert conditions == [
+        "conversation_id = ANY(%s::BIGINT[])",
+        "created_at >= %s",
+    ]
+    assert params == [[1, 2], "2023-01-01 00:00:00"]
+
+
+def test_conversation_filter_uses_the_index(tmp_path):
+    db = LocalDatabase(db_file=str(tmp_path / "chat.db"))
+    db.create_tables()
+    query, params = db._messages_query(MessageFilter(conversation_ids=[1, 2]))
+    plan = db._query_db(f"EXPLAIN QUERY PLAN {query}", params, fetch="all")
+
+    assert "messages_conversation_position" in " ".join(row[-1] for row in plan)
+    db.close()
@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+from chatgpt.metrics import Metrics, TurnMetrics, summarize_turns
+
+
+def test_prometheus_export():
+    registry = Metrics()
+    registry.observe("db_query", 0.002)
+    registry.observe("db_query", 0.2)
+    registry.increment("cache_hits")
+
+    text = registry.prometheus()
+    assert 'chatgpt_stage_seconds_bucket{stage="db_query",le="0.001"} 0' in text
+    assert 'chatgpt_stage_seconds_bucket{stage="db_query",le="0.005"} 1' in text
+    assert 'chatgpt_stage_seconds_bucket{stage="db_query",le="+Inf"} 2' in text
+    assert 'chatgpt_stage_seconds_count{stage="db_query"} 2' in text
+    assert "chatgpt_cache_hits_total 1" in text
+
+
+def test_turn_prefers_reported_usage():
+    turn = TurnMetrics("gpt-4")
+    turn.record_usage({"prompt_tokens": 10, "completion_tokens": 20})
+    turn.finish(prompt_tokens=1, completion_tokens=2)
+    row = turn.as_row()
+    assert (row["prompt_tokens"], row["completion_tokens"]) == (10, 20)
+    assert row["turn_seconds"] > 0
+
+
+def test_summarize_turns():
+    turns = pd.DataFrame(
+        {
+            "conversation_id": [1, 1, 2],
+            "model": ["gpt-3.5-turbo", "gpt-3.5-turbo-0613", "gpt-4"],
+            "turn_seconds": [1.0, 3.0, 2.0],
+            "first_token_seconds": [0.5, 0.7, None],
+            "prompt_tokens": [1000, 1000, 1000],
+            "completion_tokens": [1000, 0, 0],
+            "cache_hit": [0, 1, 0],
+            # As stored at the prices of the time, not today's.
+            "cost": [0.05, 0.04, None],
+        }
+    )
+    stats = summarize_turns(turns)
+    assert stats.loc[1, "turns"] == 2
+    assert stats.loc[1, "cost"] == pytest.approx(0.09)
+    assert stats.loc[1, "turn_p50"] == 2.0
+    assert stats.loc[2, "cost"] == 0
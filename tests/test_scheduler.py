@@ -0,0 +1,220 @@
+import asyncio
+import json
+import threading
+import time
+import unittest.mock as mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import openai
+import pytest
+from chatgpt.chatbot import Chatbot
+from chatgpt.scheduler import PRIORITY_BACKGROUND, PRIORITY_USER, RequestScheduler
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    """
+    Answer 429 to the first `failures` requests, then a fixed completion.
+    """
+
+    failures = 0
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).requests += 1
+        if type(self).requests <= type(self).failures:
+            body = {"error": {"message": "Rate limit reached", "type": "requests"}}
+            self._respond(429, body, {"Retry-After": "0"})
+        else:
+            body = {
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "Done."},
+                    }
+                ],
+            }
+            self._respond(200, body)
+
+    def _respond(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def rate_limited_api(monkeypatch):
+    RateLimitedHandler.requests = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(
+        openai, "api_base", f"http://127.0.0.1:{server.server_address[1]}/v1"
+    )
+    yield RateLimitedHandler
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def chatbot():
+    bot = Chatbot(db_path="test.db")
+    yield bot
+    bot.close()
+
+
+def test_retries_rate_limited_requests(rate_limited_api, chatbot):
+    rate_limited_api.failures = 2
+    chatbot.scheduler = RequestScheduler(base_delay=0.01)
+    message = chatbot._submit_prompt("Hello", [], display=False, use_cache=False)
+    assert message["content"] == "Done."
+    assert rate_limited_api.requests == 3
+    metrics = chatbot.scheduler.metrics()
+    assert metrics["retries"] == 2
+    assert metrics["admitted"] == 3
+    assert metrics["failures"] == 0
+
+
+def test_gives_up_after_max_retries(rate_limited_api, chatbot):
+    rate_limited_api.failures = 10
+    chatbot.scheduler = RequestScheduler(max_retries=2, base_delay=0.01)
+    with pytest.raises(openai.error.RateLimitError):
+        chatbot._submit_prompt("Hello", [], display=False, use_cache=False)
+    assert rate_limited_api.requests == 3
+    assert chatbot.scheduler.metrics()["failures"] == 1
+
+
+def test_user_requests_go_ahead_of_background_requests():
+    scheduler = RequestScheduler(requests_per_minute=600)
+    scheduler.requests.level = 0
+    order = []
+
+    def submit(name, priority):
+        scheduler.submit(lambda: order.append(name), priority=priority)
+
+    threads = [threading.Thread(target=submit, args=("title", PRIORITY_BACKGROUND))]
+    threads[0].start()
+    while scheduler.queue_depth < 1:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=submit, args=("user", PRIORITY_USER)))
+    threads[1].start()
+    while scheduler.queue_depth < 2:
+        time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+
+    assert order == ["user", "title"]
+    metrics = scheduler.metrics()
+    assert metrics["max_queue_depth"] == 2
+    assert metrics["max_wait_time"] > 0
+
+
+def test_token_budget_delays_admission():
+    scheduler = RequestScheduler(tokens_per_minute=6000)
+    started = time.monotonic()
+    scheduler.submit(lambda: None, tokens=6000)
+    scheduler.submit(lambda: None, tokens=10)
+    # The second request waits for ten tokens at 100 tokens a second.
+    assert time.monotonic() - started >= 0.09
+
+
+def test_async_admission_waits_on_the_event_loop():
+    scheduler = RequestScheduler(tokens_per_minute=6000)
+    scheduler.tokens.level = 0
+
+    async def main():
+        with mock.patch("asyncio.to_thread", side_effect=AssertionError):
+            waiting = asyncio.ensure_future(
+                scheduler.asubmit(lambda: asyncio.sleep(0), 10)
+            )
+            await asyncio.sleep(0.05)
+            assert scheduler.queue_depth == 1
+            await waiting
+
+    started = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - started >= 0.09
+    assert scheduler.queue_depth == 0
+
+
+def test_cancelled_requests_give_their_tokens_back():
+    scheduler = RequestScheduler(tokens_per_minute=6000)
+    scheduler.tokens.level = 0
+
+    async def main():
+        queued = asyncio.ensure_future(
+            scheduler.asubmit(lambda: asyncio.sleep(0), 6000)
+        )
+        await asyncio.sleep(0.01)
+        assert scheduler.queue_depth == 1
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert scheduler.queue_depth == 0
+
+        scheduler.tokens.level = 6000
+
+        running = asyncio.ensure_future(
+            scheduler.asubmit(lambda: asyncio.sleep(10), 1000)
+        )
+        await asyncio.sleep(0.01)
+        assert scheduler.tokens.level < 5100
+        running.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await running
+
+    asyncio.run(main())
+    assert scheduler.tokens.level > 5900
+
+
+def test_limits_from_env(monkeypatch):
+    monkeypatch.setenv("CHATGPT_REQUESTS_PER_MINUTE", "off")
+    monkeypatch.setenv("CHATGPT_TOKENS_PER_MINUTE", "1200")
+    scheduler = RequestScheduler.from_env()
+    assert scheduler.requests.capacity is None
+    assert scheduler.tokens.capacity == 1200
+
+    monkeypatch.setenv("CHATGPT_TOKENS_PER_MINUTE", "0")
+    scheduler = RequestScheduler.from_env()
+    started = time.monotonic()
+    for _ in range(100):
+        scheduler.submit(lambda: None, tokens=10**6)
+    assert time.monotonic() - started < 0.1
+
+
+def test_reconcile_refunds_unused_tokens():
+    scheduler = RequestScheduler(tokens_per_minute=6000)
+    scheduler.submit(lambda: None, tokens=6000)
+    scheduler.reconcile(6000, 100)
+    started = time.monotonic()
+    scheduler.submit(lambda: None, tokens=5000)
+    assert time.monotonic() - started < 0.05
+
+
+def test_estimate_charges_an_expected_completion(chatbot):
+    request = {
+        "messages": [{"role": "user", "content": "Hello"}],
+        "max_tokens": 3200,
+        "n": 2,
+    }
+    assert chatbot._estimate_tokens(request) < 3200
+
+
+def test_completion_charge_is_reconciled_with_usage(chatbot):
+    chatbot.scheduler = RequestScheduler(tokens_per_minute=6000)
+    response = {
+        "choices": [{"message": {"role": "assistant", "content": "Done."}}],
+        "usage": {"prompt_tokens": 8, "completion_tokens": 2, "total_tokens": 10},
+    }
+    with mock.patch.object(openai.ChatCompletion, "create", return_value=response):
+        chatbot._submit_prompt("Hello", [], display=False, use_cache=False)
+    assert chatbot.scheduler.tokens.level == pytest.approx(5990)
@@ -0,0 +1,326 @@
+"""
+Behaviour every storage backend must share. The PostgreSQL backend is only
+tested when CHATGPT_TEST_POSTGRES_DSN names a server to create schemas on.
+"""
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+import pytest
+from chatgpt.chatbot import Chatbot
+from chatgpt.conversation_cache import CachedDatabase
+from chatgpt.database import CONVERSATION_STAT_COLUMNS, LocalDatabase
+from chatgpt.filters import MessageFilter
+from chatgpt.metrics import TurnMetrics
+from chatgpt.storage import StorageBackend, open_database
+
+
+def _integrity_errors():
+    errors = [sqlite3.IntegrityError]
+    try:
+        import psycopg
+
+        errors.append(psycopg.IntegrityError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def test_implements_protocol(backend):
+    assert isinstance(backend, StorageBackend)
+
+
+def test_open_database(tmp_path):
+    db = open_database("local", str(tmp_path / "chat.db"))
+    assert isinstance(db, CachedDatabase)
+    assert isinstance(db.database, LocalDatabase)
+    db = open_database("local", str(tmp_path / "chat.db"), hot_conversations=0)
+    assert isinstance(db, LocalDatabase)
+    assert open_database(db) is db
+    with pytest.raises(ValueError):
+        open_database("mysql://localhost/chat")
+
+
+def test_messages(backend):
+    backend.put_conversation(1)
+    backend.put_message({"role": "user", "content": "Hello"}, 1, 0, 1)
+    backend.put_messages(
+        [
+            ({"role": "assistant", "content": "Hi"}, 1, 1, 1),
+            ({"role": "user", "content": "Bye"}, 1, 2, 1),
+        ]
+    )
+
+    assert backend.get_message(2) == {
+        "id": 2,
+        "role": "assistant",
+        "content": "Hi",
+        "conversation_id": 1,
+        "conversation_position": 1,
+        "token_count": 1,
+    }
+    assert backend.get_message(42) is None
+    assert backend.get_first_message(1) == {"role": "user", "content": "Hello"}
+    assert backend.get_context_range(1, 1, 2) == [
+        {"role": "assistant", "content": "Hi"},
+        {"role": "user", "content": "Bye"},
+    ]
+    assert backend.get_next_position(1) == 3
+
+    backend.delete_message(2)
+    assert [m["content"] for m in backend.get_context(1)] == ["Hello", "Bye"]
+
+    backend.delete_conversation(1)
+    assert backend.get_context(1) == []
+    assert backend.get_conversation_attributes(1) is None
+
+
+def test_messages_require_a_conversation(backend):
+    with pytest.raises(_integrity_errors()):
+        backend.put_message({"role": "user", "content": "Orphan"}, 42, 0, 1)
+
+
+def test_transaction_rolls_back_on_error(backend):
+    with pytest.raises(RuntimeError):
+        with backend.transaction():
+            backend.put_conversation(1)
+            with backend.transaction():
+                backend.put_messages([({"role": "user", "content": "Hi"}, 1, 0, 1)])
+            raise RuntimeError
+
+    assert backend.get_max_conversation_id() == 0
+    assert backend.get_context(1) == []
+
+
+def test_snapshot_does_not_block_writers(backend):
+    backend.put_conversation(1)
+    with backend.snapshot() as conn:
+        count = "SELECT COUNT(*) FROM conversations"
+        assert conn.execute(count).fetchone()[0] == 1
+        writer = threading.Thread(target=backend.put_conversation, args=(2,))
+        writer.start()
+        writer.join(timeout=2)
+        assert not writer.is_alive()
+        assert conn.execute(count).fetchone()[0] == 1
+
+    assert backend.get_max_conversation_id() == 2
+
+
+def test_create_conversation_from_many_threads(backend):
+    ids = []
+
+    def create():
+        for _ in range(5):
+            ids.append(backend.create_conversation())
+
+    threads = [threading.Thread(target=create) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(ids) == list(range(1, 21))
+
+
+def test_titles(backend):
+    for conversation_id in (1, 2):
+        backend.put_conversation(conversation_id)
+        backend.update_conversation_title(conversation_id, "Draft", pending=True)
+    backend.update_conversation_title(2, "Chosen by the user")
+    assert backend.get_pending_titles() == [1]
+
+    backend.replace_pending_title(1, "Generated")
+    backend.replace_pending_title(2, "Generated")
+    assert backend.get_conversation_attributes(1)["title"] == "Generated"
+    assert backend.get_conversation_attributes(2)["title"] == "Chosen by the user"
+    assert backend.get_pending_titles() == []
+
+
+def test_find_message_full_text(backend):
+    backend.put_conversation(1)
+    backend.put_messages(
+        [
+            ({"role": "user", "content": "How do tokenizers work?"}, 1, 0, 5),
+            ({"role": "assistant", "content": "A tokenizer splits text"}, 1, 1, 4),
+            ({"role": "user", "content": "Tokenizer tokenizer tokenizer"}, 1, 2, 3),
+        ]
+    )
+
+    found = backend.find_message("tokenizer", full_text=True)
+    assert found["id"].tolist() == [3, 2]
+    assert "**tokenizer**" in found.iloc[1]["snippet"]
+    assert backend.find_message('"splits text"', full_text=True)["id"].tolist() == [2]
+    assert backend.find_message("TOKENIZERS")["id"].tolist() == [1]
+
+    backend.delete_message(3)
+    assert backend.find_message("tokenizer", full_text=True)["id"].tolist() == [2]
+
+
+def test_get_context_window(backend):
+    backend.put_conversation(1)
+    backend.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 10) for i in range(5)
+    )
+
+    window, first_position, token_count = backend.get_context_window(1, 30)
+    assert [message["content"] for message in window] == [
+        "Message 2",
+        "Message 3",
+        "Message 4",
+    ]
+    assert first_position == 2
+    assert token_count == 30
+    assert len(backend.get_context_window(1, 30, message_overhead=4)[0]) == 2
+    assert backend.get_context_window(1, 100, after_position=2)[1] == 3
+    assert backend.get_context_window(1, 5) == ([], 5, 0)
+
+
+def test_summary_is_invalidated_by_deleting_a_covered_message(backend):
+    backend.put_conversation(1)
+    backend.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 10) for i in range(5)
+    )
+    backend.put_summary(1, 0, 1, "First summary", 2)
+    backend.put_summary(1, 0, 2, "Extended summary", 2)
+    assert backend.get_summary(1)["content"] == "Extended summary"
+
+    backend.delete_message(5)
+    assert backend.get_summary(1) is not None
+    backend.delete_message(2)
+    assert backend.get_summary(1) is None
+
+
+def test_delete_empty_conversations(backend):
+    for conversation_id in (1, 2, 3, 4):
+        backend.put_conversation(conversation_id)
+    backend.update_conversation_title(2, "Titled")
+    backend.put_message({"role": "user", "content": "Hello"}, 3, 0, 1)
+
+    assert backend.delete_empty_conversations(min_age=3600) == 0
+    assert backend.delete_empty_conversations(exclude=[4]) == 1
+    assert backend.list_conversations()["id"].sort_values().tolist() == [2, 3, 4]
+
+
+def test_pagination(backend):
+    backend.put_conversation(1)
+    backend.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 2) for i in range(5)
+    )
+
+    first_page = backend.get_messages(limit=2)
+    assert first_page["id"].tolist() == [1, 2]
+    second_page = backend.get_messages(limit=2, after_id=first_page["id"].iloc[-1])
+    assert second_page["id"].tolist() == [3, 4]
+    chunks = backend.iter_messages(MessageFilter(conversation_ids=[1]), chunk_size=2)
+    assert [chunk["id"].tolist() for chunk in chunks] == [[1, 2], [3, 4], [5]]
+
+    assert backend.find_message("Message", limit=2, offset=2)["id"].tolist() == [3, 4]
+    chunks = backend.iter_find_message("message", full_text=True, chunk_size=3)
+    assert [len(chunk) for chunk in chunks] == [3, 2]
+
+    for conversation_id in (2, 3):
+        backend.put_conversation(conversation_id)
+    assert len(backend.list_conversations(limit=2, offset=2)) == 1
+    assert [len(chunk) for chunk in backend.iter_conversations(chunk_size=2)] == [2, 1]
+
+
+def test_message_filter(backend):
+    for conversation_id in (1, 2):
+        backend.put_conversation(conversation_id)
+        backend.put_messages(
+            (
+                {"role": ("user", "assistant")[i % 2], "content": f"Message {i}"},
+                conversation_id,
+                i,
+                i * 10,
+            )
+            for i in range(4)
+        )
+
+    def ids(**criteria):
+        return backend.get_messages(MessageFilter(**criteria))["id"].tolist()
+
+    assert ids() == list(range(1, 9))
+    assert ids(conversation_ids=[2]) == [5, 6, 7, 8]
+    assert ids(conversation_ids=[1, 2], roles=["assistant"]) == [2, 4, 6, 8]
+    assert ids(conversation_ids=[1], min_position=1, max_position=2) == [2, 3]
+    assert ids(min_tokens=20, max_tokens=20) == [3, 7]
+    assert ids(conversation_ids=[]) == []
+
+    now = datetime.now(timezone.utc)
+    assert len(ids(created_after=now - timedelta(minutes=5))) == 8
+    assert ids(created_before=now - timedelta(minutes=5)) == []
+
+
+def test_conversation_aggregates(backend):
+    for conversation_id in (1, 2):
+        backend.put_conversation(conversation_id)
+    assert backend.get_next_position(1) == 0
+    backend.put_messages(
+        ({"role": "user", "content": f"Message {i}"}, 1, i, 10) for i in range(3)
+    )
+    backend.put_message({"role": "user", "content": "Hello"}, 2, 0, 50)
+    turn = TurnMetrics("gpt-4")
+    turn.finish(1000, 500)
+    backend.put_turn_metrics(1, turn)
+
+    def stats(conversation_id):
+        conversations = backend.list_conversations(stats=True).set_index("id")
+        return conversations.loc[conversation_id, CONVERSATION_STAT_COLUMNS].tolist()
+
+    assert stats(1) == [3, 30, 2, pytest.approx(0.06)]
+    assert backend.list_conversations(sort="tokens")["id"].tolist() == [2, 1]
+    assert backend.list_conversations(sort="cost")["id"].tolist() == [1, 2]
+    assert backend.get_next_position(1) == 3
+
+    backend.delete_message(3)
+    assert stats(1)[:3] == [2, 20, 1]
+    assert backend.get_next_position(1) == 2
+    backend.delete_message(1)
+    assert stats(1)[:3] == [1, 10, 1]
+
+    backend.delete_message(4)
+    assert stats(2)[:2] == [0, 0]
+    assert backend.get_next_position(2) == 0
+    assert backend.delete_empty_conversations() == 1
+    with pytest.raises(ValueError):
+        backend.list_conversations(sort="size")
+
+
+def test_candidates_and_turn_metrics(backend):
+    backend.put_conversation(1)
+    candidate_id = backend.put_candidate(
+        {"conversation_id": 1, "conversation_position": 0, "content": "One"}
+    )
+    backend.choose_candidate(candidate_id)
+    assert backend.get_candidate(candidate_id)["chosen"] == 1
+    assert backend.get_candidates(1)["content"].tolist() == ["One"]
+
+    turn = TurnMetrics("gpt-4")
+    turn.finish(10, 20)
+    backend.put_turn_metrics(1, turn)
+    turns = backend.get_turn_metrics(1)
+    assert turns[["model", "prompt_tokens"]].values.tolist() == [["gpt-4", 10]]
+
+
+def test_chatbot_on_backend(backend, tmp_path):
+    chatbot = Chatbot(database=backend, db_path=str(tmp_path / "unused.db"))
+    assert chatbot.conversation_id == 1
+
+    chatbot.upload_conversation(
+        [
+            {"role": "user", "content": "Hello", "token_count": 1},
+            {"role": "assistant", "content": "Hi", "token_count": 1},
+        ]
+    )
+    chatbot._save_turn(
+        {"role": "user", "content": "Again"}, {"role": "assistant", "content": "Yes"}, 1
+    )
+    chatbot.title_worker.close()
+
+    assert chatbot.conversation_id == 2
+    assert [m["content"] for m in backend.get_context(2)] == [
+        "Hello",
+        "Hi",
+        "Again",
+        "Yes",
+    ]
@@ -0,0 +1,31 @@
+import pytest
+import unittest.mock as mock
+from chatgpt.streaming import StreamBuffer
+
+
+def test_flush_every_token():
+    buffer = StreamBuffer("token")
+    assert buffer.add("Hello") == "Hello"
+    assert buffer.add(" world") == " world"
+    assert buffer.flush() == ""
+
+
+def test_flush_on_newline():
+    buffer = StreamBuffer("line")
+    assert buffer.add("Hello") is None
+    assert buffer.add(" world\n") == "Hello world\n"
+    assert buffer.add("Bye") is None
+    assert buffer.flush() == "Bye"
+
+
+def test_flush_on_interval():
+    with mock.patch("chatgpt.streaming.time.monotonic", return_value=0.0):
+        buffer = StreamBuffer(50)
+        assert buffer.add("Hello") is None
+    with mock.patch("chatgpt.streaming.time.monotonic", return_value=0.06):
+        assert buffer.add(" world") == "Hello world"
+
+
+def test_invalid_flush_policy():
+    with pytest.raises(ValueError):
+        StreamBuffer("sentence")
@@ -0,0 +1,85 @@
+import os
+import pytest
+from chatgpt.database import LocalDatabase
+from chatgpt.titles import TitleWorker, heuristic_title, parse_titles
+
+
+@pytest.fixture
+def db():
+    db = LocalDatabase(db_file="test.db")
+    db.create_tables()
+    yield db
+
+    db.close()
+    os.remove("test.db")
+
+
+def add_conversation(db, conversation_id, content):
+    db.put_conversation(conversation_id)
+    db.put_message({"role": "user", "content": content}, conversation_id, 0, 1)
+    db.update_conversation_title(conversation_id, heuristic_title(content), True)
+
+
+def test_heuristic_title():
+    assert heuristic_title("What is the capital of France?") == (
+        "What is the capital of France?"
+    )
+    assert heuristic_title("one two three four five six seven eight nine") == (
+        "one two three four five six seven eight..."
+    )
+
+
+def test_parse_titles():
+    content = '1: Capitals of Europe\n2. "Sorting in Python"\nSomething else\n9: x'
+    assert parse_titles(content, 3) == [
+        "Capitals of Europe",
+        "Sorting in Python",
+        None,
+    ]
+
+
+def test_worker_batches_conversations(db):
+    calls = []
+
+    def generate_titles(messages):
+        calls.append(messages)
+        return [message["content"].upper() for message in messages]
+
+    for conversation_id in (1, 2, 3):
+        add_conversation(db, conversation_id, f"conversation {conversation_id}")
+    worker = TitleWorker(db, batch_size=2, batch_delay=0.1)
+    for conversation_id in (1, 2, 3):
+        worker.submit(conversation_id, generate_titles)
+    worker.join()
+    worker.close()
+
+    assert [len(messages) for messages in calls] == [2, 1]
+    assert db.get_conversation_attributes(3)["title"] == "CONVERSATION 3"
+    assert db.get_pending_titles() == []
+
+
+def test_worker_keeps_titles_set_meanwhile(db):
+    add_conversation(db, 1, "conversation 1")
+
+    def generate_titles(messages):
+        db.update_conversation_title(1, "Chosen by the user")
+        return ["Generated"]
+
+    worker = TitleWorker(db, batch_delay=0)
+    worker.submit(1, generate_titles)
+    worker.join()
+    worker.close()
+
+    assert db.get_conversation_attributes(1)["title"] == "Chosen by the user"
+
+
+def test_worker_resumes_pending_titles(db):
+    add_conversation(db, 1, "left over from a previous run")
+    add_conversation(db, 2, "new conversation")
+
+    worker = TitleWorker(db, batch_delay=0.1, resume_pending=True)
+    worker.submit(2, lambda messages: ["Title"] * len(messages))
+    worker.join()
+    worker.close()
+
+    assert db.get_conversation_attributes(1)["title"] == "Title"
@@ -0,0 +1,15 @@
+from chatgpt.tokens import count_tokens, count_tokens_batch, get_encoding
+
+
+def test_get_encoding_is_cached():
+    assert get_encoding("gpt-3.5-turbo") is get_encoding("gpt-3.5-turbo")
+
+
+def test_count_tokens():
+    assert count_tokens("Hi there! How can I help you?") == 9
+    assert count_tokens("<|endoftext|>") > 0
+
+
+def test_count_tokens_batch_matches_single_counts():
+    texts = ["Hello", "Can you tell me a joke?", "To get to the other side!"]
+    assert count_tokens_batch(texts) == [count_tokens(text) for text in texts]